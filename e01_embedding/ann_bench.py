@@ -0,0 +1,89 @@
+# =====================================
+# ANN backend のベンチマーク
+# =====================================
+# カタログサイズごとに backend を選べるように、exact / hnsw / annoy / int8 / pq について
+#   build 時間, クエリ latency の p50 / p99, スループット（1 秒あたりに捌けるアイテム数）,
+#   メモリ（index 全体と 1 アイテムあたりのバイト数）, exact に対する recall@k
+# を測る。int8 / pq のメモリは走査する圧縮コードの分（再ランキング用の元のベクトルは含まない）。
+#   python ann_bench.py
+import time
+
+import numpy as np
+import psutil
+
+from ann_index import build_index
+from report import print_report
+
+
+def synthetic_embeddings(n, dim=384, n_clusters=100, seed=0):
+    """カテゴリっぽい塊のある正規化済みベクトル（カタログの代わり）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, n)
+    x = centers[labels] + 0.8 * rng.standard_normal((n, dim)).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x
+
+
+def recall_at_k(found, truth):
+    """行ごとの |found ∩ truth| / |truth| の平均（-1 は無視）"""
+    hits = [len(set(f[f >= 0]) & set(t[t >= 0])) / max((t >= 0).sum(), 1)
+            for f, t in zip(found, truth)]
+    return float(np.mean(hits))
+
+
+def benchmark(embeddings, queries, backends=("exact", "hnsw", "annoy", "int8", "pq", "pca"),
+              k=10, params=None):
+    """
+    params: {"hnsw": {"M": 16, "ef": 50}, "annoy": {"n_trees": 50}} のような backend ごとの設定
+    戻り値: backend ごとの結果 dict のリスト
+    """
+    params = params or {}
+    truth, _ = build_index("exact", embeddings).search_batch(queries, k)
+    process = psutil.Process()
+
+    results = []
+    for backend in backends:
+        rss_before = process.memory_info().rss
+        start = time.perf_counter()
+        index = build_index(backend, embeddings, **params.get(backend, {}))
+        if hasattr(index, "build"):
+            index.build()  # Annoy は検索時まで build を遅らせているので、ここで作る
+        build_sec = time.perf_counter() - start
+        rss_delta = process.memory_info().rss - rss_before
+
+        latencies = []
+        found = np.full((len(queries), k), -1, dtype=np.intp)
+        for i, q in enumerate(queries):
+            t0 = time.perf_counter()
+            ids, _ = index.search(q, k)
+            latencies.append(time.perf_counter() - t0)
+            found[i, :len(ids)] = ids
+
+        latencies_ms = np.array(latencies) * 1000.0
+        results.append({
+            "backend": backend,
+            "n": len(embeddings),
+            "build_sec": build_sec,
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "Mitems/sec": len(embeddings) / latencies_ms.mean() / 1e3,
+            "memory_mb": index.memory_bytes() / 1e6,
+            "bytes/item": index.memory_bytes() / len(embeddings),
+            "rss_delta_mb": rss_delta / 1e6,
+            f"recall@{k}": recall_at_k(found, truth),
+        })
+    return results
+
+
+def main() -> None:
+    k = 10
+    for n in (10_000, 100_000):
+        emb = synthetic_embeddings(n)
+        queries = synthetic_embeddings(200, seed=1)
+        print(f"\n=== n={n}, dim={emb.shape[1]}, queries={len(queries)} ===")
+        print_report(benchmark(emb, queries, k=k))
+
+
+if __name__ == "__main__":
+    main()
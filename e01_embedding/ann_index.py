@@ -0,0 +1,336 @@
+# =====================================
+# 近傍探索 index の共通インターフェース
+# =====================================
+# recommend_* 系の関数から backend を差し替えられるように、
+#   "exact": NumPy の全件内積（今までの product_embeddings @ query_emb と同じ）
+#   "hnsw" : hnswlib
+#   "annoy": Annoy
+#   "int8" / "pq": 圧縮コード / "pca": PCA で次元を落としたコピー で候補を出して
+#                 float で再ランキング（quantized_index.py）
+# を同じメソッドで使えるようにする。ベクトルは正規化済み（内積 = cos 類似度）を前提にする。
+#
+#   index.add_items(vectors, ids)      追加 / 上書き（ids は行番号などの int）
+#   index.mark_deleted(id)             削除
+#   index.search(query, k, exclude=, accept=)  → (ids, scores)  スコア降順
+#   index.search_batch(queries, k)     → (n_queries, k) の ids / scores（足りない所は -1）
+#   index.search_cost(k)               → 1 クエリで計算する内積の数の目安（filtered_index が使う）
+#
+# ProductStore.attach_index() の factory からもそのまま使える。
+# スクリプト（e05〜e14）は DEFAULT_BACKEND を使う。既定は "exact" で、環境変数で切り替えられる
+#   ANN_BACKEND=hnsw python e08_mini.py
+import os
+
+import numpy as np
+
+from topk import top_k_indices, top_k_rows
+
+BACKENDS = ("exact", "hnsw", "annoy", "int8", "pq", "pca")
+DEFAULT_BACKEND = os.environ.get("ANN_BACKEND", "exact")
+
+
+class AnnIndex:
+    """共通部分: フィルター付き search は「多めに取って落とす、足りなければ増やす」"""
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def _knn(self, query, k):
+        """フィルター無しの上位 k 件 (ids, scores)"""
+        raise NotImplementedError
+
+    def search(self, query, k, exclude=None, accept=None):
+        """
+        exclude: ids で引ける bool マスク（True は除外）
+        accept : accept(id) -> bool（False は除外）
+        """
+        n = len(self)
+        if k <= 0 or n == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        kk = min(n, k if exclude is None and accept is None else 2 * k)
+        while True:
+            ids, scores = self._knn(query, kk)
+            keep = np.ones(len(ids), dtype=bool)
+            if exclude is not None:
+                keep &= ~exclude[ids]
+            if accept is not None:
+                keep &= np.array([accept(i) for i in ids], dtype=bool)
+            ids, scores = ids[keep], scores[keep]
+            if len(ids) >= k or kk >= n:
+                return ids[:k], scores[:k]
+            kk = min(n, kk * 4)
+
+    def search_batch(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32)
+        out_ids = np.full((len(queries), k), -1, dtype=np.intp)
+        out_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, q in enumerate(queries):
+            ids, scores = self.search(q, k)
+            out_ids[i, :len(ids)] = ids
+            out_scores[i, :len(ids)] = scores
+        return out_ids, out_scores
+
+    def memory_bytes(self):
+        """index 本体のおおよそのメモリ量"""
+        return 0
+
+    def search_cost(self, k):
+        """フィルター無しで上位 k 件を引くときに計算する内積の数の目安（既定は全件）"""
+        return len(self)
+
+
+class ExactIndex(AnnIndex):
+    """
+    NumPy の全件スコア。embeddings に ndarray / MappedMatrix を渡すとコピーせずに使う
+    （add_items されたときに初めて書き込み可能な float32 にする）。ids は行番号。
+    """
+
+    def __init__(self, dim, max_elements=1024, embeddings=None):
+        self.dim = dim
+        if embeddings is not None:
+            self._emb = embeddings
+            self._n = len(embeddings)
+            self._alive = np.ones(self._n, dtype=bool)
+        else:
+            self._emb = np.zeros((max_elements, dim), dtype=np.float32)
+            self._n = 0
+            self._alive = np.zeros(max_elements, dtype=bool)
+
+    def __len__(self):
+        return int(self._alive[:self._n].sum())
+
+    def get_max_elements(self):
+        return len(self._alive)
+
+    def resize_index(self, max_elements):
+        self._make_writable(max_elements)
+
+    def add_items(self, vectors, ids=None):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        ids = np.arange(self._n, self._n + len(vectors)) if ids is None else np.asarray(ids)
+        need = int(ids.max()) + 1 if len(ids) else 0
+        self._make_writable(max(need, len(self._alive)))
+        self._emb[ids] = vectors
+        self._alive[ids] = True
+        self._n = max(self._n, need)
+
+    def mark_deleted(self, id_):
+        self._alive[id_] = False
+
+    def scores(self, query):
+        """全行のスコア。削除済みは -inf"""
+        if hasattr(self._emb, "scores"):
+            scores = self._emb.scores(query)[..., :self._n]
+        else:
+            scores = (self._emb[:self._n] @ np.asarray(query, dtype=np.float32).T).T
+        scores[..., ~self._alive[:self._n]] = -np.inf
+        return scores
+
+    def vectors(self, ids):
+        """ids の行を float32 で取り出す（再ランキング用）"""
+        if hasattr(self._emb, "rows"):
+            return self._emb.rows(ids)
+        return np.asarray(self._emb[ids], dtype=np.float32)
+
+    def search(self, query, k, exclude=None, accept=None):
+        scores = self.scores(query)
+        ids = top_k_indices(scores, k, exclude=exclude, accept=accept)
+        return ids, scores[ids]
+
+    def _knn(self, query, k):
+        return self.search(query, k)
+
+    def search_batch(self, queries, k):
+        scores = self.scores(np.asarray(queries, dtype=np.float32))
+        ids = top_k_rows(scores, k)
+        top = np.take_along_axis(scores, ids, axis=1)
+        return np.where(top > -np.inf, ids, -1), top
+
+    def memory_bytes(self):
+        data = getattr(self._emb, "data", self._emb)
+        return 0 if isinstance(data, np.memmap) else data.nbytes
+
+    def _make_writable(self, capacity):
+        emb = self._emb
+        if isinstance(emb, np.ndarray) and emb.flags.writeable and len(emb) >= capacity:
+            return
+        if hasattr(emb, "rows"):
+            emb = emb.rows(np.arange(self._n))
+        new = np.zeros((max(capacity, self._n), self.dim), dtype=np.float32)
+        new[:self._n] = emb[:self._n]
+        alive = np.zeros(len(new), dtype=bool)
+        alive[:self._n] = self._alive[:self._n]
+        self._emb, self._alive = new, alive
+
+
+class HnswIndex(AnnIndex):
+    """hnswlib（space="ip"。正規化済みベクトルなら cos と同じ順位）"""
+
+    def __init__(self, dim, max_elements=1024, M=16, ef_construction=200, ef=50):
+        import hnswlib
+
+        self.dim = dim
+        self.M = M
+        self.ef = ef
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        self.index.init_index(max_elements=max_elements, ef_construction=ef_construction, M=M)
+        self.index.set_ef(ef)
+        self._live = set()
+
+    def __len__(self):
+        return len(self._live)
+
+    def get_max_elements(self):
+        return self.index.get_max_elements()
+
+    def resize_index(self, max_elements):
+        self.index.resize_index(max_elements)
+
+    def add_items(self, vectors, ids=None):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if ids is None:
+            ids = np.arange(self.index.get_current_count(),
+                            self.index.get_current_count() + len(vectors))
+        need = self.index.get_current_count() + len(vectors)
+        if need > self.index.get_max_elements():
+            self.index.resize_index(max(need, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, ids)
+        self._live.update(int(i) for i in ids)
+
+    def mark_deleted(self, id_):
+        if int(id_) in self._live:
+            self.index.mark_deleted(int(id_))
+            self._live.discard(int(id_))
+
+    def search(self, query, k, exclude=None, accept=None):
+        if k <= 0 or len(self) == 0 or (exclude is None and accept is None):
+            return super().search(query, k, exclude=exclude, accept=accept)
+
+        # hnswlib の filter: グラフをたどりながら対象外の id を飛ばす（多めに取って落とさない）
+        def keep(id_):
+            return (exclude is None or not exclude[id_]) and (accept is None or accept(id_))
+
+        try:
+            return self._knn(query, k, filter=keep)
+        except RuntimeError:
+            # 対象が k 件に足りないと hnswlib は例外を出す → 多めに取って落とす方で引き直す
+            return super().search(query, k, exclude=exclude, accept=accept)
+
+    def _knn(self, query, k, filter=None):
+        k = min(k, len(self))
+        self.index.set_ef(max(self.ef, k))
+        labels, distances = self.index.knn_query(np.asarray(query, dtype=np.float32), k=k,
+                                                 filter=filter)
+        # space="ip" の距離は 1 - 内積
+        return labels[0].astype(np.intp), (1.0 - distances[0]).astype(np.float32)
+
+    def search_cost(self, k):
+        # 第 0 層で max(ef, k) 個の候補をたどり、それぞれのリンク（M*2 本）の先と内積を取る
+        return min(len(self), max(self.ef, k) * 2 * self.M)
+
+    def memory_bytes(self):
+        # データ + 第 0 層のリンク（M*2 本）+ 上の層（おおよそ）
+        n = self.index.get_current_count()
+        return int(n * (self.dim * 4 + self.M * 2 * 4 + 16) * 1.1)
+
+
+class AnnoyIndex(AnnIndex):
+    """
+    Annoy（metric="dot"）。Annoy は build 後に追加できないので、
+    追加があったら次の検索時に作り直す。削除は検索結果から落とす。
+    """
+
+    def __init__(self, dim, max_elements=None, n_trees=50, search_k=-1):
+        self.dim = dim
+        self.n_trees = n_trees
+        self.search_k = search_k
+        self.index = None
+        self._vectors = {}  # id → ベクトル（作り直し用）
+        self._deleted = set()
+        self._dirty = True
+
+    def __len__(self):
+        return len(self._vectors) - len(self._deleted)
+
+    def add_items(self, vectors, ids=None):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if ids is None:
+            ids = range(len(self._vectors), len(self._vectors) + len(vectors))
+        for i, v in zip(ids, vectors):
+            self._vectors[int(i)] = v
+            self._deleted.discard(int(i))
+        self._dirty = True
+
+    def mark_deleted(self, id_):
+        if int(id_) in self._vectors:
+            self._deleted.add(int(id_))
+
+    def build(self):
+        from annoy import AnnoyIndex as _Annoy
+
+        index = _Annoy(self.dim, "dot")
+        for i, v in self._vectors.items():
+            if i not in self._deleted:
+                index.add_item(i, v)
+        index.build(self.n_trees)
+        self.index = index
+        self._dirty = False
+
+    def _knn(self, query, k):
+        if self._dirty:
+            self.build()
+        # build 後に削除されたものも結果に出てくるので、その分多めに取る
+        labels, scores = self.index.get_nns_by_vector(
+            np.asarray(query, dtype=np.float32), k + len(self._deleted),
+            search_k=self.search_k, include_distances=True)
+        pairs = [(i, s) for i, s in zip(labels, scores) if i not in self._deleted][:k]
+        return (np.array([i for i, _ in pairs], dtype=np.intp),
+                np.array([s for _, s in pairs], dtype=np.float32))
+
+    def search_cost(self, k):
+        # search_k 個の葉の候補と内積を取る（-1 のときの Annoy の既定は n_trees * k）
+        return min(len(self), self.search_k if self.search_k > 0 else self.n_trees * k)
+
+    def memory_bytes(self):
+        # ノード 1 個あたりベクトル + 子へのリンク。木の数ぶん内部ノードがある（おおよそ）
+        n = len(self)
+        return n * (self.dim * 4 + 12) * 2 + n * self.n_trees * 8
+
+
+def make_index(backend, dim, max_elements=1024, **params):
+    """backend 名 → 空の index"""
+    if backend == "exact":
+        return ExactIndex(dim, max_elements=max_elements)
+    if backend == "hnsw":
+        return HnswIndex(dim, max_elements=max_elements, **params)
+    if backend == "annoy":
+        return AnnoyIndex(dim, max_elements=max_elements, **params)
+    if backend in ("int8", "pq", "pca"):
+        from quantized_index import make_quantized_index
+
+        return make_quantized_index(backend, dim, max_elements=max_elements, **params)
+    raise ValueError(f"backend must be one of {BACKENDS}: {backend}")
+
+
+def build_index(backend, embeddings, **params):
+    """
+    embeddings（ndarray / MappedMatrix）の全行を id=行番号 で登録した index を返す。
+    "exact" はコピーせずにそのままスコア計算に使う（"int8" / "pq" / "pca" も再ランキングにそのまま使う）
+    """
+    if backend == "exact":
+        return ExactIndex(embeddings.shape[1], embeddings=embeddings)
+    if backend in ("int8", "pq", "pca"):
+        from quantized_index import build_quantized_index
+
+        return build_quantized_index(backend, embeddings, **params)
+    index = make_index(backend, embeddings.shape[1], max_elements=max(len(embeddings), 1),
+                       **params)
+    vectors = embeddings.rows(np.arange(len(embeddings))) if hasattr(embeddings, "rows") \
+        else embeddings
+    index.add_items(vectors, np.arange(len(embeddings)))
+    return index
+
+
+def index_factory(backend, **params):
+    """ProductStore.attach_index() 用の factory(dim, max_elements)"""
+    return lambda dim, max_elements: make_index(backend, dim, max_elements=max_elements,
+                                                **params)
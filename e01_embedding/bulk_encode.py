@@ -0,0 +1,253 @@
+# =====================================
+# カタログ全体をプロセスプールで encode する（一括の再 embedding 用）
+# =====================================
+# 1 プロセスの中で torch のスレッド数を増やしてもコア数に比例して速くならないので、
+#   texts を shard_size 件ずつに分け、n_workers 個のプロセス（それぞれ threads_per_worker スレッド）で encode
+#   結果は shard の順番どおりに path/data.npy（embedding_matrix と同じ形式）へ書き込む
+#   終わった shard は path/progress.json に記録し、途中で止まっても続きから再開できる
+#   全部終わったら meta.json を書く（load_matrix で開けるのはそこから）
+#   sort_by_length=True なら全体をトークン数順に並べてから shard に分け、shard ごとに
+#   最大長に合わせたバッチサイズで encode する（length_buckets.py。書き込み先は元の行）
+# 商品カタログ（.jsonl）を渡すと catalog.product_to_text で文章にする。--truncate なら先に
+# length_buckets.truncate_fields で説明などをフィールドごとの上限で切る。
+#   python bulk_encode.py texts.txt .cache/bulk_products --workers 8 --threads 2
+#   python bulk_encode.py products.jsonl .cache/bulk_products --truncate
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import get_context
+
+import numpy as np
+
+from catalog import product_to_text, read_catalog
+from embedding_cache import texts_fingerprint
+from embedding_matrix import load_matrix, write_meta
+from length_buckets import (DEFAULT_TOKEN_BUDGET, FIELD_BUDGETS, batch_size_for, load_tokenizer,
+                            text_lengths, truncate_fields)
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+_worker_model = None
+
+
+@contextmanager
+def _thread_env(threads):
+    """
+    ワーカーの BLAS / OpenMP のスレッド数。spawn の子プロセスは起動時に親の環境変数を引き継ぎ、
+    numpy などはそれを import 時に読むので、子の中ではなく親でプールを作る前に設定する
+    """
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _init_worker(model_name, backend, threads):
+    """ワーカープロセスごとに 1 回: モデルを読み込む（torch / ONNX Runtime のスレッド数は threads）"""
+    global _worker_model
+    from model_registry import get_model
+
+    _worker_model = get_model(model_name, backend=backend, verbose=False, threads=threads)
+
+
+def _encode_with(model, texts, batch_size, normalize_embeddings):
+    emb = model.encode(texts, batch_size=batch_size, normalize_embeddings=normalize_embeddings)
+    return np.asarray(emb, dtype=np.float32)
+
+
+def _encode_shard(texts, batch_size, normalize_embeddings):
+    return _encode_with(_worker_model, texts, batch_size, normalize_embeddings)
+
+
+def _encode_in_process(shards, plan, model, normalize_embeddings):
+    for start in shards:
+        rows, shard_texts, shard_batch = plan(start)
+        yield start, rows, _encode_with(model, shard_texts, shard_batch, normalize_embeddings)
+
+
+def _encode_in_pool(shards, plan, model_name, backend, n_workers, threads, normalize_embeddings):
+    """shards を n_workers プロセスで encode して、(start, rows, emb) を shards の順に返す"""
+    if not shards:
+        return
+    ctx = get_context("spawn")  # torch は fork と相性が悪いので spawn
+    # ワーカーは最初の submit のときに起動するので、プールを閉じるまで環境変数を設定しておく
+    with _thread_env(threads), \
+            ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_init_worker,
+                                initargs=(model_name, backend, threads)) as pool:
+        def submit(start):
+            rows, shard_texts, shard_batch = plan(start)
+            return rows, pool.submit(_encode_shard, shard_texts, shard_batch,
+                                     normalize_embeddings)
+
+        # 先読みは n_workers * 2 shard まで（メモリを抑える）。結果は投入順に受け取って書く
+        queue = iter(shards)
+        pending = deque((start, *submit(start)) for start in islice(queue, n_workers * 2))
+        while pending:
+            start, rows, future = pending.popleft()
+            emb = future.result()
+            next_start = next(queue, None)
+            if next_start is not None:
+                pending.append((next_start, *submit(next_start)))
+            yield start, rows, emb
+
+
+def _load_progress(path, job):
+    """同じジョブの progress.json があれば終わった shard の集合と dim を返す"""
+    progress_path = os.path.join(path, "progress.json")
+    if not os.path.exists(progress_path) or not os.path.exists(os.path.join(path, "data.npy")):
+        return set(), None
+    with open(progress_path) as f:
+        progress = json.load(f)
+    if progress.get("job") != job:
+        return set(), None
+    return set(progress["done"]), progress["dim"]
+
+
+def _save_progress(path, job, done, dim):
+    tmp_path = os.path.join(path, "progress.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"job": job, "dim": dim, "done": sorted(done)}, f)
+    os.replace(tmp_path, os.path.join(path, "progress.json"))
+
+
+def catalog_texts(products, text_fn=product_to_text, field_budgets=None, tokenizer=None):
+    """
+    商品 dict → encode する文章。
+    field_budgets（FIELD_BUDGETS など）があれば truncate_fields で切ってから text_fn に通す
+    """
+    if field_budgets is None:
+        return [text_fn(p) for p in products]
+    return [text_fn(truncate_fields(p, field_budgets, tokenizer)) for p in products]
+
+
+def bulk_encode(texts, path, model_name=MODEL_NAME, backend="torch", n_workers=None,
+                threads_per_worker=1, shard_size=4096, batch_size=64,
+                normalize_embeddings=True, sort_by_length=True,
+                token_budget=DEFAULT_TOKEN_BUDGET, max_length=256, version=0, model=None,
+                verbose=True):
+    """
+    texts を encode して path/ に保存し、load_matrix(path) の結果（MappedMatrix）を返す。
+    同じ texts / 設定で呼び直すと、progress.json に記録済みの shard は飛ばす
+    sort_by_length=False なら入力順のまま、全 shard を batch_size で encode する
+    model: 読み込み済みのモデルを渡すと、プロセスプールを使わずにこのプロセスで encode する
+    """
+    texts = list(texts)
+    n = len(texts)
+    n_workers = n_workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+    if sort_by_length:
+        lengths = text_lengths(texts, load_tokenizer(model_name), max_length)
+        order = np.argsort(lengths, kind="stable")
+    else:
+        lengths, order = None, np.arange(n)
+    job = {
+        "texts": texts_fingerprint(texts), "n": n, "model_name": model_name,
+        "backend": backend, "normalize_embeddings": normalize_embeddings,
+        "shard_size": shard_size, "order": hashlib.sha1(order.tobytes()).hexdigest(),
+    }
+    os.makedirs(path, exist_ok=True)
+    done, dim = _load_progress(path, job)
+    data_path = os.path.join(path, "data.npy")
+    data = None
+    if dim is not None:
+        data = np.lib.format.open_memmap(data_path, mode="r+")
+    else:
+        # 前の結果は使えないので、meta.json を消してから書き始める
+        for name in ("meta.json", "progress.json"):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+
+    shards = [i for i in range(0, n, shard_size) if i not in done]
+    if verbose and done:
+        print(f"[bulk encode] resume: {len(done)} shards done, {len(shards)} left")
+
+    def plan(start):
+        # shard の中は行番号順（書き込みが連続になる）
+        rows = np.sort(order[start:start + shard_size])
+        shard_batch = batch_size if lengths is None else \
+            batch_size_for(lengths[rows].max(), token_budget)
+        return rows, [texts[i] for i in rows], shard_batch
+
+    start_time = time.perf_counter()
+    rows_done = sum(min(shard_size, n - s) for s in done)
+    n_rows = 0
+    if model is not None:
+        encoded = _encode_in_process(shards, plan, model, normalize_embeddings)
+    else:
+        encoded = _encode_in_pool(shards, plan, model_name, backend, n_workers,
+                                  threads_per_worker, normalize_embeddings)
+    for start, rows, emb in encoded:
+        if data is None:
+            dim = emb.shape[1]
+            data = np.lib.format.open_memmap(data_path, mode="w+", dtype=np.float32,
+                                             shape=(n, dim))
+        data[rows] = emb
+        data.flush()
+        done.add(start)
+        _save_progress(path, job, done, dim)
+
+        rows_done += len(emb)
+        n_rows += len(emb)
+        if verbose:
+            elapsed = time.perf_counter() - start_time
+            print(f"[bulk encode] {rows_done}/{n} rows "
+                  f"({n_rows / max(elapsed, 1e-9):.0f} rows/sec)")
+
+    if data is None:  # texts が空
+        data = np.lib.format.open_memmap(data_path, mode="w+", dtype=np.float32, shape=(0, 0))
+    del data
+    write_meta(path, "float32", (n, dim or 0), version=version)
+    return load_matrix(path)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="texts / 商品カタログをまとめて encode する")
+    parser.add_argument("catalog", help="1 行に 1 テキストのファイル、または .jsonl のカタログ（1 行 1 商品）")
+    parser.add_argument("out", help="保存先のディレクトリ（embedding_matrix 形式）")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--backend", default="torch")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=1, help="ワーカー 1 つあたりのスレッド数")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="--no-sort のときのバッチサイズ")
+    parser.add_argument("--token-budget", type=int, default=DEFAULT_TOKEN_BUDGET,
+                        help="長さ順のときの 1 バッチの（バッチサイズ × 最大長）")
+    parser.add_argument("--no-sort", action="store_true", help="長さ順に並べ替えない")
+    parser.add_argument("--truncate", action="store_true",
+                        help=f".jsonl のとき、フィールドごとに切り詰める {FIELD_BUDGETS}")
+    args = parser.parse_args()
+
+    if args.catalog.endswith(".jsonl"):
+        tokenizer = load_tokenizer(args.model) if args.truncate else None
+        texts = catalog_texts(read_catalog(args.catalog),
+                              field_budgets=FIELD_BUDGETS if args.truncate else None,
+                              tokenizer=tokenizer)
+    else:
+        with open(args.catalog, encoding="utf-8") as f:
+            texts = [line.rstrip("\n") for line in f]
+    start = time.perf_counter()
+    matrix = bulk_encode(texts, args.out, model_name=args.model, backend=args.backend,
+                         n_workers=args.workers, threads_per_worker=args.threads,
+                         shard_size=args.shard_size, batch_size=args.batch_size,
+                         sort_by_length=not args.no_sort, token_budget=args.token_budget)
+    elapsed = time.perf_counter() - start
+    print(f"shape = {matrix.shape}, {len(texts) / max(elapsed, 1e-9):.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+# =====================================
+# 商品カタログの読み込みと、encode する文章への変換
+# =====================================
+# e10_mini / bulk_encode / length_buckets で同じ文章を作るように、product_to_text はここに 1 つだけ置く。
+# カタログファイルは 1 行 1 商品の JSON（.jsonl）。
+import json
+
+
+def product_to_text(p):
+    """商品 dict → 名前 / カテゴリ / タグ / 説明 をつなげた文章"""
+    tags_text = " ".join(p.get("tags", []))
+    return (f"{p['name']}。カテゴリ: {p.get('category', '')}。タグ: {tags_text}。"
+            f"説明: {p.get('description', '')}")
+
+
+def read_catalog(path):
+    """.jsonl（1 行 1 商品の dict）を読む。空行は飛ばす"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
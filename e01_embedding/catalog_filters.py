@@ -0,0 +1,140 @@
+# =====================================
+# カテゴリ / キーワードフィルターを bool マスクにまとめて前計算
+# =====================================
+# リクエストごとに商品 1 件ずつ文字列を組み立てて部分一致を調べるのではなく、
+# カタログ（ProductStore）の version ごとに 1 回だけ
+#   キーワード → Aho–Corasick で全商品テキストを 1 パス走査して bool マスク
+#   カテゴリ / 在庫など → 商品 dict から bool マスク
+# を作っておき、リクエスト時はマスクを & / | で組み合わせてスコアに適用する。
+# version は store.upsert / delete / compact のたびに上がるので、在庫などが変わったら
+# store.changed_rows_since で変わった行だけ作り直す（compact のあとは全行）。
+from collections import deque
+
+import numpy as np
+
+
+class AhoCorasick:
+    """複数キーワードをまとめて 1 パスで探す（テキスト長に比例、キーワード数に依存しない）"""
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self._goto = [{}]   # state → {文字: 次の state}
+        self._fail = [0]
+        self._out = [set()]  # state → マッチしたキーワード番号
+        for i, kw in enumerate(self.keywords):
+            state = 0
+            for ch in kw:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                state = nxt
+            self._out[state].add(i)
+
+        # BFS で failure リンクを張る
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def _step(self, state, ch):
+        while state and ch not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(ch, 0)
+
+    def find(self, text):
+        """text に含まれるキーワード番号の集合"""
+        found = set()
+        state = 0
+        for ch in text:
+            state = self._step(state, ch)
+            found |= self._out[state]
+        return found
+
+    def contains_any(self, text):
+        state = 0
+        for ch in text:
+            state = self._step(state, ch)
+            if self._out[state]:
+                return True
+        return False
+
+
+def keyword_mask(texts, keywords):
+    """texts のうち、keywords のどれかを含むものが True"""
+    matcher = AhoCorasick(keywords)
+    return np.array([t is not None and matcher.contains_any(t) for t in texts],
+                    dtype=bool)
+
+
+def category_mask(products, categories):
+    categories = set(categories)
+    return np.array([p is not None and p.get("category") in categories
+                     for p in products], dtype=bool)
+
+
+def predicate_mask(products, fn):
+    """在庫ありなど、任意の条件 fn(p) -> bool をマスクにする（削除済み None は False）"""
+    return np.array([p is not None and bool(fn(p)) for p in products], dtype=bool)
+
+
+class CatalogFilters:
+    """
+    名前付きフィルターのマスクを、ProductStore（store.token）ごと・version ごとにキャッシュする
+        filters.register("hotpot", lambda products: keyword_mask(...))
+        allowed = filters.mask(store, ["hotpot", "in_stock"])  # AND。行番号で引ける
+    version が上がったら、前のマスクから変わった行だけ builder に渡して作り直す
+    """
+
+    def __init__(self):
+        self._builders = {}
+        self._cache = {}  # name → (store.token, store.version, mask)
+
+    def register(self, name, builder):
+        """
+        builder(products) -> (len(products),) の bool マスク（削除済みの行は None が来る）。
+        i 行目の値は products[i] だけで決まること（変わった行だけを渡して呼ぶことがある）
+        """
+        self._builders[name] = builder
+        self._cache.pop(name, None)
+
+    def get(self, name, store):
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == store.token:
+            _, version, mask = cached
+            if version == store.version:
+                return mask
+            changed = store.changed_rows_since(version, products=True)
+            if changed is not None:
+                mask = self._update(name, store, mask, changed)
+                self._cache[name] = (store.token, store.version, mask)
+                return mask
+        mask = self._builders[name](store.products)
+        self._cache[name] = (store.token, store.version, mask)
+        return mask
+
+    def _update(self, name, store, mask, changed):
+        """mask のコピーに、changed の行と増えた行だけ builder で計算し直して書き込む"""
+        n = len(store.products)
+        rows = sorted(changed | set(range(len(mask), n)))
+        out = np.zeros(n, dtype=bool)
+        out[:len(mask)] = mask
+        if rows:
+            out[rows] = self._builders[name]([store.products[r] for r in rows])
+        return out
+
+    def mask(self, store, names):
+        """names のマスクを AND したもの（names が空なら全部 True）"""
+        out = np.ones(len(store.products), dtype=bool)
+        for name in names:
+            out &= self.get(name, store)
+        return out
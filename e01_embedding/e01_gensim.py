@@ -1,21 +1,35 @@
-import gensim.downloader as api
+from glove_store import load_glove, load_normed_vectors
+from kv_batch import batch_similarity, key_ids
+from vocab_tiers import VocabTiers
+
+MODEL_NAME = "glove-wiki-gigaword-100"
 
 
 def main() -> None:
     print("Loading GloVe model (100d)...")
-    model = api.load("glove-wiki-gigaword-100")
+    # 初回だけ gensim のネイティブ形式に変換し、次からは mmap で開く
+    model = load_glove(MODEL_NAME)
     print("vocab size:", len(model))
 
-    # ベクトル演算: king - man + woman
-    king = model["king"]
-    man = model["man"]
-    woman = model["woman"]
+    # 正規化済みの語彙行列（mmap）。類似度 / アナロジーはこれに対してまとめて計算する
+    normed = load_normed_vectors(MODEL_NAME)
+    # 頻度上位 3 万語（"hot"）はメモリ上の連続した行列で探す。全語彙で探すときは restrict_vocab="full"
+    tiers = VocabTiers(normed, tiers={"hot": 30000, "warm": 100000}, resident="hot")
 
-    vec = king - man + woman
+    # ベクトル演算: king - man + woman（a に対する b は、c に対する何か = b - a + c）
+    analogies = [
+        ("man", "king", "woman"),
+        ("japan", "tokyo", "france"),
+        ("good", "better", "bad"),
+    ]
+    a, b, c = (key_ids(model, words) for words in zip(*analogies))
+    ids, scores = tiers.analogy(a, b, c, topn=10, restrict_vocab="hot")
 
-    print("\n=== king - man + woman に近い単語 Top 10 ===")
-    for word, score in model.similar_by_vector(vec, topn=10):
-        print(f"{word:10s}  {score:.4f}")
+    for (wa, wb, wc), ids_q, scores_q in zip(analogies, ids, scores):
+        print(f"\n=== {wb} - {wa} + {wc} に近い単語 Top 10 ===")
+        for i, score in zip(ids_q, scores_q):
+            if i >= 0:
+                print(f"{model.index_to_key[i]:10s}  {score:.4f}")
 
     print("\n=== いくつかの類似度 ===")
     pairs = [
@@ -25,8 +39,9 @@ def main() -> None:
         ("tokyo", "japan"),
         ("tokyo", "france"),
     ]
-    for w1, w2 in pairs:
-        sim = model.similarity(w1, w2)
+    w1s, w2s = zip(*pairs)
+    sims = batch_similarity(normed, key_ids(model, w1s), key_ids(model, w2s))
+    for (w1, w2), sim in zip(pairs, sims):
         print(f"{w1:10s} vs {w2:10s} → {sim:.4f}")
 
 
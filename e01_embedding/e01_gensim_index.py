@@ -1,13 +1,18 @@
-import gensim.downloader as api
-from gensim.similarities.annoy import AnnoyIndexer
+from glove_store import load_annoy_indexer, load_glove
+
+MODEL_NAME = "glove-wiki-gigaword-100"
+
 
 def main() -> None:
     print("Loading GloVe model (100d)...")
-    model = api.load("glove-wiki-gigaword-100")
+    # 初回だけ gensim のネイティブ形式に変換し、次からは mmap で開く
+    model = load_glove(MODEL_NAME)
     print("vocab size:", len(model))
 
     # 50 trees くらいで ANN Index を作る
-    annoy_index = AnnoyIndexer(model, num_trees=50)
+    # 初回だけ .cache/glove-wiki-gigaword-100/ にディスク上で（全コアで）作り、
+    # 次からは mmap で開くだけ（複数プロセスで同じ木を共有できる）
+    annoy_index = load_annoy_indexer(model, MODEL_NAME, num_trees=50, n_jobs=-1)
     # memo アルゴリズム Faiss / Annoy / hnswlib
     # memo ベクトルDB側（Qdrant / Milvus / Weaviate / pgvector）
     # など DBを使う方法もある
@@ -1,8 +1,17 @@
-from sentence_transformers import SentenceTransformer
-import hnswlib
+import os
+
 import numpy as np
 
-model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+from embedding_cache import texts_fingerprint
+from embedding_matrix import matrix_path, open_matrix
+from encoder_backend import ENCODER_BACKEND, cache_name
+from hnsw_store import open_hnsw_index
+from model_registry import lazy_model
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
 
 items = [
     "低脂肪牛乳 1L",
@@ -12,22 +21,25 @@ items = [
     "豚ロース 300g",
 ]
 
-emb = model.encode(items)
-print("shape =", emb.shape)
-
-###
-###
-##
-# embedding の準備
-vectors = emb.astype(np.float32)
-dim = vectors.shape[1]
-
-# HNSW index 作成
-p = hnswlib.Index(space='cosine', dim=dim)
-p.init_index(max_elements=len(vectors), ef_construction=200, M=16)
-p.add_items(vectors)
-
-# 検索
-q = model.encode(["無糖ヨーグルト"]).astype(np.float32)
-labels, distances = p.knn_query(q, k=3)
-print(labels, distances)
+
+def main() -> None:
+    # embedding 行列と HNSW index を .cache/e04_items/ に保存しておき、
+    # 次回からは読み込むだけにする（文章 + モデルが同じなら encode も書き込みもしない。
+    # 変わっていたら encode し直して保存し、HNSW も作り直す / 増えた分は追加）
+    items_path = matrix_path("e04_items")
+    matrix = open_matrix(items_path, lambda: model.encode(items).astype(np.float32),
+                         dtype="float32",
+                         key=texts_fingerprint(items, cache_name(MODEL_NAME, ENCODER_BACKEND)))
+    print("shape =", matrix.shape)
+
+    p = open_hnsw_index(os.path.join(items_path, "hnsw"), matrix.data,
+                        space='cosine', M=16, ef_construction=200)
+
+    # 検索
+    q = model.encode(["無糖ヨーグルト"]).astype(np.float32)
+    labels, distances = p.knn_query(q, k=3)
+    print(labels, distances)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,10 +27,17 @@ products = [
 ]
 
 # ③ モデル読み込み
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+from ann_index import DEFAULT_BACKEND, AnnIndex, build_index
+from embedding_cache import encode_with_cache
+from encoder_backend import ENCODER_BACKEND, cache_name
+from model_registry import lazy_model
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
 
 # ④ 商品1件を「文章」に変換する関数
 #   name を中心に、category や tags, description も足して意味をリッチにしています
@@ -43,9 +50,15 @@ def product_to_text(p):
         f"説明: {p.get('description', '')}"
     )
 
-# ⑤ 全商品の埋め込みをあらかじめ計算
-product_texts = [product_to_text(p) for p in products]
-product_embeddings = model.encode(product_texts, normalize_embeddings=True)  # cos類似度用に正規化
+# ⑤ 全商品の埋め込みをあらかじめ計算して index にする
+def build_product_index(products):
+    product_texts = [product_to_text(p) for p in products]
+    product_embeddings = encode_with_cache(model, product_texts,
+                                           cache_name(MODEL_NAME, ENCODER_BACKEND),
+                                           normalize_embeddings=True)  # cos類似度用に正規化
+
+    # 近傍探索の backend は ann_index.DEFAULT_BACKEND（既定は "exact"。環境変数 ANN_BACKEND で切り替え）
+    return build_index(DEFAULT_BACKEND, product_embeddings)
 
 # ⑥ 今ある材料(テキスト)からおすすめ商品を出す関数
 from typing import List, Dict
@@ -53,7 +66,7 @@ from typing import List, Dict
 def recommend_products_from_ingredients(
     ingredients_text: str,
     products: List[Dict],
-    product_embeddings: np.ndarray,
+    product_index: AnnIndex,
     top_k: int = 5,
 ):
     """
@@ -64,30 +77,35 @@ def recommend_products_from_ingredients(
     query_emb = model.encode([ingredients_text], normalize_embeddings=True)[0]
 
     # コサイン類似度 = 正規化したベクトル同士の内積
-    scores = product_embeddings @ query_emb  # shape: (n_products,)
-
-    # 類似度の高い順に top_k 件を取得
-    top_idx = np.argsort(scores)[::-1][:top_k]
+    # 類似度の高い順に top_k 件を取得（product_index の backend で探す）
+    top_idx, top_scores = product_index.search(query_emb, top_k)
 
     results = []
-    for idx in top_idx:
+    for idx, score in zip(top_idx, top_scores):
         p = products[idx]
         results.append({
             "id": p["id"],
             "name": p["name"],
-            "score": float(scores[idx]),
+            "score": float(score),
         })
     return results
 
 # ⑦ 使ってみる
-# 例: 材料として「いちご」と「ヨーグルト」がある
-ingredients = "冷蔵庫に低脂肪のヨーグルトといちごがある"
-recommendations = recommend_products_from_ingredients(
-    ingredients_text=ingredients,
-    products=products,
-    product_embeddings=product_embeddings,
-    top_k=3,
-)
-
-for r in recommendations:
-    print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+def main() -> None:
+    product_index = build_product_index(products)
+
+    # 例: 材料として「いちご」と「ヨーグルト」がある
+    ingredients = "冷蔵庫に低脂肪のヨーグルトといちごがある"
+    recommendations = recommend_products_from_ingredients(
+        ingredients_text=ingredients,
+        products=products,
+        product_index=product_index,
+        top_k=3,
+    )
+
+    for r in recommendations:
+        print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+
+
+if __name__ == "__main__":
+    main()
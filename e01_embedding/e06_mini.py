@@ -3,9 +3,14 @@
 # ===================================
 # !pip install -q sentence-transformers
 
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
+from ann_index import DEFAULT_BACKEND, index_factory
+from catalog_filters import CatalogFilters, keyword_mask, predicate_mask
+from encoder_backend import ENCODER_BACKEND, cache_name
+from model_registry import lazy_model
+from product_store import ProductStore
+
 
 # ===================================
 # 商品データ（鍋特化の簡易データ）
@@ -54,27 +59,41 @@ products = [
 # ===================================
 # 埋め込み生成
 # ===================================
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
 
 def product_to_text(p):
     tags_text = " ".join(p.get("tags", []))
     return f"{p['name']}。カテゴリ:{p['category']}。タグ:{tags_text}。説明:{p['description']}"
 
-product_texts = [product_to_text(p) for p in products]
-product_embeddings = model.encode(product_texts, normalize_embeddings=True)
+# 商品を ProductStore に入れる（upsert のたびに version が上がり、フィルターのマスクも作り直される）
+def build_store(products):
+    store = ProductStore(model, cache_name(MODEL_NAME, ENCODER_BACKEND), product_to_text, products)
+
+    # 近傍探索の backend は ann_index.DEFAULT_BACKEND（既定は "exact"。環境変数 ANN_BACKEND で切り替え）
+    if DEFAULT_BACKEND != "exact":
+        store.attach_index(index_factory(DEFAULT_BACKEND))
+    return store
 
 
 # ===================================
-# 鍋関連フィルター
+# 鍋関連フィルター（カタログごとに 1 回だけマスクを作る）
 # ===================================
-def is_hotpot_related(p):
-    hotpot_keywords = [
-        "鍋", "スープ", "白菜", "ねぎ", "ネギ", "長ねぎ",
-        "しめじ", "えのき", "豆腐", "しらたき",
-        "豚", "鶏", "肉", "〆", "雑炊", "中華麺"
-    ]
-    text = p["name"] + " " + p["description"] + " " + " ".join(p.get("tags", []))
-    return any(k in text for k in hotpot_keywords)
+HOTPOT_KEYWORDS = [
+    "鍋", "スープ", "白菜", "ねぎ", "ネギ", "長ねぎ",
+    "しめじ", "えのき", "豆腐", "しらたき",
+    "豚", "鶏", "肉", "〆", "雑炊", "中華麺"
+]
+
+def hotpot_text(p):
+    return p["name"] + " " + p["description"] + " " + " ".join(p.get("tags", []))
+
+filters = CatalogFilters()
+filters.register("hotpot", lambda ps: keyword_mask([p and hotpot_text(p) for p in ps],
+                                                    HOTPOT_KEYWORDS))
+filters.register("in_stock", lambda ps: predicate_mask(ps, lambda p: p.get("in_stock", True)))
 
 
 # ===================================
@@ -83,48 +102,69 @@ def is_hotpot_related(p):
 def suggest_missing_hotpot_items(
     dish_text: str,
     cart_product_ids,
-    products,
-    product_embeddings,
+    store: ProductStore,
     top_k: int = 5,
+    filter_names=("hotpot",),
 ):
+    """
+    filter_names: 適用するフィルター名（AND）。例: ("hotpot", "in_stock")
+    """
     cart_product_ids = set(cart_product_ids)
 
     # 鍋の説明を embedding
     query_emb = model.encode([dish_text], normalize_embeddings=True)[0]
 
-    # 類似度計算
-    scores = product_embeddings @ query_emb
-
-    candidates = []
-    for idx, p in enumerate(products):
-        if p["id"] in cart_product_ids:
-            continue
-        if not is_hotpot_related(p):
-            continue
-        candidates.append((scores[idx], p))
+    # 前計算したマスクを組み合わせて、フィルター外 + カート内の商品を除外
+    exclude = ~filters.mask(store, filter_names) | store.exclusion_mask(ids=cart_product_ids)
 
-    candidates.sort(key=lambda x: x[0], reverse=True)
+    # 類似度計算 + 上位 top_k 件（削除済みは自動で落ちる）
+    idxs, scores = store.search(query_emb, top_k, exclude=exclude)
 
     return [
-        {"id": p["id"], "name": p["name"], "score": float(score)}
-        for score, p in candidates[:top_k]
+        {"id": store.products[i]["id"], "name": store.products[i]["name"],
+         "score": float(score)}
+        for i, score in zip(idxs, scores)
     ]
 
 
 # ===================================
 # 動作例
 # ===================================
-dish = "今日は家族で寄せ鍋を作りたい。野菜多めでヘルシーにしたい。"
-#dish = "寄せ鍋"
-cart_ids = [30, 1]  # すでに「寄せ鍋スープ」と「白菜」を購入済み
-
-results = suggest_missing_hotpot_items(
-    dish_text=dish,
-    cart_product_ids=cart_ids,
-    products=products,
-    product_embeddings=product_embeddings,
-    top_k=5,
-)
-
-for r in results:
-    print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+def main() -> None:
+    store = build_store(products)
+
+    dish = "今日は家族で寄せ鍋を作りたい。野菜多めでヘルシーにしたい。"
+    #dish = "寄せ鍋"
+    cart_ids = [30, 1]  # すでに「寄せ鍋スープ」と「白菜」を購入済み
+
+    results = suggest_missing_hotpot_items(
+        dish_text=dish,
+        cart_product_ids=cart_ids,
+        store=store,
+        top_k=5,
+    )
+
+    for r in results:
+        print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+
+    # ===================================
+    # 在庫フィルターと組み合わせる例（豚バラ肉・しらたきが品切れ）
+    # ===================================
+    # 文章は変わらないので再 embedding はしない。version が上がるので在庫マスクは次の検索で作り直す
+    store.upsert([dict(store.get(pid), in_stock=False) for pid in (10, 22)])
+
+    print("=== 鍋関連 AND 在庫あり ===")
+    results = suggest_missing_hotpot_items(
+        dish_text=dish,
+        cart_product_ids=cart_ids,
+        store=store,
+        top_k=5,
+        filter_names=("hotpot", "in_stock"),
+    )
+
+    for r in results:
+        print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+
+
+if __name__ == "__main__":
+    main()
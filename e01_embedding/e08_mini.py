@@ -1,7 +1,11 @@
 # !pip install -q sentence-transformers
 
-from sentence_transformers import SentenceTransformer
-import numpy as np
+from ann_index import DEFAULT_BACKEND, index_factory
+from embedding_matrix import matrix_path
+from encoder_backend import ENCODER_BACKEND, cache_name
+from model_registry import lazy_model
+from product_store import ProductStore
+from query_cache import QueryEmbeddingCache
 
 # ================================
 # 商品データ（鍋特化の例示）
@@ -40,14 +44,31 @@ products = [
 # ================================
 # embedding モデル
 # ================================
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
+# よく来るクエリ（料理名・材料の組み合わせ）の embedding を使い回す
+query_cache = QueryEmbeddingCache(model, maxsize=1024, ttl=3600)
 
 def product_to_text(p):
     tags_text = " ".join(p.get("tags", []))
     return f"{p['name']}。カテゴリ:{p['category']}。タグ:{tags_text}。説明:{p['description']}"
 
-product_texts = [product_to_text(p) for p in products]
-product_embeddings = model.encode(product_texts, normalize_embeddings=True)
+# 商品の行列の書き出し先
+PRODUCT_MATRIX_PATH = matrix_path("e08_products")
+
+def build_store(products):
+    # 商品id / 商品名 → 行 の索引を upsert / delete のたびに保つストア
+    store = ProductStore(model, cache_name(MODEL_NAME, ENCODER_BACKEND), product_to_text, products)
+    # float16 で保存して mmap で開く（複数ワーカーでページキャッシュを共有）。
+    # 同じ文章 + モデルで保存済みなら書き込まず、ファイルを開くだけ
+    store.publish(PRODUCT_MATRIX_PATH, dtype="float16")
+
+    # 近傍探索の backend は ann_index.DEFAULT_BACKEND（既定は "exact"。環境変数 ANN_BACKEND で切り替え）
+    if DEFAULT_BACKEND != "exact":
+        store.attach_index(index_factory(DEFAULT_BACKEND))
+    return store
 
 # ================================
 # 抜けている鍋具材の推薦（フィルターなし）
@@ -55,43 +76,41 @@ product_embeddings = model.encode(product_texts, normalize_embeddings=True)
 def suggest_missing_items(
     dish_text: str,
     cart_product_ids,
-    products,
-    product_embeddings,
+    store: ProductStore,
     top_k: int = 5,
 ):
-    cart_product_ids = set(cart_product_ids)
-
-    query_emb = model.encode([dish_text], normalize_embeddings=True)[0]
-    scores = product_embeddings @ query_emb
-
-    # カート以外をスコア順に返す
-    indexed = [
-        (scores[i], products[i])
-        for i in range(len(products))
-        if products[i]["id"] not in cart_product_ids
-    ]
+    query_emb = query_cache.encode(dish_text)
 
-    indexed.sort(key=lambda x: x[0], reverse=True)
+    # カート以外をスコア順に返す（商品id → 行 はストアの索引から引く。削除済みは自動で落ちる）
+    exclude = store.exclusion_mask(ids=set(cart_product_ids))
+    idxs, scores = store.search(query_emb, top_k, exclude=exclude)
 
     return [
-        {"id": p["id"], "name": p["name"], "score": float(score)}
-        for score, p in indexed[:top_k]
+        {"id": store.products[i]["id"], "name": store.products[i]["name"],
+         "score": float(score)}
+        for i, score in zip(idxs, scores)
     ]
 
 
 # ================================
 # テスト例
 # ================================
-dish = "今日は家族で寄せ鍋を作りたい。野菜多めでヘルシーにしたい。"
-cart_ids = [30, 1]  # 寄せ鍋スープ & 白菜はカートに入ってる
-
-results = suggest_missing_items(
-    dish_text=dish,
-    cart_product_ids=cart_ids,
-    products=products,
-    product_embeddings=product_embeddings,
-    top_k=5,
-)
-
-for r in results:
-    print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+def main() -> None:
+    store = build_store(products)
+
+    dish = "今日は家族で寄せ鍋を作りたい。野菜多めでヘルシーにしたい。"
+    cart_ids = [30, 1]  # 寄せ鍋スープ & 白菜はカートに入ってる
+
+    results = suggest_missing_items(
+        dish_text=dish,
+        cart_product_ids=cart_ids,
+        store=store,
+        top_k=5,
+    )
+
+    for r in results:
+        print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+
+
+if __name__ == "__main__":
+    main()
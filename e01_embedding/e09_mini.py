@@ -3,9 +3,19 @@
 # ================================
 # !pip install -q sentence-transformers
 
-from sentence_transformers import SentenceTransformer
+import asyncio
+import functools
+
 import numpy as np
 
+from ann_index import DEFAULT_BACKEND, build_index
+from embedding_cache import texts_fingerprint
+from embedding_matrix import matrix_path, open_matrix
+from encode_service import BatchingEncoder
+from encoder_backend import ENCODER_BACKEND, cache_name
+from model_registry import lazy_model
+from query_cache import QueryEmbeddingCache, join_ingredients
+
 
 # ================================
 # レシピデータ（料理名 + 材料[]）
@@ -37,15 +47,34 @@ recipes = [
 # ================================
 # embedding モデル
 # ================================
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
+# よく来るクエリ（料理名・材料の組み合わせ）の embedding を使い回す
+query_cache = QueryEmbeddingCache(model, maxsize=1024, ttl=3600)
 
 def recipe_to_text(recipe):
     ing = "、".join(recipe["ingredients"])
     return f"{recipe['name']}。材料: {ing}"
 
-# 全レシピをテキスト化 & embedding
-recipe_texts = [recipe_to_text(r) for r in recipes]
-recipe_embeddings = model.encode(recipe_texts, normalize_embeddings=True)
+# レシピの行列の書き出し先
+RECIPE_MATRIX_PATH = matrix_path("e09_recipes")
+
+@functools.lru_cache(maxsize=None)
+def get_recipe_index():
+    """初めて呼ばれたときに embedding を開いて（無ければ encode して）index を作る"""
+    # 全レシピをテキスト化 & embedding
+    recipe_texts = [recipe_to_text(r) for r in recipes]
+    # float16 で保存して mmap で開く（複数ワーカーでページキャッシュを共有）。
+    # 同じ文章 + モデルで保存済みなら encode も書き込みもせず、ファイルを開くだけ
+    recipe_embeddings = open_matrix(
+        RECIPE_MATRIX_PATH, lambda: model.encode(recipe_texts, normalize_embeddings=True),
+        dtype="float16",
+        key=texts_fingerprint(recipe_texts, cache_name(MODEL_NAME, ENCODER_BACKEND)))
+
+    # 近傍探索の backend は ann_index.DEFAULT_BACKEND（既定は "exact"。環境変数 ANN_BACKEND で切り替え）
+    return build_index(DEFAULT_BACKEND, recipe_embeddings)
 
 
 # ================================
@@ -55,13 +84,12 @@ def recommend_recipes_from_ingredients(ingredients_list, top_k=5):
     """
     ユーザーが持っている材料から作れそうな料理を推薦
     """
-    query_text = " ".join(ingredients_list)
-    query_emb = model.encode([query_text], normalize_embeddings=True)[0]
+    query_text = join_ingredients(ingredients_list, sep=" ")
+    query_emb = query_cache.encode(query_text)
 
-    scores = recipe_embeddings @ query_emb
-    idxs = np.argsort(scores)[::-1][:top_k]
+    idxs, scores = get_recipe_index().search(query_emb, top_k)
 
-    return [(recipes[i]["name"], float(scores[i])) for i in idxs]
+    return [(recipes[i]["name"], float(s)) for i, s in zip(idxs, scores)]
 
 
 # ================================
@@ -73,11 +101,11 @@ def recommend_missing_ingredients(dish_name, user_ingredients, top_k=5):
     ユーザーが持っていない材料を推薦
     """
     # 入力料理名を embedding 化
-    dish_emb = model.encode([dish_name], normalize_embeddings=True)[0]
+    dish_emb = query_cache.encode(dish_name)
 
     # 一番近いレシピを探す
-    scores = recipe_embeddings @ dish_emb
-    best_idx = int(np.argmax(scores))
+    idxs, _ = get_recipe_index().search(dish_emb, 1)
+    best_idx = int(idxs[0])
     best_recipe = recipes[best_idx]
 
     # 足りない材料
@@ -93,23 +121,54 @@ def recommend_missing_ingredients(dish_name, user_ingredients, top_k=5):
 # ③ 料理名 → 似てる料理の推薦
 # ================================
 def recommend_similar_recipes(dish_name, top_k=5):
-    dish_emb = model.encode([dish_name], normalize_embeddings=True)[0]
-    scores = recipe_embeddings @ dish_emb
-    idxs = np.argsort(scores)[::-1][:top_k]
+    dish_emb = query_cache.encode(dish_name)
+    idxs, scores = get_recipe_index().search(dish_emb, top_k)
+
+    return [(recipes[i]["name"], float(s)) for i, s in zip(idxs, scores)]
+
+
+# ================================
+# ④ asyncio のサーバから: 同時に来たクエリを 1 回の encode にまとめる
+# ================================
+async def recommend_similar_recipes_async(dish_name, encoder, top_k=5):
+    # キャッシュに無いクエリだけ encoder（BatchingEncoder）に回る
+    dish_emb = await query_cache.aencode(dish_name, encoder)
+    idxs, scores = get_recipe_index().search(dish_emb, top_k)
+
+    return [(recipes[i]["name"], float(s)) for i, s in zip(idxs, scores)]
+
 
-    return [(recipes[i]["name"], float(scores[i])) for i in idxs]
+async def serve_similar_recipes(dish_names, top_k=3):
+    async with BatchingEncoder(model, max_batch_size=64, max_wait_ms=5.0) as encoder:
+        results = await asyncio.gather(
+            *(recommend_similar_recipes_async(d, encoder, top_k) for d in dish_names))
+    return results, encoder.stats()
 
 
 
 # ================================
 # ★ 動作確認 ★
 # ================================
+def main() -> None:
+    print("=== 材料 → 作れる料理 ===")
+    print(recommend_recipes_from_ingredients(["白菜", "豆腐", "鶏肉"], top_k=3))
+
+    print("\n=== 料理名 → 足りない材料 ===")
+    print(recommend_missing_ingredients("寄せ鍋", ["白菜", "豚肉"], top_k=5))
+
+    print("\n=== 料理名 → 似ている料理 ===")
+    print(recommend_similar_recipes("寄せ鍋", top_k=3))
+
+    print("\n=== 同時に来たクエリ → 似ている料理（まとめて encode） ===")
+    dish_names = ["キムチ鍋", "水炊き", "豚汁", "寄せ鍋"]
+    results, encoder_stats = asyncio.run(serve_similar_recipes(dish_names, top_k=2))
+    for dish_name, result in zip(dish_names, results):
+        print(dish_name, "→", result)
+    print("encode batches:", encoder_stats["batch_size_hist"])
 
-print("=== 材料 → 作れる料理 ===")
-print(recommend_recipes_from_ingredients(["白菜", "豆腐", "鶏肉"], top_k=3))
+    print("\n=== クエリ embedding キャッシュ ===")
+    print(query_cache.stats())
 
-print("\n=== 料理名 → 足りない材料 ===")
-print(recommend_missing_ingredients("寄せ鍋", ["白菜", "豚肉"], top_k=5))
 
-print("\n=== 料理名 → 似ている料理 ===")
-print(recommend_similar_recipes("寄せ鍋", top_k=3))
+if __name__ == "__main__":
+    main()
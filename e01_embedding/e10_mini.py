@@ -3,9 +3,19 @@
 # =========================================
 # !pip install -q sentence-transformers
 
-from sentence_transformers import SentenceTransformer
+import functools
+
 import numpy as np
 
+from ann_index import DEFAULT_BACKEND, index_factory
+from catalog import product_to_text
+from embedding_matrix import matrix_path
+from encoder_backend import ENCODER_BACKEND, cache_name
+from model_registry import lazy_model
+from neighbor_table import NeighborTable
+from product_store import ProductStore
+from topk import top_k_rows
+
 
 # =========================================
 # 商品データ（完全版）
@@ -57,15 +67,40 @@ products = [
 # =========================================
 # embedding モデル
 # =========================================
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
+
+# 商品の行列 / 近傍テーブルの書き出し先
+PRODUCT_MATRIX_PATH = matrix_path("e10_products")
+NEIGHBOR_TABLE_PATH = matrix_path("e10_neighbors.npz")
 
-def product_to_text(p):
-    tags_text = " ".join(p.get("tags", []))
-    return f"{p['name']}。カテゴリ: {p['category']}。タグ: {tags_text}。説明: {p['description']}"
+@functools.lru_cache(maxsize=None)
+def get_store():
+    """初めて呼ばれたときにストアを作る（以降は同じストアを upsert / delete で更新する）"""
+    # 商品テキスト（catalog.product_to_text）→ 埋め込み（upsert / delete で差分だけ更新できるストア）
+    store = ProductStore(model, cache_name(MODEL_NAME, ENCODER_BACKEND), product_to_text, products)
+    # float16 で mmap 形式に書き出して、スコア計算はそちらを使う
+    store.publish(PRODUCT_MATRIX_PATH, dtype="float16")
 
-# 商品テキスト → 埋め込み
-product_texts = [product_to_text(p) for p in products]
-product_embeddings = model.encode(product_texts, normalize_embeddings=True)
+    # 近傍探索の backend は ann_index.DEFAULT_BACKEND（既定は "exact"。環境変数 ANN_BACKEND で切り替え）
+    # exact 以外なら index を attach して、upsert / delete のたびに一緒に更新する
+    if DEFAULT_BACKEND != "exact":
+        store.attach_index(index_factory(DEFAULT_BACKEND))
+    return store
+
+@functools.lru_cache(maxsize=None)
+def get_neighbor_table():
+    """商品 → 商品 の近傍 top-N を事前計算（カタログ内の商品はここを引くだけ）"""
+    store = get_store()
+    # 同じカタログで保存済みなら（再起動 / 他のプロセスが計算済み）読むだけ
+    neighbor_table = NeighborTable.load(NEIGHBOR_TABLE_PATH, store)
+    if neighbor_table is None:
+        neighbor_table = NeighborTable(n_neighbors=20)
+        neighbor_table.sync(store)
+        neighbor_table.save(NEIGHBOR_TABLE_PATH, store)
+    return neighbor_table
 
 
 # =========================================
@@ -75,35 +110,40 @@ def recommend_related_products(product_name, top_k=5):
     """
     商品名に意味的に近い商品を推薦する（＝この商品も買いませんか？）
     """
+    store, neighbor_table = get_store(), get_neighbor_table()
 
-    # 入力商品の embedding
-    query_emb = model.encode([product_name], normalize_embeddings=True)[0]
+    # カタログ内の商品なら事前計算した近傍テーブルを引くだけ
+    rows = store.rows_for(names=[product_name])
+    if (len(rows) and neighbor_table.version == store.version
+            and top_k <= neighbor_table.n_neighbors):
+        nbrs, nbr_scores = neighbor_table.lookup(rows[0])
+        results = []
+        for idx, score in zip(nbrs, nbr_scores):
+            p = store.products[idx]
+            if p["name"] == product_name:
+                continue  # 同名の商品も除外
+            results.append({"id": p["id"], "name": p["name"], "score": float(score)})
+            if len(results) >= top_k:
+                break
+        return results
 
-    # 類似度
-    scores = product_embeddings @ query_emb
+    # カタログに無い商品名は embedding して全件スコア計算
+    query_emb = model.encode([product_name], normalize_embeddings=True)[0]
 
-    # 自分自身の商品 index を特定
-    self_idx = None
-    for i, p in enumerate(products):
-        if p["name"] == product_name:
-            self_idx = i
-            break
+    # 自分自身の商品を除外（商品名 → 行 の index から引く）
+    exclude = store.exclusion_mask(names=[product_name])
 
-    # スコア順に top_k 取得
-    idxs = np.argsort(scores)[::-1]
+    # 類似度の高い順に top_k 取得（自分を除外 / 削除済みは落ちる）
+    idxs, scores = store.search(query_emb, top_k, exclude=exclude)
 
     results = []
-    for idx in idxs:
-        if idx == self_idx:
-            continue  # 自分を除外
-        p = products[idx]
+    for idx, score in zip(idxs, scores):
+        p = store.products[idx]
         results.append({
             "id": p["id"],
             "name": p["name"],
-            "score": float(scores[idx])
+            "score": float(score)
         })
-        if len(results) >= top_k:
-            break
 
     return results
 
@@ -114,51 +154,115 @@ def recommend_related_products_multi(product_names, top_k=5):
     """
     product_names: ["豚バラ肉 200g", "しらたき 200g"] のようなリスト
     """
-    # --- 入力商品それぞれを embedding ---
-    query_embs = []
-    for name in product_names:
-        emb = model.encode([name], normalize_embeddings=True)[0]
-        query_embs.append(emb)
+    # カート 1 つ分のバッチとして計算する
+    return recommend_related_products_batch([product_names], top_k=top_k)[0]
 
-    # --- 平均を取る（複数商品の意味の“中心”を取る）---
-    query_emb = np.mean(query_embs, axis=0)
+# =========================================
+# 複数のカートをまとめて関連商品推薦（バッチ）
+# =========================================
+def recommend_related_products_batch(carts, top_k=5, block_size=1024):
+    """
+    carts: [["豚バラ肉 200g", "しらたき 200g"], ["白菜 1/4カット"], ...] のようなリスト
+    全カートに出てくる商品名を 1 回の encode でまとめて embedding し、
+    (カート数 × 商品数) の行列積でスコアを出す。
+    戻り値: カートごとの結果リスト（carts と同じ順番）
+    """
+    store = get_store()
+    results = [[] for _ in carts]
+    lengths = np.array([len(cart) for cart in carts], dtype=np.intp)
+    active = np.flatnonzero(lengths > 0)
+    if len(active) == 0:
+        return results
 
-    # --- 類似度 ---
-    scores = product_embeddings @ query_emb
+    # --- 重複を除いた商品名を 1 回の encode で embedding ---
+    names = list(dict.fromkeys(name for cart in carts for name in cart))
+    name_pos = {name: i for i, name in enumerate(names)}
+    name_embs = model.encode(names, normalize_embeddings=True)
 
-    # --- 自分自身(購入済み商品)を除外 ---
-    exclude_idxs = set()
-    for name in product_names:
-        for i, p in enumerate(products):
-            if p["name"] == name:
-                exclude_idxs.add(i)
+    # --- カートごとに平均を取る（複数商品の意味の“中心”を取る）---
+    flat = np.array([name_pos[name] for cart in carts for name in cart], dtype=np.intp)
+    offsets = np.cumsum(lengths[active]) - lengths[active]
+    query_embs = np.add.reduceat(name_embs[flat], offsets, axis=0)
+    query_embs /= lengths[active][:, None]
 
-    # --- スコア順に top_k ---
-    idxs = np.argsort(scores)[::-1]
+    # --- block_size カートずつ (カート × 商品) の行列積 ---
+    for start in range(0, len(active), block_size):
+        block = active[start:start + block_size]
+        scores = store.scores(query_embs[start:start + block_size])
 
-    results = []
-    for idx in idxs:
-        if idx in exclude_idxs:
-            continue  # 自分自身を除外
-        p = products[idx]
-        results.append({
-            "id": p["id"],
-            "name": p["name"],
-            "score": float(scores[idx])
-        })
-        if len(results) >= top_k:
-            break
+        # --- 自分自身(購入済み商品)を除外: 商品名 → 行 の index から scatter ---
+        rows, cols = [], []
+        for r, c in enumerate(block):
+            cart_rows = store.rows_for(names=carts[c])
+            rows.append(np.full(len(cart_rows), r, dtype=np.intp))
+            cols.append(cart_rows)
+        scores[np.concatenate(rows), np.concatenate(cols)] = -np.inf
+
+        top = top_k_rows(scores, top_k)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        for r, c in enumerate(block):
+            results[c] = [
+                {
+                    "id": store.products[idx]["id"],
+                    "name": store.products[idx]["name"],
+                    "score": float(score),
+                }
+                for idx, score in zip(top[r], top_scores[r])
+                if score > -np.inf
+            ]
 
     return results
 
 # =========================================
 # ★ 動作確認 ★
 # =========================================
-print("=== 豚バラ肉 200g を買うなら、この商品もどうですか？ ===")
-for r in recommend_related_products("豚バラ肉 200g", top_k=5):
-    print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+def main() -> None:
+    store = get_store()
+
+    print("=== 豚バラ肉 200g を買うなら、この商品もどうですか？ ===")
+    for r in recommend_related_products("豚バラ肉 200g", top_k=5):
+        print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+
+
+    print("=== 豚バラ肉 + しらたき を買うなら、この商品もどうですか？ ===")
+    for r in recommend_related_products_multi(["豚バラ肉 200g", "しらたき 200g"], top_k=5):
+        print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+
+
+    print("=== カートをまとめて推薦（バッチ） ===")
+    carts = [
+        ["豚バラ肉 200g", "しらたき 200g"],
+        ["白菜 1/4カット"],
+        ["鶏もも肉 300g", "木綿豆腐 1丁", "長ねぎ 2本"],
+    ]
+    for cart, recs in zip(carts, recommend_related_products_batch(carts, top_k=3)):
+        print(cart, "→", [r["name"] for r in recs])
+
+    # =========================================
+    # ★ 商品の更新 / 削除（差分だけ再 embedding） ★
+    # =========================================
+    print("=== 商品の更新 ===")
+    # 価格だけの変更 → 文章が変わらないので encode されない
+    touched = store.upsert([dict(products[4], price=398)])
+    print("価格変更で再 embedding した行:", touched)
+    # 説明文の変更 + 新商品 → その 2 行だけ encode
+    touched = store.upsert([
+        dict(products[4], description="しゃぶしゃぶや寄せ鍋に合う薄切り豚バラ肉。"),
+        {"id": 42, "name": "ポン酢 360ml", "category": "調味料", "tags": ["鍋", "つけだれ"],
+         "description": "水炊きやしゃぶしゃぶに合う柑橘ポン酢。"},
+    ])
+    print("説明変更 + 新商品で再 embedding した行:", touched)
+    # 削除 → tombstone
+    store.delete([22])
+    store.publish(PRODUCT_MATRIX_PATH, dtype="float16")  # 更新後の行列を書き出し直す
+    neighbor_table = get_neighbor_table()
+    neighbor_table.sync(store)  # 変わった行に関係する近傍だけ作り直す
+    neighbor_table.save(NEIGHBOR_TABLE_PATH, store)
+
+    print("=== 更新後: 豚バラ肉 200g を買うなら、この商品もどうですか？ ===")
+    for r in recommend_related_products("豚バラ肉 200g", top_k=5):
+        print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
 
 
-print("=== 豚バラ肉 + しらたき を買うなら、この商品もどうですか？ ===")
-for r in recommend_related_products_multi(["豚バラ肉 200g", "しらたき 200g"], top_k=5):
-    print(f"{r['score']:.3f}  {r['name']} (id={r['id']})")
+if __name__ == "__main__":
+    main()
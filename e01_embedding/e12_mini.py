@@ -3,9 +3,17 @@
 # =====================================
 # !pip install -q sentence-transformers
 
-from sentence_transformers import SentenceTransformer
+import functools
+
 import numpy as np
 
+from ann_index import DEFAULT_BACKEND, build_index
+from embedding_cache import texts_fingerprint
+from embedding_matrix import matrix_path, open_matrix
+from encoder_backend import ENCODER_BACKEND, cache_name
+from model_registry import lazy_model
+from query_cache import QueryEmbeddingCache, join_ingredients
+
 # =====================================
 # ① レシピデータ（レシピサイトから取ってきた想定）
 #    {name: 料理名, elems: [材料]
@@ -36,7 +44,12 @@ recipes = [
 # =====================================
 # ② SentenceTransformer モデル読み込み
 # =====================================
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
+# よく来るクエリ（料理名・材料の組み合わせ）の embedding を使い回す
+query_cache = QueryEmbeddingCache(model, maxsize=1024, ttl=3600)
 
 # =====================================
 # ③ {name, elems[]} → 1本の文章にする関数
@@ -49,11 +62,25 @@ def recipe_to_text(recipe):
     ing = "、".join(recipe["elems"])
     return f"{recipe['name']}。材料: {ing}"
 
-# レシピごとにテキスト化
-recipe_texts = [recipe_to_text(r) for r in recipes]
+# レシピの行列の書き出し先
+RECIPE_MATRIX_PATH = matrix_path("e12_recipes")
+
+@functools.lru_cache(maxsize=None)
+def get_recipe_index():
+    """初めて呼ばれたときに embedding を開いて（無ければ encode して）index を作る"""
+    # レシピごとにテキスト化
+    recipe_texts = [recipe_to_text(r) for r in recipes]
+
+    # embedding 生成（ここでベクトル空間に入る）
+    # float16 で保存して mmap で開く（複数ワーカーでページキャッシュを共有）。
+    # 同じ文章 + モデルで保存済みなら encode も書き込みもせず、ファイルを開くだけ
+    recipe_embeddings = open_matrix(
+        RECIPE_MATRIX_PATH, lambda: model.encode(recipe_texts, normalize_embeddings=True),
+        dtype="float16",
+        key=texts_fingerprint(recipe_texts, cache_name(MODEL_NAME, ENCODER_BACKEND)))
 
-# embedding 生成（ここでベクトル空間に入る）
-recipe_embeddings = model.encode(recipe_texts, normalize_embeddings=True)
+    # 近傍探索の backend は ann_index.DEFAULT_BACKEND（既定は "exact"。環境変数 ANN_BACKEND で切り替え）
+    return build_index(DEFAULT_BACKEND, recipe_embeddings)
 
 # =====================================
 # ④ 手持ちの材料 → 作れそうな料理をレコメンド
@@ -64,22 +91,19 @@ def recommend_recipes_from_ingredients(ingredients_list, top_k=5):
     を渡すと、作れそうな料理をスコア順に返す
     """
     # 材料リスト → 1本のテキスト
-    query_text = "、".join(ingredients_list)
+    query_text = join_ingredients(ingredients_list)
     # テキスト → embedding
-    query_emb = model.encode([query_text], normalize_embeddings=True)[0]
+    query_emb = query_cache.encode(query_text)
 
-    # コサイン類似度相当（正規化してるので内積でOK）
-    scores = recipe_embeddings @ query_emb
-
-    # スコア順に top_k 件
-    idxs = np.argsort(scores)[::-1][:top_k]
+    # コサイン類似度相当（正規化してるので内積でOK）のスコア順に top_k 件
+    idxs, scores = get_recipe_index().search(query_emb, top_k)
 
     results = []
-    for i in idxs:
+    for i, score in zip(idxs, scores):
         results.append(
             {
                 "name": recipes[i]["name"],
-                "score": float(scores[i]),
+                "score": float(score),
                 "ingredients": recipes[i]["elems"],
             }
         )
@@ -122,12 +146,17 @@ def recommend_extra_ingredients(ingredients_list, top_k_recipes=3, top_k_ingredi
 # =====================================
 # ⑥ 動作確認
 # =====================================
-my_ingredients = ["白菜", "豆腐", "鶏肉"]  # 手持ちの材料
+def main() -> None:
+    my_ingredients = ["白菜", "豆腐", "鶏肉"]  # 手持ちの材料
+
+    print("=== 手持ちの材料:", my_ingredients, "→ 作れそうな料理 ===")
+    for r in recommend_recipes_from_ingredients(my_ingredients, top_k=3):
+        print(f"{r['score']:.3f}  {r['name']}  材料: {r['ingredients']}")
+
+    print("\n=== これも買えば？（足りてなさそうな材料） ===")
+    for e in recommend_extra_ingredients(my_ingredients, top_k_recipes=3, top_k_ingredients=5):
+        print(f"{e['score']:.3f}  {e['name']}")
 
-print("=== 手持ちの材料:", my_ingredients, "→ 作れそうな料理 ===")
-for r in recommend_recipes_from_ingredients(my_ingredients, top_k=3):
-    print(f"{r['score']:.3f}  {r['name']}  材料: {r['ingredients']}")
 
-print("\n=== これも買えば？（足りてなさそうな材料） ===")
-for e in recommend_extra_ingredients(my_ingredients, top_k_recipes=3, top_k_ingredients=5):
-    print(f"{e['score']:.3f}  {e['name']}")
+if __name__ == "__main__":
+    main()
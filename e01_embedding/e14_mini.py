@@ -3,9 +3,18 @@
 # =====================================
 # !pip install -q sentence-transformers
 
-from sentence_transformers import SentenceTransformer
+import functools
+
 import numpy as np
 
+from ann_index import DEFAULT_BACKEND
+from embedding_cache import texts_fingerprint
+from embedding_matrix import matrix_path, open_matrix
+from encoder_backend import ENCODER_BACKEND, cache_name
+from filtered_index import build_partitioned_index
+from model_registry import lazy_model
+from query_cache import QueryEmbeddingCache, join_ingredients
+
 # =====================================
 # ① レシピデータ
 #    {name: 料理名, genre: ジャンル, elems: [材料]}
@@ -56,7 +65,12 @@ recipes = [
 # =====================================
 # ② SentenceTransformer モデル読み込み
 # =====================================
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# backend は encoder_backend.ENCODER_BACKEND（既定は "torch"。環境変数 ENCODER_BACKEND で切り替え）
+# 読み込みは最初に encode するとき（model_registry で 1 プロセス 1 つを共有）
+model = lazy_model(MODEL_NAME, backend=ENCODER_BACKEND)
+# よく来るクエリ（料理名・材料の組み合わせ）の embedding を使い回す
+query_cache = QueryEmbeddingCache(model, maxsize=1024, ttl=3600)
 
 # =====================================
 # ③ {name, genre, elems[]} → 1本の文章にする関数
@@ -69,11 +83,29 @@ def recipe_to_text(recipe):
     ing = "、".join(recipe["elems"])
     return f"{recipe['name']}。ジャンル: {recipe['genre']}。材料: {ing}"
 
-# レシピごとにテキスト化
-recipe_texts = [recipe_to_text(r) for r in recipes]
-
-# embedding 生成（ここでベクトル空間に入る）
-recipe_embeddings = model.encode(recipe_texts, normalize_embeddings=True)
+# レシピの行列の書き出し先
+RECIPE_MATRIX_PATH = matrix_path("e14_recipes")
+
+@functools.lru_cache(maxsize=None)
+def get_recipe_index():
+    """初めて呼ばれたときに embedding を開いて（無ければ encode して）index を作る"""
+    # レシピごとにテキスト化
+    recipe_texts = [recipe_to_text(r) for r in recipes]
+
+    # embedding 生成（ここでベクトル空間に入る）
+    # float16 で保存して mmap で開く（複数ワーカーでページキャッシュを共有）。
+    # 同じ文章 + モデルで保存済みなら encode も書き込みもせず、ファイルを開くだけ
+    recipe_embeddings = open_matrix(
+        RECIPE_MATRIX_PATH, lambda: model.encode(recipe_texts, normalize_embeddings=True),
+        dtype="float16",
+        key=texts_fingerprint(recipe_texts, cache_name(MODEL_NAME, ENCODER_BACKEND)))
+
+    # 近傍探索の backend は ann_index.DEFAULT_BACKEND（既定は "exact"。環境変数 ANN_BACKEND で切り替え）
+    # 全体の index + ジャンルごとの行番号リスト。ジャンル指定の検索は計算する内積の数を見積もって
+    #   そのジャンルの行だけ内積 / 全体 + 除外マスク
+    # の少ない方で引く
+    return build_partitioned_index(DEFAULT_BACKEND, recipe_embeddings,
+                                   [r["genre"] for r in recipes])
 
 # =====================================
 # ④ 手持ちの材料 → 作れそうな料理をレコメンド
@@ -87,32 +119,25 @@ def recommend_recipes_from_ingredients(ingredients_list, preferred_genres=None,
     preferred_genres: ["和風"], ["和風","中華"], None など
     """
     # 材料リスト → 1本のテキスト
-    query_text = "、".join(ingredients_list)
+    query_text = join_ingredients(ingredients_list)
     # テキスト → embedding
-    query_emb = model.encode([query_text], normalize_embeddings=True)[0]
-
-    # コサイン類似度相当（正規化してるので内積でOK）
-    scores = recipe_embeddings @ query_emb
+    query_emb = query_cache.encode(query_text)
 
-    # スコア順にソート
-    idxs_all = np.argsort(scores)[::-1]
+    # コサイン類似度相当（正規化してるので内積でOK）のスコア順に top_k 件
+    # （ジャンル指定があれば、そのジャンルのレシピだけから取る）
+    idxs, scores = get_recipe_index().search(query_emb, top_k, labels=preferred_genres)
 
     results = []
-    for i in idxs_all:
+    for i, score in zip(idxs, scores):
         r = recipes[i]
-        # ジャンル指定があればフィルタ
-        if preferred_genres is not None and r["genre"] not in preferred_genres:
-            continue
         results.append(
             {
                 "name": r["name"],
                 "genre": r["genre"],
-                "score": float(scores[i]),
+                "score": float(score),
                 "ingredients": r["elems"],
             }
         )
-        if len(results) >= top_k:
-            break
     return results
 
 # =====================================
@@ -156,22 +181,27 @@ def recommend_extra_ingredients(ingredients_list,
 # =====================================
 # ⑥ 動作確認
 # =====================================
-# 手持ちの材料
-my_ingredients = ["白菜", "豆腐", "鶏肉"]
-
-print("=== 手持ちの材料:", my_ingredients, "→ 作れそうな料理（ジャンル指定なし） ===")
-for r in recommend_recipes_from_ingredients(my_ingredients, preferred_genres=None,
-                                            top_k=5):
-    print(f"{r['score']:.3f}  [{r['genre']}] {r['name']}  材料: {r['ingredients']}")
-
-print("\n=== 手持ちの材料:", my_ingredients, "→ 作れそうな料理（和風だけ） ===")
-for r in recommend_recipes_from_ingredients(my_ingredients, preferred_genres=["和風"],
-                                            top_k=5):
-    print(f"{r['score']:.3f}  [{r['genre']}] {r['name']}  材料: {r['ingredients']}")
-
-print("\n=== これも買えば？（和風料理を前提に不足材料を提案） ===")
-for e in recommend_extra_ingredients(my_ingredients,
-                                     preferred_genres=["和風"],
-                                     top_k_recipes=3,
-                                     top_k_ingredients=5):
-    print(f"{e['score']:.3f}  {e['name']}")
+def main() -> None:
+    # 手持ちの材料
+    my_ingredients = ["白菜", "豆腐", "鶏肉"]
+
+    print("=== 手持ちの材料:", my_ingredients, "→ 作れそうな料理（ジャンル指定なし） ===")
+    for r in recommend_recipes_from_ingredients(my_ingredients, preferred_genres=None,
+                                                top_k=5):
+        print(f"{r['score']:.3f}  [{r['genre']}] {r['name']}  材料: {r['ingredients']}")
+
+    print("\n=== 手持ちの材料:", my_ingredients, "→ 作れそうな料理（和風だけ） ===")
+    for r in recommend_recipes_from_ingredients(my_ingredients, preferred_genres=["和風"],
+                                                top_k=5):
+        print(f"{r['score']:.3f}  [{r['genre']}] {r['name']}  材料: {r['ingredients']}")
+
+    print("\n=== これも買えば？（和風料理を前提に不足材料を提案） ===")
+    for e in recommend_extra_ingredients(my_ingredients,
+                                         preferred_genres=["和風"],
+                                         top_k_recipes=3,
+                                         top_k_ingredients=5):
+        print(f"{e['score']:.3f}  {e['name']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# =====================================
+# 商品テキスト embedding のディスクキャッシュ
+# =====================================
+# product_to_text(p) の結果 + モデル名 + 正規化フラグ をハッシュしてキーにする。
+# 変更のない商品はファイルから読み込み、新規/変更された文章だけ model.encode に回す。
+# 件数は max_entries までで、超えたら一番長く使われていないものから捨てる（LRU）。
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  ".cache", "embeddings.npz")
+DEFAULT_MAX_ENTRIES = 200_000
+
+
+def text_key(text, model_name, normalize_embeddings):
+    """文章 + モデル名 + 正規化フラグ → キャッシュキー(sha1 hex)"""
+    raw = f"{model_name}\0{int(bool(normalize_embeddings))}\0{text}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def texts_fingerprint(texts, model_name=""):
+    """文章の並び全体（+ モデル名）の sha1 hex。保存した行列が今のカタログのものかの確認用"""
+    h = hashlib.sha1(f"{model_name}\0".encode("utf-8"))
+    for t in texts:
+        h.update(t.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    キー → ベクトル を 1 つの .npz (keys, vectors) に保存するキャッシュ
+    （vectors は古い順。保存のときもこの順に書くので、次に読んだときも LRU の順番が残る）
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.vectors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        if path and os.path.exists(path):
+            data = np.load(path)
+            for k, v in zip(data["keys"], data["vectors"]):
+                self.vectors[str(k)] = v
+            self._evict()
+
+    def __contains__(self, key):
+        return key in self.vectors
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def get(self, key):
+        """キーのベクトル（無ければ None）。使ったものは LRU の末尾に回す"""
+        vector = self.vectors.get(key)
+        if vector is not None:
+            self.vectors.move_to_end(key)
+        return vector
+
+    def put(self, key, vector):
+        self.vectors[key] = np.asarray(vector, dtype=np.float32)
+        self.vectors.move_to_end(key)
+        self._dirty = True
+        self._evict()
+
+    def _evict(self):
+        while self.max_entries is not None and len(self.vectors) > self.max_entries:
+            self.vectors.popitem(last=False)
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty or not self.path:  # path=None はメモリだけのキャッシュ
+            return
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        keys = np.array(list(self.vectors.keys()))
+        vecs = np.stack(list(self.vectors.values())).astype(np.float32)
+        # 途中で落ちても壊れないように一時ファイル → rename
+        # （一時ファイルは書き手ごとに別の名前。同時に保存しても互いの途中のファイルを壊さない）
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp.npz",
+                                         delete=False) as f:
+            tmp_path = f.name
+            np.savez(f, keys=keys, vectors=vecs)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def encode_with_cache(model, texts, model_name, normalize_embeddings=True,
+                      cache_path=DEFAULT_CACHE_PATH, batch_size=32,
+                      verbose=True, cache=None, save=True):
+    """
+    model.encode(texts, normalize_embeddings=...) と同じ結果を返す。
+    キャッシュに無い文章だけ encode し、結果はキャッシュに書き戻す。
+    cache: 使い回す EmbeddingCache（省略時は cache_path から読む）
+    save=False ならファイルには書かない（呼び出し側があとで cache.save() する）
+    """
+    if cache is None:
+        cache = EmbeddingCache(cache_path)
+    keys = [text_key(t, model_name, normalize_embeddings) for t in texts]
+
+    # 同じ文章が複数回出てきても encode は 1 回だけ
+    found, missing = {}, {}
+    for k, t in zip(keys, texts):
+        vector = found.get(k)
+        if vector is None:
+            vector = cache.get(k)
+        if vector is not None:
+            found[k] = vector
+            cache.hits += 1
+        else:
+            cache.misses += 1
+            missing.setdefault(k, t)
+
+    if missing:
+        embs = model.encode(list(missing.values()),
+                            batch_size=batch_size,
+                            normalize_embeddings=normalize_embeddings)
+        for k, emb in zip(missing.keys(), embs):
+            cache.put(k, emb)
+            found[k] = np.asarray(emb, dtype=np.float32)
+        if save:
+            cache.save()
+
+    if verbose:
+        print(f"[embedding cache] hit={cache.hits} miss={cache.misses} "
+              f"(encoded={len(missing)}, cached={len(cache)})")
+
+    if not keys:
+        dim = model.get_sentence_embedding_dimension()
+        return np.zeros((0, dim), dtype=np.float32)
+    # max_entries が小さくて追い出されていても、今回の結果は found に残っている
+    return np.stack([found[k] for k in keys])
@@ -0,0 +1,175 @@
+# =====================================
+# 埋め込み行列のディスク保存 + mmap 読み込み
+# =====================================
+# path/ 以下に
+#   meta.json          : フォーマットバージョン, dtype, shape, カタログのバージョン, key, data_dir
+#   <data_dir>/data.npy   : float32 / float16 / int8 の行列
+#   <data_dir>/scales.npy : int8 のときだけ。行ごとのスケール (float32)
+# を置く。np.load(mmap_mode="r") で開くので、複数プロセスでページキャッシュを共有できる。
+# 書くときは毎回新しい data_dir（v<version>-xxxx）に data / scales を全部書いてから meta.json を
+# 差し替えるので、読み手が見るのは常にそろった 1 組になる。
+# open_matrix は meta の version / key が同じなら書かずに開くだけ（作るのは最初の 1 プロセスだけで、
+# 他のプロセスは同じファイルを mmap する）。
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+FORMAT_VERSION = 2
+DTYPES = ("float32", "float16", "int8")
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+_DATA_DIR = re.compile(r"^v\d+-")
+
+
+def matrix_path(name):
+    """.cache/<name> のパス（スクリプトごとの保存先）"""
+    return os.path.join(DEFAULT_DIR, name)
+
+
+def quantize_int8(embeddings):
+    """行ごとに max|x| / 127 でスケールして int8 にする"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.round(embeddings / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def save_matrix(path, embeddings, dtype="float16", version=0, key=None):
+    """
+    embeddings (n, dim) を path/ に保存する。
+    key: 中身を表す文字列（文章の fingerprint など）。open_matrix が一致を確かめるのに使う
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}: {dtype}")
+    os.makedirs(path, exist_ok=True)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    data_dir = tempfile.mkdtemp(prefix=f"v{version}-", dir=path)
+    if dtype == "int8":
+        codes, scales = quantize_int8(embeddings)
+        np.save(os.path.join(data_dir, "data.npy"), codes)
+        np.save(os.path.join(data_dir, "scales.npy"), scales)
+    else:
+        np.save(os.path.join(data_dir, "data.npy"), embeddings.astype(dtype))
+    os.chmod(data_dir, 0o755)
+
+    # meta.json は最後に書く（読み手は meta を見てから data を開く）
+    previous = read_meta(path)
+    write_meta(path, dtype, embeddings.shape, version=version, key=key,
+               data_dir=os.path.basename(data_dir))
+    # 1 つ前の data_dir は、meta を読んだ直後のプロセスが開けるように残す
+    keep = {os.path.basename(data_dir), (previous or {}).get("data_dir")}
+    for name in os.listdir(path):
+        if _DATA_DIR.match(name) and name not in keep:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def write_meta(path, dtype, shape, version=0, key=None, data_dir="."):
+    """path/meta.json を書く（data_dir の中身を書き終えてから呼ぶ）"""
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "dtype": dtype,
+        "shape": list(shape),
+        "version": version,
+        "key": key,
+        "data_dir": data_dir,
+    }
+    with tempfile.NamedTemporaryFile("w", dir=path, suffix=".json.tmp", delete=False) as f:
+        json.dump(meta, f)
+    os.replace(f.name, os.path.join(path, "meta.json"))
+
+
+def read_meta(path):
+    """path/meta.json の中身（無ければ None）"""
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def load_matrix(path):
+    """path/ を mmap で開く（データはコピーしない）"""
+    meta = read_meta(path)
+    if meta is None:
+        raise FileNotFoundError(os.path.join(path, "meta.json"))
+    if meta["format_version"] not in (1, FORMAT_VERSION):
+        raise ValueError(f"unsupported format_version: {meta['format_version']}")
+
+    # format_version 1 は path/ の直下に data.npy がある
+    data_dir = os.path.join(path, meta.get("data_dir", "."))
+    data = np.load(os.path.join(data_dir, "data.npy"), mmap_mode="r")
+    if list(data.shape) != meta["shape"] or data.dtype != np.dtype(meta["dtype"]):
+        raise ValueError(f"{path}: data.npy does not match meta.json")
+
+    scales = None
+    if meta["dtype"] == "int8":
+        scales = np.load(os.path.join(data_dir, "scales.npy"), mmap_mode="r")
+    return MappedMatrix(data, scales, meta, path=path)
+
+
+def open_matrix(path, build, dtype="float16", version=0, key=None, n_rows=None):
+    """
+    path/ の行列が dtype / version / key（と n_rows）の条件に合えば書かずに mmap で開く。
+    合わなければ build() で embeddings を作って保存してから開く（build は必要なときだけ呼ばれる）
+    """
+    meta = read_meta(path)
+    if not (meta is not None and meta["format_version"] in (1, FORMAT_VERSION)
+            and meta["dtype"] == dtype and meta["version"] == version
+            and meta.get("key") == key and (n_rows is None or meta["shape"][0] == n_rows)):
+        save_matrix(path, build(), dtype=dtype, version=version, key=key)
+    return load_matrix(path)
+
+
+class MappedMatrix:
+    """
+    mmap した埋め込み行列。scores() で float32 のスコアを返す。
+    float16 / int8 はブロックごとに float32 に戻して内積を取る（全体のコピーは作らない）
+    """
+
+    def __init__(self, data, scales=None, meta=None, path=None):
+        self.data = data
+        self.scales = scales
+        self.meta = meta or {}
+        self.path = path  # load_matrix で開いたときの保存先（projection.open_projection が使う）
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def version(self):
+        return self.meta.get("version", 0)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def scores(self, query_emb, block_rows=65536):
+        """
+        query_emb: (dim,) または (n_queries, dim)
+        戻り値: (n,) または (n_queries, n) の float32
+        """
+        q = np.asarray(query_emb, dtype=np.float32)
+        if self.data.dtype == np.float32:
+            return np.asarray(self.data @ q.T).T
+
+        n = len(self)
+        out = np.empty((n,) + q.shape[:-1], dtype=np.float32)
+        for start in range(0, n, block_rows):
+            end = min(start + block_rows, n)
+            block = self.data[start:end].astype(np.float32) @ q.T
+            if self.scales is not None:
+                block *= self.scales[start:end].reshape((-1,) + (1,) * (q.ndim - 1))
+            out[start:end] = block
+        return out.T
+
+    def rows(self, idxs):
+        """指定行を float32 で取り出す（再ランキング用）"""
+        block = self.data[idxs].astype(np.float32)
+        if self.scales is not None:
+            block *= self.scales[idxs][..., None]
+        return block
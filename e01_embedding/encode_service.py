@@ -0,0 +1,166 @@
+# =====================================
+# asyncio のマイクロバッチ encode サービス
+# =====================================
+# 各リクエストが model.encode([text]) を 1 件ずつ呼ぶと transformer の CPU が遊ぶので、
+# 同時に来た encode 要求をキューに溜めて
+#   max_batch_size 件たまる or 最初の要求から max_wait_ms 経つ
+# のどちらかで 1 回の model.encode にまとめる。encode はワーカースレッドで実行し、
+# 結果はそれぞれの呼び出し元の Future に返す。
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class BatchingEncoder:
+    def __init__(self, model, max_batch_size=64, max_wait_ms=5.0,
+                 normalize_embeddings=True):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.normalize_embeddings = normalize_embeddings
+        self._queue = None
+        self._worker = None
+        self._executor = None
+        self._inflight = []  # encode 中のバッチ [(text, future), ...]
+
+        # メトリクス
+        self.n_requests = 0
+        self.n_batches = 0
+        self.max_queue_depth = 0
+        self.batch_size_hist = {}  # バッチサイズ → 回数
+
+    # ---------- 起動 / 停止 ----------
+    async def start(self):
+        if self._worker is None:
+            # encode は 1 本のスレッドで順番に実行する（torch 側で並列化される）
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        """ワーカーを止める。キューに残った要求と encode 中のバッチは RuntimeError で終わらせる"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._executor is not None:
+            # encode 中のバッチが終わるのを待つ（イベントループは止めない）
+            await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+            self._executor = None
+        pending = self._inflight
+        self._inflight = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            self._queue = None
+        for _, f in pending:
+            if not f.done():
+                f.set_exception(RuntimeError("service stopped"))
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    # ---------- encode ----------
+    async def encode(self, text):
+        """1 件分の embedding を返す（model.encode([text])[0] 相当）"""
+        if self._worker is None:
+            raise RuntimeError("BatchingEncoder is not running; "
+                               "call start() or use 'async with' first")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        self.n_requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await future
+
+    async def encode_many(self, texts):
+        return np.stack(await asyncio.gather(*(self.encode(t) for t in texts)))
+
+    # ---------- メトリクス ----------
+    @property
+    def queue_depth(self):
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def stats(self):
+        n_items = sum(size * count for size, count in self.batch_size_hist.items())
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "requests": self.n_requests,
+            "batches": self.n_batches,
+            "mean_batch_size": n_items / self.n_batches if self.n_batches else 0.0,
+            "batch_size_hist": dict(sorted(self.batch_size_hist.items())),
+        }
+
+    # ---------- 内部 ----------
+    async def _collect_batch(self):
+        """最初の 1 件を待ってから、締め切りまで / 上限までまとめて取り出す"""
+        loop = asyncio.get_running_loop()
+        # 取り出した要求は stop() で終わらせられるように _inflight に置いておく
+        batch = self._inflight = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # 呼び出し元がキャンセル済みの要求は encode しない
+            batch = [(t, f) for t, f in batch if not f.cancelled()]
+            if not batch:
+                continue
+            texts = [t for t, _ in batch]
+            self._inflight = batch
+            try:
+                embs = await loop.run_in_executor(
+                    self._executor,
+                    lambda: self.model.encode(texts, batch_size=len(texts),
+                                              normalize_embeddings=self.normalize_embeddings))
+            except Exception as e:
+                self._inflight = []
+                for _, f in batch:
+                    if not f.done():
+                        f.set_exception(e)
+                continue
+            self._inflight = []
+
+            self.n_batches += 1
+            self.batch_size_hist[len(batch)] = self.batch_size_hist.get(len(batch), 0) + 1
+            for (_, f), emb in zip(batch, embs):
+                if not f.done():
+                    f.set_result(emb)
+
+
+# =====================================
+# 動作確認: 同時に 200 件の encode 要求を投げる
+# =====================================
+async def main() -> None:
+    from model_registry import load_stats, warm_up
+
+    model = warm_up("sentence-transformers/all-MiniLM-L6-v2")
+    queries = ["寄せ鍋", "キムチ鍋", "水炊き", "白菜、豆腐、鶏肉"] * 50
+
+    async with BatchingEncoder(model, max_batch_size=32, max_wait_ms=5) as encoder:
+        embs = await encoder.encode_many(queries)
+        print("shape =", embs.shape)
+        print(encoder.stats())
+    print(load_stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
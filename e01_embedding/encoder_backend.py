@@ -0,0 +1,85 @@
+# =====================================
+# encode の実行 backend を選ぶ（PyTorch / ONNX Runtime / ONNX Runtime + int8）
+# =====================================
+# CPU だけの環境ではクエリの encode がリクエストの latency の大部分になるので、
+#   "torch"    : 今まで通り PyTorch（eager）
+#   "onnx"     : ONNX にエクスポートして ONNX Runtime で実行
+#   "onnx-int8": さらに重みを動的 int8 量子化したもの
+# を同じ SentenceTransformer の API（model.encode）で使えるようにする。
+# エクスポート / 量子化は初回だけ行い、.cache/onnx/<モデル名>/ に保存して次からはそれを読む。
+# 埋め込みは torch の結果と cos 類似度で比べて MAX_COSINE_DRIFT 以内（1 - cos）を目安にする
+# （encoder_bench.py で確認できる）。
+# スクリプト（e04〜e14）は ENCODER_BACKEND を使う。既定は "torch" で、環境変数で切り替えられる
+#   ENCODER_BACKEND=onnx-int8 python e10_mini.py
+import os
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+ENCODER_BACKEND = os.environ.get("ENCODER_BACKEND", "torch")
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "onnx")
+
+# torch の埋め込みとの差（1 - cos）の許容値
+MAX_COSINE_DRIFT = {"torch": 1e-6, "onnx": 1e-4, "onnx-int8": 2e-2}
+
+
+def onnx_dir(model_name):
+    """.cache/onnx/<モデル名> のパス"""
+    return os.path.join(DEFAULT_DIR, model_name.replace("/", "__"))
+
+
+def cache_name(model_name, backend="torch"):
+    """
+    EmbeddingCache / ProductStore に渡すモデル名。
+    backend ごとに埋め込みが少しずつ違うので、torch 以外はキャッシュを分ける
+    """
+    return model_name if backend == "torch" else f"{model_name}#{backend}"
+
+
+def load_encoder(model_name, backend="torch", quantization="avx2", verbose=True, threads=None):
+    """
+    backend に応じた SentenceTransformer を返す。
+    quantization: "onnx-int8" のときの命令セット（"avx2" / "avx512" / "avx512_vnni" / "arm64"）
+    threads: 1 つの encode が使うスレッド数（torch は set_num_threads、ONNX Runtime は
+             SessionOptions の intra_op_num_threads）。None なら各ライブラリの既定（全コア）
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}: {backend}")
+    if backend == "torch":
+        if threads:
+            import torch
+
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name)
+
+    path = onnx_dir(model_name)
+    status = "loaded"
+    if not os.path.exists(os.path.join(path, "onnx", "model.onnx")):
+        # backend="onnx" で開くと ONNX にエクスポートされるので、それを保存しておく
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(path)
+        status = "exported"
+
+    model_kwargs = {}
+    if threads:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        model_kwargs["session_options"] = options
+    if backend == "onnx":
+        model = SentenceTransformer(path, backend="onnx", model_kwargs=model_kwargs)
+    else:
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+
+        file_name = f"onnx/model_qint8_{quantization}.onnx"
+        if not os.path.exists(os.path.join(path, file_name)):
+            export_dynamic_quantized_onnx_model(
+                SentenceTransformer(path, backend="onnx"), quantization, path)
+            status = f"{status} + quantized"
+        model = SentenceTransformer(path, backend="onnx",
+                                    model_kwargs={"file_name": file_name, **model_kwargs})
+
+    if verbose:
+        print(f"[encoder] {backend} {status} (path={path})")
+    return model
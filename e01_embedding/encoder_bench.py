@@ -0,0 +1,72 @@
+# =====================================
+# encode backend のベンチマーク（torch / onnx / onnx-int8）
+# =====================================
+# backend ごとに
+#   1 クエリずつ encode したときの latency の p50 / p99
+#   バッチで encode したときのスループット（texts/sec）
+#   torch の埋め込みとの差（1 - cos の平均 / 最大）と、MAX_COSINE_DRIFT 以内か
+# を測る。
+#   python encoder_bench.py
+import time
+
+import numpy as np
+
+from encoder_backend import BACKENDS, MAX_COSINE_DRIFT, load_encoder
+from report import print_report
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def sample_texts(n=512, seed=0):
+    """商品名 / クエリっぽい短いテキスト"""
+    rng = np.random.default_rng(seed)
+    words = ["白菜", "長ねぎ", "豆腐", "豚肉", "鶏肉", "しめじ", "キムチ", "味噌", "醤油",
+             "牛乳", "バター", "ヨーグルト", "鍋", "スープ", "パスタ", "トマト", "にんにく"]
+    suffixes = ["1/4カット", "2本", "1パック", "300g", "1L", "の素", "セット", ""]
+    return ["、".join(rng.choice(words, rng.integers(1, 6))) + " " + str(rng.choice(suffixes))
+            for _ in range(n)]
+
+
+def benchmark(model_name, texts, backends=BACKENDS, n_single=100, batch_size=64, repeat=3):
+    models = {backend: load_encoder(model_name, backend) for backend in backends}
+    reference = load_encoder(model_name, "torch") if "torch" not in models else models["torch"]
+    ref = reference.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+
+    results = []
+    for backend, model in models.items():
+        model.encode(texts[:8], batch_size=8)  # ウォームアップ
+
+        latencies = []
+        for text in texts[:n_single]:
+            start = time.perf_counter()
+            model.encode([text])
+            latencies.append(time.perf_counter() - start)
+        latencies_ms = np.array(latencies) * 1000.0
+
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            emb = model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+            best = min(best, time.perf_counter() - start)
+
+        drift = 1.0 - np.einsum("ij,ij->i", ref, emb)
+        results.append({
+            "backend": backend,
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "texts/sec": len(texts) / best,
+            "mean_drift": float(drift.mean()),
+            "max_drift": float(drift.max()),
+            "within_tol": bool(drift.max() <= MAX_COSINE_DRIFT[backend]),
+        })
+    return results
+
+
+def main() -> None:
+    texts = sample_texts()
+    print(f"=== {MODEL_NAME}, texts={len(texts)} ===")
+    print_report(benchmark(MODEL_NAME, texts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# =====================================
+# ジャンル / カテゴリで絞り込む近傍探索
+# =====================================
+# 全件をスコア順に並べてから「ジャンルが違うもの」を捨てると、
+# 珍しいジャンルを指定したときはほとんどの計算が無駄になる。そこで
+#   ラベル（ジャンルなど）ごとの行番号リスト → 指定ラベルの行だけを共有の行列から取り出して内積
+#   全体の index + id の除外マスク         → 全体を引きながら対象外の id を落とす
+#                                            （"hnsw" は hnswlib の filter= でたどりながら飛ばす）
+# の 2 通りを用意し、クエリごとに計算する内積の数を見積もって少ない方を使う。
+#   行番号リスト: 対象の行数 m
+#   全体の index: index.search_cost(k) / 選択率（対象の行が m/n しか無いので、k 件そろうまでに
+#                 その分多くたどる。"exact" は選択率によらず全件 n）
+# "exact" なら常に行番号リスト、"hnsw" なら m が √(search_cost × n) くらいまでは行番号リスト
+# （n = 100 万, ef = 50, M = 16 なら 3 万行弱）、それより広いフィルターは全体の index になる。
+# ラベルごとの index やベクトルのコピーは持たない（行番号の配列だけ）。
+# 行の追加 / 削除には対応しない（カタログが変わったら作り直す）。
+import numpy as np
+
+from ann_index import build_index
+from topk import top_k_indices
+
+
+class PartitionedIndex:
+    def __init__(self, full_index, embeddings, labels, partitions):
+        """
+        full_index : 全行の index（id = 行番号）
+        embeddings : 全行の行列（ndarray / MappedMatrix。full_index と共有してコピーしない）
+        labels     : 行ごとのラベル
+        partitions : ラベル → 行番号の配列
+        """
+        self.full_index = full_index
+        self.embeddings = embeddings
+        self.labels = list(labels)
+        self.partitions = partitions
+        self.plan_counts = {"full": 0, "partition": 0, "predicate": 0}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def n_rows(self, labels):
+        """labels に当てはまる行の数"""
+        return sum(len(self.partitions[label]) for label in set(labels)
+                   if label in self.partitions)
+
+    def selectivity(self, labels):
+        """labels に当てはまる行の割合"""
+        return self.n_rows(labels) / max(len(self), 1)
+
+    def plan(self, labels, k=10):
+        """
+        "full"（フィルター無し）/ "partition" / "predicate" のどれで引くか。
+        partition は m 行の内積、predicate は full_index.search_cost(k) / 選択率 の内積と見積もる
+        """
+        if labels is None:
+            return "full"
+        m = self.n_rows(labels)
+        if m == 0:
+            return "partition"
+        predicate_cost = self.full_index.search_cost(k) * len(self) / m
+        return "partition" if m <= predicate_cost else "predicate"
+
+    def search(self, query, k, labels=None, exclude=None):
+        """
+        labels : このラベルの行だけを返す（None なら全部）
+        exclude: 行番号で引ける bool マスク（True は除外。カートの商品など）
+        戻り値 : (行番号の配列, スコアの配列) スコア降順
+        """
+        plan = self.plan(labels, k)
+        self.plan_counts[plan] += 1
+        if plan == "full":
+            return self.full_index.search(query, k, exclude=exclude)
+        if plan == "predicate":
+            allowed = self.label_mask(labels)
+            return self.full_index.search(
+                query, k, exclude=~allowed if exclude is None else ~allowed | exclude)
+
+        # partition: 指定ラベルの行だけを共有の行列から取り出して内積
+        rows = [self.partitions[label] for label in set(labels) if label in self.partitions]
+        rows = np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.intp)
+        if exclude is not None:
+            rows = rows[~exclude[rows]]
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        scores = _float32_rows(self.embeddings, rows) @ np.asarray(query, dtype=np.float32)
+        top = top_k_indices(scores, k)
+        return rows[top], scores[top].astype(np.float32)
+
+    def label_mask(self, labels):
+        mask = np.zeros(len(self), dtype=bool)
+        for label in set(labels):
+            if label in self.partitions:
+                mask[self.partitions[label]] = True
+        return mask
+
+
+def _float32_rows(embeddings, rows):
+    if hasattr(embeddings, "rows"):
+        return embeddings.rows(rows)
+    return np.asarray(embeddings[rows], dtype=np.float32)
+
+
+def build_partitioned_index(backend, embeddings, labels, **params):
+    """
+    embeddings（ndarray / MappedMatrix）から全体の index とラベルごとの行番号リストを作る
+    """
+    labels = list(labels)
+    full_index = build_index(backend, embeddings, **params)
+
+    rows_by_label = {}
+    for row, label in enumerate(labels):
+        rows_by_label.setdefault(label, []).append(row)
+    partitions = {label: np.array(rows, dtype=np.intp) for label, rows in rows_by_label.items()}
+    return PartitionedIndex(full_index, embeddings, labels, partitions)
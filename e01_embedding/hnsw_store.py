@@ -0,0 +1,115 @@
+# =====================================
+# HNSW index のディスク保存 / 読み込み
+# =====================================
+# 起動のたびに init_index + add_items (ef_construction=200) で作り直すと、
+# アイテム数が多いときはデプロイごとに長い時間がかかる。そこで path/ 以下に
+#   index.bin : hnswlib の save_index() の中身
+#   meta.json : フォーマットバージョン, space, dim, M, ef_construction,
+#               登録済みの件数, その件数ぶんの embedding の checksum, カタログのバージョン
+# を置き、次の起動では
+#   設定とカタログのバージョンが同じで、
+#   checksum が今の embedding の先頭 count 行と一致 → load_index するだけ
+#   embedding が後ろに増えている → resize_index して増えた行だけ add_items
+#   それ以外（中身が変わった / 設定が違う） → 作り直して保存
+# とする。id は embedding の行番号。
+import hashlib
+import json
+import os
+
+import hnswlib
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def embeddings_checksum(embeddings, n=None, block_rows=65536):
+    """先頭 n 行（省略時は全行）を float32 にしたものの sha1"""
+    n = len(embeddings) if n is None else n
+    h = hashlib.sha1()
+    h.update(f"{n}x{embeddings.shape[1]}".encode())
+    for start in range(0, n, block_rows):
+        block = np.ascontiguousarray(embeddings[start:min(start + block_rows, n)],
+                                     dtype=np.float32)
+        h.update(block.tobytes())
+    return h.hexdigest()
+
+
+def save_hnsw(path, index, embeddings, space, M, ef_construction, version=0):
+    """index（embeddings の先頭 get_current_count() 行を登録済み）を path/ に保存する"""
+    os.makedirs(path, exist_ok=True)
+    count = index.get_current_count()
+    tmp_path = os.path.join(path, "index.bin.tmp")
+    index.save_index(tmp_path)
+    os.replace(tmp_path, os.path.join(path, "index.bin"))
+
+    # meta.json は最後に書く（読み手は meta を見てから index.bin を開く）
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "space": space,
+        "dim": int(embeddings.shape[1]),
+        "M": M,
+        "ef_construction": ef_construction,
+        "count": count,
+        "checksum": embeddings_checksum(embeddings, count),
+        "version": version,
+    }
+    tmp_path = os.path.join(path, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+
+def load_hnsw(path, embeddings, space="cosine", M=16, ef_construction=200, version=0):
+    """
+    path/ の index が embeddings の先頭 count 行と一致すれば読み込んで返す。
+    設定 / version が違う・一致しない・無いときは None。増えた行はまだ登録しない（open_hnsw_index で追加する）
+    """
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    expected = {"format_version": FORMAT_VERSION, "space": space,
+                "dim": int(embeddings.shape[1]), "M": M, "ef_construction": ef_construction,
+                "version": version}
+    if any(meta.get(key) != value for key, value in expected.items()):
+        return None
+    count = meta["count"]
+    if count > len(embeddings) or embeddings_checksum(embeddings, count) != meta["checksum"]:
+        return None
+
+    index = hnswlib.Index(space=space, dim=meta["dim"])
+    index.load_index(os.path.join(path, "index.bin"), max_elements=max(len(embeddings), 1))
+    return index
+
+
+def open_hnsw_index(path, embeddings, space="cosine", M=16, ef_construction=200, ef=50,
+                    version=0, verbose=True):
+    """
+    保存済みの index を使えるなら読み込み、後ろに増えた行だけ追加する。
+    使えなければ全件から作る。どちらも変更があれば path/ に保存し直す
+    """
+    n = len(embeddings)
+    index = load_hnsw(path, embeddings, space=space, M=M, ef_construction=ef_construction,
+                      version=version)
+    if index is None:
+        index = hnswlib.Index(space=space, dim=embeddings.shape[1])
+        index.init_index(max_elements=max(n, 1), ef_construction=ef_construction, M=M)
+        status = "built"
+    else:
+        status = "loaded"
+
+    count = index.get_current_count()
+    if count < n:
+        if n > index.get_max_elements():
+            index.resize_index(n)
+        index.add_items(np.asarray(embeddings[count:], dtype=np.float32), np.arange(count, n))
+        save_hnsw(path, index, embeddings, space, M, ef_construction, version=version)
+        if status == "loaded":
+            status = f"loaded + added {n - count}"
+
+    index.set_ef(ef)
+    if verbose:
+        print(f"[hnsw index] {status} (count={index.get_current_count()}, path={path})")
+    return index
@@ -0,0 +1,94 @@
+# =====================================
+# KeyedVectors の類似度 / アナロジーをまとめて計算する
+# =====================================
+# model.similarity(w1, w2) や most_similar(...) を 1 問ずつ Python のループで呼ぶ代わりに、
+#   1. 単語 → 行番号をまとめて引き、ベクトルは 1 回の take で集める
+#   2. 正規化済みの語彙行列 (vocab, dim) とのスコアを
+#      (クエリ block_queries 件) × (語彙 block_vocab 語) の行列積でブロックごとに計算
+#   3. ブロックごとの上位 topn を前のブロックまでの上位とマージ（入力に使った単語は除外）
+# で、何万問あっても問題ごとのループ無しで上位 topn を出す。
+# normed は load_normed_vectors()（mmap）や kv.get_normed_vectors() の戻り値を渡す。
+import numpy as np
+
+from topk import top_k_rows
+
+
+def key_ids(kv, words):
+    """単語の配列 → 行番号の配列（語彙に無い単語は -1）"""
+    key_to_index = kv.key_to_index
+    return np.array([key_to_index.get(w, -1) for w in words], dtype=np.int64)
+
+
+def batch_similarity(normed, ids1, ids2):
+    """(ids1[i], ids2[i]) ごとの cos 類似度。どちらかが -1 なら nan"""
+    ids1, ids2 = np.asarray(ids1), np.asarray(ids2)
+    valid = (ids1 >= 0) & (ids2 >= 0)
+    v1 = np.take(normed, np.where(valid, ids1, 0), axis=0)
+    v2 = np.take(normed, np.where(valid, ids2, 0), axis=0)
+    sims = np.einsum("ij,ij->i", v1, v2).astype(np.float32)
+    sims[~valid] = np.nan
+    return sims
+
+
+def batch_most_similar(normed, queries, topn=10, exclude_ids=None, restrict_vocab=None,
+                       block_queries=256, block_vocab=65536):
+    """
+    queries    : (n, dim) のクエリベクトル（正規化していなくてよい。スコアは cos 類似度）
+    exclude_ids: (n, m) クエリごとに除外する行番号（-1 は無視）
+    戻り値     : (n, topn) の行番号（足りないところは -1）とスコア
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    queries = queries / np.where(norms > 0, norms, 1.0)
+    n_vocab = len(normed) if restrict_vocab is None else min(restrict_vocab, len(normed))
+
+    out_ids = np.full((len(queries), topn), -1, dtype=np.int64)
+    out_scores = np.full((len(queries), topn), -np.inf, dtype=np.float32)
+    for qs in range(0, len(queries), block_queries):
+        q = queries[qs:qs + block_queries]
+        ex = None if exclude_ids is None else np.asarray(exclude_ids[qs:qs + block_queries])
+        best_ids = np.full((len(q), 0), -1, dtype=np.int64)
+        best_scores = np.full((len(q), 0), -np.inf, dtype=np.float32)
+        for vs in range(0, n_vocab, block_vocab):
+            ve = min(vs + block_vocab, n_vocab)
+            scores = q @ np.asarray(normed[vs:ve], dtype=np.float32).T
+            if ex is not None:
+                rows, cols = np.nonzero((ex >= vs) & (ex < ve))
+                scores[rows, ex[rows, cols] - vs] = -np.inf
+            # このブロックの上位 topn と、前のブロックまでの上位 topn をマージ
+            top = top_k_rows(scores, topn)
+            cand_ids = np.concatenate([best_ids, top + vs], axis=1)
+            cand_scores = np.concatenate(
+                [best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            keep = top_k_rows(cand_scores, topn)
+            best_ids = np.take_along_axis(cand_ids, keep, axis=1)
+            best_scores = np.take_along_axis(cand_scores, keep, axis=1)
+        k = best_ids.shape[1]
+        out_ids[qs:qs + len(q), :k] = np.where(best_scores > -np.inf, best_ids, -1)
+        out_scores[qs:qs + len(q), :k] = best_scores
+    return out_ids, out_scores
+
+
+def analogy_queries(normed, ids_a, ids_b, ids_c):
+    """
+    b - a + c のクエリベクトル (n, dim)、入力の行番号 (n, 3)、全部語彙にある問題かどうか (n,)。
+    most_similar(positive=[b, c], negative=[a]) と同じく正規化したベクトルで足し引きする
+    """
+    ids = np.stack([np.asarray(ids_a), np.asarray(ids_b), np.asarray(ids_c)], axis=1)
+    valid = (ids >= 0).all(axis=1)
+    v = np.take(normed, np.where(valid[:, None], ids, 0), axis=0)  # (n, 3, dim)
+    return v[:, 1] - v[:, 0] + v[:, 2], ids, valid
+
+
+def batch_analogy(normed, ids_a, ids_b, ids_c, topn=10, **kwargs):
+    """
+    「a に対する b は、c に対する何か」（b - a + c）をまとめて解く。
+    king - man + woman なら a=man, b=king, c=woman。a / b / c 自身は除外する。
+    どれかが -1 の問題は全部 -1 を返す
+    """
+    queries, ids, valid = analogy_queries(normed, ids_a, ids_b, ids_c)
+    out_ids, out_scores = batch_most_similar(normed, queries, topn=topn, exclude_ids=ids,
+                                             **kwargs)
+    out_ids[~valid] = -1
+    out_scores[~valid] = -np.inf
+    return out_ids, out_scores
@@ -0,0 +1,244 @@
+# =====================================
+# テキストの長さでバケットに分けて encode する + フィールドごとの切り詰め
+# =====================================
+# product_to_text は 名前 / カテゴリ / タグ / 説明 をつなげるので、長さのばらつきが大きい。
+# 短い商品名だけのテキストが長い説明と同じバッチに入ると、長い方に合わせてパディングされて
+# transformer の計算が無駄になる。そこで
+#   1. トークン数（tokenizer が無ければ文字数）で並べ替えて、boundaries ごとのバケットに分ける
+#   2. バケットごとに「バッチサイズ × 長さ ≒ token_budget」になるバッチサイズで encode
+#   3. 結果は元の順番に戻す
+# また、truncate_fields で説明などの長いフィールドをフィールドごとの上限で切ってからテキストにする。
+#   python length_buckets.py                  → 合成カタログでパディング率と速度を比べる
+#   python length_buckets.py products.jsonl   → 手元のカタログ（catalog.read_catalog の形式）で比べる
+import time
+
+import numpy as np
+
+DEFAULT_BOUNDARIES = (16, 32, 64, 128, 256)
+DEFAULT_TOKEN_BUDGET = 4096  # 1 バッチの（バッチサイズ × 最大長）の目安
+MAX_BATCH_SIZE = 256
+
+# フィールドごとのトークン数の上限（tags は合計）
+FIELD_BUDGETS = {"name": 32, "category": 16, "tags": 32, "description": 128}
+
+
+def load_tokenizer(model_name):
+    """model_name の tokenizer（transformers が無い / 読めないときは None → 文字数で代用）"""
+    try:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(model_name)
+    except (ImportError, OSError):
+        return None
+
+
+def text_lengths(texts, tokenizer=None, max_length=None):
+    """各テキストのトークン数（special token 込み）。max_length があればそこで頭打ち"""
+    texts = list(texts)
+    if tokenizer is None:
+        lengths = np.array([len(t) for t in texts], dtype=np.int64)
+    elif texts:
+        input_ids = tokenizer(texts, add_special_tokens=True)["input_ids"]
+        lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+    else:
+        lengths = np.zeros(0, dtype=np.int64)
+    if max_length:
+        lengths = np.minimum(lengths, max_length)
+    return lengths
+
+
+def batch_size_for(length, token_budget=DEFAULT_TOKEN_BUDGET, max_batch_size=MAX_BATCH_SIZE):
+    """最大長 length のバッチに使うバッチサイズ"""
+    return int(max(1, min(max_batch_size, token_budget // max(int(length), 1))))
+
+
+def bucket_batches(lengths, boundaries=DEFAULT_BOUNDARIES, token_budget=DEFAULT_TOKEN_BUDGET,
+                   max_batch_size=MAX_BATCH_SIZE):
+    """
+    長さ順に並べてバケットに分ける。
+    戻り値: [(rows, batch_size), ...]  rows は元の行番号（バケットの中は短い順）
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind="stable")
+    bucket_of = np.searchsorted(np.asarray(boundaries), lengths[order], side="left")
+    batches = []
+    for b in np.unique(bucket_of):
+        rows = order[bucket_of == b]
+        batches.append((rows, batch_size_for(lengths[rows].max(), token_budget, max_batch_size)))
+    return batches
+
+
+def encode_bucketed(model, texts, normalize_embeddings=True, tokenizer=None,
+                    boundaries=DEFAULT_BOUNDARIES, token_budget=DEFAULT_TOKEN_BUDGET,
+                    max_batch_size=MAX_BATCH_SIZE, **kwargs):
+    """
+    model.encode(texts, normalize_embeddings=...) と同じ結果を、バケットごとのバッチサイズで計算する。
+    tokenizer を省略すると model.tokenizer を使う
+    """
+    texts = list(texts)
+    if tokenizer is None:
+        tokenizer = getattr(model, "tokenizer", None)
+    lengths = text_lengths(texts, tokenizer, getattr(model, "max_seq_length", None))
+
+    out = None
+    for rows, batch_size in bucket_batches(lengths, boundaries, token_budget, max_batch_size):
+        emb = model.encode([texts[i] for i in rows], batch_size=batch_size,
+                           normalize_embeddings=normalize_embeddings, **kwargs)
+        emb = np.asarray(emb, dtype=np.float32)
+        if out is None:
+            out = np.empty((len(texts), emb.shape[1]), dtype=np.float32)
+        out[rows] = emb
+
+    if out is None:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    return out
+
+
+# =====================================
+# フィールドごとの切り詰め
+# =====================================
+def _n_tokens(text, tokenizer=None):
+    if tokenizer is None:
+        return len(text)
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def truncate_text(text, max_tokens, tokenizer=None):
+    """text を先頭 max_tokens トークン（tokenizer が無ければ文字）までに切る"""
+    if tokenizer is None:
+        return text[:max_tokens]
+    enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = enc["offset_mapping"]
+    if len(offsets) <= max_tokens:
+        return text
+    return text[:offsets[max_tokens - 1][1]] if max_tokens > 0 else ""
+
+
+def truncate_fields(record, budgets=FIELD_BUDGETS, tokenizer=None):
+    """
+    record（商品 dict など）のコピーを返す。budgets にあるフィールドだけ上限で切る
+      文字列: 先頭 budget トークンまで / リスト（tags）: 合計が budget に収まるところまでの要素
+    """
+    out = dict(record)
+    for field, budget in budgets.items():
+        value = out.get(field)
+        if isinstance(value, str):
+            out[field] = truncate_text(value, budget, tokenizer)
+        elif isinstance(value, (list, tuple)):
+            kept, used = [], 0
+            for item in value:
+                used += _n_tokens(item, tokenizer)
+                if used > budget:
+                    break
+                kept.append(item)
+            out[field] = kept
+    return out
+
+
+# =====================================
+# パディング率と速度のレポート
+# =====================================
+def padding_stats(lengths, batches):
+    """batches: [(rows, batch_size), ...] → (実トークン数, パディング込みのトークン数)"""
+    lengths = np.asarray(lengths)
+    real = padded = 0
+    for rows, batch_size in batches:
+        for start in range(0, len(rows), batch_size):
+            chunk = lengths[rows[start:start + batch_size]]
+            real += int(chunk.sum())
+            padded += int(chunk.max()) * len(chunk)
+    return real, padded
+
+
+def padding_report(model, texts, batch_size=32, tokenizer=None, repeat=3, **bucket_kwargs):
+    """
+    3 通りの並べ方でパディング率（1 - 実トークン / パディング込み）を比べる
+      fixed    : 入力順のまま batch_size ずつ
+      sorted   : 長さ順に並べて batch_size ずつ（model.encode をそのまま呼んだとき）
+      bucketed : encode_bucketed（長さ順 + バケットごとのバッチサイズ）
+    sorted / bucketed は実際に encode して texts/sec も測る
+    """
+    texts = list(texts)
+    if tokenizer is None:
+        tokenizer = getattr(model, "tokenizer", None)
+    lengths = text_lengths(texts, tokenizer, getattr(model, "max_seq_length", None))
+    n = len(texts)
+    plans = {
+        "fixed": [(np.arange(n), batch_size)],
+        "sorted": [(np.argsort(lengths, kind="stable"), batch_size)],
+        "bucketed": bucket_batches(lengths, **bucket_kwargs),
+    }
+    runs = {
+        "sorted": lambda: model.encode(texts, batch_size=batch_size, normalize_embeddings=True),
+        "bucketed": lambda: encode_bucketed(model, texts, tokenizer=tokenizer, **bucket_kwargs),
+    }
+
+    seconds = {}
+    for name, run in runs.items():
+        run()  # ウォームアップ
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+        seconds[name] = best
+
+    rows = []
+    for name, batches in plans.items():
+        real, padded = padding_stats(lengths, batches)
+        sec = seconds.get(name)
+        rows.append({
+            "plan": name,
+            "tokens": real,
+            "padded": padded,
+            "padding_ratio": 1.0 - real / max(padded, 1),
+            "texts/sec": n / sec if sec else float("nan"),
+            "speedup": seconds["sorted"] / sec if sec else float("nan"),
+        })
+    return rows
+
+
+def sample_products(n=2000, seed=0):
+    """名前だけの短い商品から長い説明つきの商品まで混ざった合成カタログ"""
+    rng = np.random.default_rng(seed)
+    words = ["白菜", "長ねぎ", "豆腐", "豚肉", "鶏肉", "しめじ", "キムチ", "味噌", "醤油",
+             "牛乳", "バター", "ヨーグルト", "トマト", "にんにく", "パスタ", "チーズ"]
+    sentences = ["鍋料理にぴったりです。", "国産の原料を使っています。", "冷蔵で保存してください。",
+                 "炒め物やスープにも使えます。", "お子さまにも人気の定番商品です。",
+                 "開封後はお早めにお召し上がりください。"]
+    products = []
+    for i in range(n):
+        # 説明の長さは 0 文〜数十文（長い説明は少数）
+        n_sentences = int(rng.pareto(1.2) * 2)
+        products.append({
+            "id": i,
+            "name": "".join(rng.choice(words, rng.integers(1, 3))),
+            "category": str(rng.choice(["野菜", "肉", "乳製品", "調味料", "加工食品"])),
+            "tags": list(rng.choice(words, rng.integers(0, 5))),
+            "description": "".join(rng.choice(sentences, min(n_sentences, 60))),
+        })
+    return products
+
+
+def main() -> None:
+    import sys
+
+    from catalog import product_to_text, read_catalog
+    from model_registry import get_model
+    from report import print_report
+
+    model_name = "sentence-transformers/all-MiniLM-L6-v2"
+    model = get_model(model_name)
+    tokenizer = getattr(model, "tokenizer", None)
+    products = read_catalog(sys.argv[1]) if len(sys.argv) > 1 else sample_products()
+
+    print(f"\n=== {model_name}, products={len(products)} (そのまま) ===")
+    print_report(padding_report(model, [product_to_text(p) for p in products]))
+
+    print(f"\n=== フィールドごとに切り詰め {FIELD_BUDGETS} ===")
+    truncated = [product_to_text(truncate_fields(p, FIELD_BUDGETS, tokenizer)) for p in products]
+    print_report(padding_report(model, truncated))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# =====================================
+# プロセス内で共有するモデルの置き場（初めて使うときに読み込む）
+# =====================================
+# モジュールの import 時に load_encoder を呼ぶと、encode しない使い方（CLI / テスト /
+# キャッシュだけで足りるとき）でも torch + モデルの読み込みを待つことになり、
+# 複数のモジュールを組み合わせるとモデルが何個も読み込まれる。そこで
+#   lazy_model(name, backend) → 最初に encode などの属性にさわったときに読み込む代理オブジェクト
+#   get_model(name, backend)  → (name, backend) ごとに 1 つだけ読み込んで使い回す
+#   warm_up(name, backend)    → 先に読み込み + 1 回 encode しておく（サーバ起動時など）
+#   load_stats()              → 読み込み / ウォームアップにかかった秒数と get_model が呼ばれた回数
+import threading
+import time
+
+from encoder_backend import load_encoder
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+_models = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+def get_model(model_name=MODEL_NAME, backend="torch", verbose=True, threads=None):
+    """
+    (model_name, backend) のモデル。まだなら読み込む（同時に呼ばれても読み込みは 1 回）
+    threads は読み込むときだけ使う（load_encoder に渡す）
+    """
+    key = (model_name, backend)
+    with _lock:
+        if key not in _models:
+            start = time.perf_counter()
+            _models[key] = load_encoder(model_name, backend=backend, verbose=verbose,
+                                        threads=threads)
+            _stats[key] = {"load_sec": time.perf_counter() - start, "warmup_sec": None,
+                           "uses": 0}
+            if verbose:
+                print(f"[model registry] loaded {model_name} ({backend}) "
+                      f"in {_stats[key]['load_sec']:.2f}s")
+        _stats[key]["uses"] += 1
+        return _models[key]
+
+
+def is_loaded(model_name=MODEL_NAME, backend="torch"):
+    return (model_name, backend) in _models
+
+
+def warm_up(model_name=MODEL_NAME, backend="torch", texts=("warm up",), verbose=True):
+    """読み込み + 短い encode を 1 回（最初のリクエストで初期化の時間を払わないように）"""
+    model = get_model(model_name, backend, verbose=verbose)
+    start = time.perf_counter()
+    model.encode(list(texts), normalize_embeddings=True)
+    _stats[(model_name, backend)]["warmup_sec"] = time.perf_counter() - start
+    return model
+
+
+def load_stats():
+    """読み込んだモデルごとの load_sec / warmup_sec / uses"""
+    return [{"model": name, "backend": backend, **stats}
+            for (name, backend), stats in _stats.items()]
+
+
+def clear():
+    """読み込んだモデルを全部手放す"""
+    with _lock:
+        _models.clear()
+        _stats.clear()
+
+
+class LazyModel:
+    """
+    SentenceTransformer の代わりに渡せる代理オブジェクト。
+    encode などの属性に初めてさわった時点で get_model() を呼び、あとはそのモデルを使い回す
+    """
+
+    def __init__(self, model_name=MODEL_NAME, backend="torch"):
+        self.model_name = model_name
+        self.backend = backend
+        self._model = None
+
+    @property
+    def loaded(self):
+        return self._model is not None or is_loaded(self.model_name, self.backend)
+
+    def _resolve(self):
+        if self._model is None:
+            self._model = get_model(self.model_name, self.backend)
+        return self._model
+
+    def __getattr__(self, name):
+        # model_name / backend / _model 以外の属性だけここに来る
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"LazyModel({self.model_name!r}, backend={self.backend!r}, {state})"
+
+
+def lazy_model(model_name=MODEL_NAME, backend="torch"):
+    return LazyModel(model_name, backend)
@@ -0,0 +1,182 @@
+# =====================================
+# 商品 → 商品 の近傍テーブル（「この商品も買いませんか？」の事前計算）
+# =====================================
+# カタログ内の商品同士の類似度はカタログが変わるまで変わらないので、
+# 全商品の top-N 近傍をブロックごとの行列積でまとめて計算して
+# （行も列も block に分けて、列ブロックごとの上位 N 件を行ごとにマージしていくので、
+#   一度に持つスコアは block_size × col_block_size だけ）
+#   neighbors: (n, N) int32   近傍の行番号（足りないところは -1）
+#   scores   : (n, N) float16 類似度
+# に持っておく。引くときは neighbors[row] を見るだけ (O(1))。
+# ProductStore の変更履歴を見て、変わった行に関係するところだけ作り直す。
+# save / load はカタログの fingerprint（行ごとの商品id / 文章 + モデル名）と一緒に保存して、
+# 別のカタログ / 別の状態のテーブルを読まないようにする。
+import os
+import tempfile
+
+import numpy as np
+
+from topk import top_k_rows
+
+
+class NeighborTable:
+    def __init__(self, n_neighbors=20, block_size=1024, col_block_size=16384):
+        self.n_neighbors = n_neighbors
+        self.block_size = block_size
+        self.col_block_size = col_block_size
+        self.neighbors = np.full((0, n_neighbors), -1, dtype=np.int32)
+        self.scores = np.zeros((0, n_neighbors), dtype=np.float16)
+        self.version = None  # 同期済みの ProductStore.version
+
+    def __len__(self):
+        return len(self.neighbors)
+
+    # ---------- 参照 ----------
+    def lookup(self, row, top_k=None):
+        """row の近傍 (行番号の配列, スコアの配列) をスコア降順で返す"""
+        nbrs = self.neighbors[row]
+        valid = nbrs >= 0
+        nbrs, scores = nbrs[valid], self.scores[row][valid].astype(np.float32)
+        if top_k is not None:
+            nbrs, scores = nbrs[:top_k], scores[:top_k]
+        return nbrs, scores
+
+    # ---------- 作成 / 更新 ----------
+    def sync(self, store):
+        """ProductStore の現在の状態に合わせる（必要なところだけ作り直す）"""
+        changed = None if self.version is None else store.changed_rows_since(self.version)
+        if changed is None:
+            self.build(store.embeddings, store.alive)
+        elif changed:
+            self.refresh(store.embeddings, store.alive, changed)
+        self.version = store.version
+
+    def build(self, embeddings, alive=None):
+        """全行の top-N 近傍を計算する"""
+        n = len(embeddings)
+        alive = np.ones(n, dtype=bool) if alive is None else np.asarray(alive)
+        self.neighbors = np.full((n, self.n_neighbors), -1, dtype=np.int32)
+        self.scores = np.zeros((n, self.n_neighbors), dtype=np.float16)
+        self._compute_rows(np.flatnonzero(alive), embeddings, alive)
+
+    def refresh(self, embeddings, alive, changed_rows):
+        """
+        changed_rows（追加/更新/削除された行）に関係するところだけ作り直す
+          1. 変わった行自身と、近傍に変わった行を含む行 → 全件から計算し直し
+          2. それ以外の行 → 今の近傍と「変わった行」だけをマージ
+        """
+        n = len(embeddings)
+        alive = np.asarray(alive)
+        self._grow(n)
+        changed = np.array(sorted(changed_rows), dtype=np.intp)
+        if len(changed) * 2 > n:
+            self.build(embeddings, alive)
+            return
+
+        is_changed = np.zeros(n, dtype=bool)
+        is_changed[changed] = True
+        dead = np.flatnonzero(~alive)
+        self.neighbors[dead] = -1
+        self.scores[dead] = 0.0
+
+        nbrs = self.neighbors
+        has_changed_nbr = ((nbrs >= 0) & is_changed[np.maximum(nbrs, 0)]).any(axis=1)
+        dirty = alive & (is_changed | has_changed_nbr)
+        self._compute_rows(np.flatnonzero(dirty), embeddings, alive)
+
+        # 2. 変わった行（生きているもの）を、それ以外の行の近傍候補にマージ
+        new_rows = changed[alive[changed]]
+        others = np.flatnonzero(alive & ~dirty)
+        if len(new_rows) == 0 or len(others) == 0:
+            return
+        new_emb = _float32_rows(embeddings, new_rows)
+        for start in range(0, len(others), self.block_size):
+            rows = others[start:start + self.block_size]
+            old_idx = self.neighbors[rows].astype(np.intp)
+            old_sc = self.scores[rows].astype(np.float32)
+            old_sc[old_idx < 0] = -np.inf
+            new_sc = _float32_rows(embeddings, rows) @ new_emb.T
+            cand_idx = np.concatenate(
+                [old_idx, np.broadcast_to(new_rows, (len(rows), len(new_rows)))], axis=1)
+            cand_sc = np.concatenate([old_sc, new_sc], axis=1)
+            self._store_top(rows, cand_idx, cand_sc)
+
+    # ---------- 保存 ----------
+    def save(self, path, store):
+        """store（sync 済みの ProductStore）の fingerprint と一緒に保存する（一時ファイル → rename）"""
+        if self.version != store.version:
+            raise ValueError("NeighborTable is not in sync with the store; call sync(store) first")
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp.npz", delete=False) as f:
+            np.savez(f, neighbors=self.neighbors, scores=self.scores, key=store.fingerprint())
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path, store):
+        """
+        保存したときと store のカタログが同じなら読み込んで、store の今の version に同期済みにする。
+        無い / カタログが違うときは None
+        """
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        if str(data["key"]) != store.fingerprint():
+            return None
+        table = cls(n_neighbors=data["neighbors"].shape[1])
+        table.neighbors = data["neighbors"]
+        table.scores = data["scores"]
+        table.version = store.version
+        return table
+
+    # ---------- 内部 ----------
+    def _compute_rows(self, rows, embeddings, alive):
+        """
+        rows の近傍を全行との行列積から計算する。
+        block_size 行 × col_block_size 列ずつ計算し、列ブロックの上位 N 件を行ごとにマージする
+        """
+        n = len(embeddings)
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            queries = _float32_rows(embeddings, block)
+            best_idx = np.full((len(block), 0), -1, dtype=np.intp)
+            best_sc = np.full((len(block), 0), -np.inf, dtype=np.float32)
+            for cs in range(0, n, self.col_block_size):
+                ce = min(cs + self.col_block_size, n)
+                scores = queries @ np.asarray(embeddings[cs:ce], dtype=np.float32).T
+                scores[:, ~alive[cs:ce]] = -np.inf
+                # 自分自身は除外
+                own = np.flatnonzero((block >= cs) & (block < ce))
+                scores[own, block[own] - cs] = -np.inf
+                top = top_k_rows(scores, self.n_neighbors)
+                cand_idx = np.concatenate([best_idx, top + cs], axis=1)
+                cand_sc = np.concatenate([best_sc, np.take_along_axis(scores, top, axis=1)],
+                                         axis=1)
+                keep = top_k_rows(cand_sc, self.n_neighbors)
+                best_idx = np.take_along_axis(cand_idx, keep, axis=1)
+                best_sc = np.take_along_axis(cand_sc, keep, axis=1)
+            self._store_top(block, best_idx, best_sc)
+
+    def _store_top(self, rows, cand_idx, cand_sc):
+        top = top_k_rows(cand_sc, self.n_neighbors)
+        top_sc = np.take_along_axis(cand_sc, top, axis=1)
+        top_idx = np.take_along_axis(cand_idx, top, axis=1)
+        top_idx = np.where(top_sc > -np.inf, top_idx, -1)
+        k = top.shape[1]
+        self.neighbors[rows] = -1
+        self.neighbors[rows, :k] = top_idx
+        self.scores[rows, :k] = np.where(top_sc > -np.inf, top_sc, 0.0)
+
+    def _grow(self, n):
+        if n <= len(self.neighbors):
+            return
+        extra = n - len(self.neighbors)
+        self.neighbors = np.concatenate(
+            [self.neighbors, np.full((extra, self.n_neighbors), -1, dtype=np.int32)])
+        self.scores = np.concatenate(
+            [self.scores, np.zeros((extra, self.n_neighbors), dtype=np.float16)])
+
+
+def _float32_rows(embeddings, rows):
+    """embeddings（float32 / float16 の ndarray や mmap）の指定行を float32 で取り出す"""
+    return np.asarray(embeddings[rows], dtype=np.float32)
@@ -0,0 +1,350 @@
+# =====================================
+# 商品ストア（upsert / delete で差分だけ再 embedding）
+# =====================================
+# products と product_embeddings を 1 つにまとめて、
+#   - upsert: 新規/文章が変わった商品だけ encode して行を上書き or 追加
+#   - delete: 行は消さずに tombstone（alive=False）を立てる
+#   - compact: tombstone が溜まったら詰め直す
+# を行う。ANN index（hnswlib.Index 互換）を attach しておくと一緒に更新する。
+# publish() で行列を mmap 形式（embedding_matrix）に書き出すと、scores() はそちらを使い、
+# 手元の float32 の行列は手放す（次に upsert / compact で書き換えるときに mmap から作り直す）。
+# publish 後に upsert した行は mmap のスコアの上に手元の行列で計算し直したスコアを重ねるので、
+# 次の publish までも全件の float32 化はしない（compact で行番号が変わったときだけ手元の行列で計算）。
+# embedding のディスクキャッシュはストアが 1 つメモリに持ち続け、ファイルに書くのは
+# compact / publish / flush のときだけ（upsert のたびにキャッシュ全体を読み書きしない）。
+import uuid
+
+import numpy as np
+
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache, encode_with_cache, texts_fingerprint
+from embedding_matrix import open_matrix
+from topk import top_k_indices
+
+DELETED = "\0deleted"  # publish の key で削除済みの行を表す文章
+
+
+class ProductStore:
+    def __init__(self, model, model_name, text_fn, products=(),
+                 normalize_embeddings=True, compact_ratio=0.3,
+                 initial_capacity=1024, cache_path=DEFAULT_CACHE_PATH):
+        """
+        text_fn: product_to_text のような 商品dict → 文章 の関数
+        compact_ratio: 削除済み行がこの割合を超えたら自動で compact
+        cache_path: embedding のディスクキャッシュ（None ならファイルに書かない）
+        """
+        self.model = model
+        self.model_name = model_name
+        self.text_fn = text_fn
+        self.normalize_embeddings = normalize_embeddings
+        self.compact_ratio = compact_ratio
+        self.dim = model.get_sentence_embedding_dimension()
+        self._cache = EmbeddingCache(cache_path)
+
+        self.products = []   # row → 商品dict（削除済みは None）
+        self.texts = []      # row → 埋め込み元の文章
+        self.id_to_row = {}     # 商品id → row
+        self.name_to_rows = {}  # 商品名 → {row, ...}（同名商品があり得るので set）
+        self._emb = np.zeros((initial_capacity, self.dim), dtype=np.float32)
+        self._alive = np.zeros(initial_capacity, dtype=bool)
+        self.n_rows = 0
+        self.n_dead = 0
+        self.token = uuid.uuid4().hex  # ストアごとの識別子（派生データのキャッシュのキー。id() は使い回される）
+        self.version = 0     # 変更のたびに +1（派生データの作り直し判定用）
+        self._changes = []   # (version, embedding を変えた行 / None=全行, 商品dictだけ変えた行) の履歴
+        self._changes_floor = 0  # これより古い version の差分は捨ててある
+
+        self._index = None
+        self._index_factory = None
+        self._matrix = None
+        self._dirty = None   # publish 後に embedding を変えた行（None: mmap の行番号が使えない）
+
+        if products:
+            self.upsert(products, verbose=True)
+            self.flush()
+
+    # ---------- 参照 ----------
+    def __len__(self):
+        return self.n_rows - self.n_dead
+
+    @property
+    def embeddings(self):
+        """
+        (n_rows, dim) の行列。削除済み行も含むので alive と一緒に使う。
+        publish 後は mmap（float16 など）をそのまま返す（int8 のときだけ float32 に戻したコピー）
+        """
+        if self._emb is None:
+            if self._matrix.scales is None:
+                return self._matrix.data
+            return self._matrix.rows(np.arange(self.n_rows))
+        return self._emb[:self.n_rows]
+
+    @property
+    def alive(self):
+        return self._alive[:self.n_rows]
+
+    @property
+    def index(self):
+        return self._index
+
+    def scores(self, query_emb):
+        """
+        全行のスコア。削除済み行は -inf
+        query_emb が (n_queries, dim) なら (n_queries, n_rows) を返す
+        """
+        if self._dirty is None:
+            scores = (self.embeddings @ np.asarray(query_emb).T).T
+        else:
+            scores = self._matrix.scores(query_emb)
+            if self._dirty:
+                # publish 後に書き換えた / 追加した行だけ手元の行列で計算して重ねる
+                rows = np.fromiter(sorted(self._dirty), dtype=np.intp, count=len(self._dirty))
+                published = scores
+                scores = np.empty(published.shape[:-1] + (self.n_rows,), dtype=np.float32)
+                scores[..., :published.shape[-1]] = published
+                scores[..., rows] = (self._emb[rows] @ np.asarray(query_emb, np.float32).T).T
+        scores[..., ~self.alive] = -np.inf
+        return scores
+
+    def search(self, query_emb, top_k, exclude=None, accept=None):
+        """
+        上位 top_k 件の (行番号, スコア)。
+        index を attach していればそれで探し、無ければ scores() の全件から選ぶ
+        """
+        if self._index is not None:
+            return self._index.search(query_emb, top_k, exclude=exclude, accept=accept)
+        scores = self.scores(query_emb)
+        rows = top_k_indices(scores, top_k, exclude=exclude, accept=accept)
+        return rows, scores[rows]
+
+    def get(self, product_id):
+        row = self.id_to_row.get(product_id)
+        return None if row is None else self.products[row]
+
+    def rows_for(self, ids=(), names=()):
+        """商品id / 商品名 → 行番号の配列（存在しないものは無視）"""
+        rows = [self.id_to_row[i] for i in ids if i in self.id_to_row]
+        for name in names:
+            rows.extend(self.name_to_rows.get(name, ()))
+        return np.array(rows, dtype=np.intp)
+
+    def fingerprint(self):
+        """
+        行ごとの (商品id, 文章) + モデル名の sha1 hex。行番号で引く派生データ（近傍テーブルなど）を
+        保存したときと今のカタログが同じかの確認用（version はプロセスごとの番号なので使えない）
+        """
+        keys = [DELETED if p is None else f"{p['id']}\0{t}"
+                for p, t in zip(self.products, self.texts)]
+        return texts_fingerprint(keys, self.model_name)
+
+    def exclusion_mask(self, ids=(), names=()):
+        """カートの商品や自分自身を除外する (n_rows,) の bool マスク"""
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[self.rows_for(ids, names)] = True
+        return mask
+
+    # ---------- 更新 ----------
+    def upsert(self, products, verbose=False):
+        """
+        商品を追加 or 更新する。
+        文章(text_fn の結果)が変わっていない商品（価格だけ変更など）は encode しない。
+        先に encode してから products / 索引 / 行列を書き換えるので、encode が失敗しても
+        ストアは upsert 前のまま。
+        戻り値: 再 embedding した行番号のリスト
+        """
+        pending = {}  # 商品id → (商品dict, 文章)（同じ id が何度も来たら最後のもの）
+        for p in products:
+            pending[p["id"]] = (p, self.text_fn(p))
+        changed = [pid for pid, (_, text) in pending.items()
+                   if pid not in self.id_to_row or self.texts[self.id_to_row[pid]] != text]
+        if changed:
+            embs = encode_with_cache(self.model, [pending[pid][1] for pid in changed],
+                                     self.model_name,
+                                     normalize_embeddings=self.normalize_embeddings,
+                                     verbose=verbose, cache=self._cache, save=False)
+
+        # ここから下は失敗しない書き換えだけ
+        changed = set(changed)
+        touched_rows, product_rows = [], []
+        for pid, (p, text) in pending.items():
+            row = self.id_to_row.get(pid)
+            if row is None:
+                row = self._append_row()
+                self.id_to_row[pid] = row
+            elif pid not in changed:
+                if self.products[row] != p:  # 価格・在庫など、文章に出ない項目だけの変更
+                    self._set_product(row, p)
+                    product_rows.append(row)
+                continue
+            self._set_product(row, p)
+            self.texts[row] = text
+            touched_rows.append(row)
+
+        if touched_rows:
+            rows = np.asarray(touched_rows)
+            self._writable()
+            self._emb[rows] = embs
+            self._alive[rows] = True
+            if self._dirty is not None:
+                self._dirty.update(touched_rows)
+            if self._index is not None:
+                self._ensure_index_capacity(self.n_rows)
+                self._index.add_items(embs, rows)
+        if touched_rows or product_rows:
+            self._bump(touched_rows, product_rows)
+        return touched_rows
+
+    def delete(self, product_ids):
+        """tombstone を立てるだけ。行の詰め直しは compact で行う"""
+        deleted_rows = []
+        for pid in product_ids:
+            row = self.id_to_row.pop(pid, None)
+            if row is None:
+                continue
+            self._alive[row] = False
+            self._set_product(row, None)
+            self.texts[row] = None
+            self.n_dead += 1
+            deleted_rows.append(row)
+            if self._index is not None:
+                self._index.mark_deleted(row)
+        if deleted_rows:
+            self._bump(deleted_rows)
+        if self.n_rows and self.n_dead / self.n_rows > self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """削除済み行を詰める。行番号が変わるので index は作り直す"""
+        self._writable()
+        keep = np.flatnonzero(self.alive)
+        n = len(keep)
+        self._emb[:n] = self._emb[keep]
+        self._emb[n:self.n_rows] = 0.0
+        self._alive[:n] = True
+        self._alive[n:self.n_rows] = False
+        self.products = [self.products[i] for i in keep]
+        self.texts = [self.texts[i] for i in keep]
+        self.id_to_row = {p["id"]: row for row, p in enumerate(self.products)}
+        self.name_to_rows = {}
+        for row, p in enumerate(self.products):
+            self.name_to_rows.setdefault(p["name"], set()).add(row)
+        self.n_rows = n
+        self.n_dead = 0
+        self._dirty = None
+        self._bump(None)
+        if self._index_factory is not None:
+            self._build_index()
+        self.flush()
+
+    def flush(self):
+        """メモリ上の embedding キャッシュをファイルに書く（変更が無ければ何もしない）"""
+        self._cache.save()
+
+    # ---------- mmap 公開 ----------
+    def publish(self, path, dtype="float16", release=True):
+        """
+        現在の行列を path/ に書き出して mmap で開き直す。
+        同じ version / 文章の行列がもう書いてあれば（他のプロセスが publish 済みなど）開くだけ。
+        以後 scores() はこの mmap を使う（upsert した行だけ手元の行列で計算して重ねる）。
+        release=True なら手元の float32 の行列を手放す（メモリは mmap の分だけになる）
+        """
+        texts = [DELETED if t is None else t for t in self.texts[:self.n_rows]]
+        self._matrix = open_matrix(path, lambda: self.embeddings, dtype=dtype,
+                                   version=self.version,
+                                   key=texts_fingerprint(texts, self.model_name))
+        self._dirty = set()
+        if release:
+            self._emb = None
+        self.flush()
+        return self._matrix
+
+    # ---------- ANN index ----------
+    def attach_index(self, factory):
+        """
+        factory(dim, max_elements) → hnswlib.Index 互換のオブジェクト
+        （add_items / mark_deleted が使えればよい。ann_index.index_factory など）
+        """
+        self._index_factory = factory
+        self._build_index()
+        return self._index
+
+    def _build_index(self):
+        self._index = self._index_factory(self.dim, max(len(self._alive), 1))
+        rows = np.flatnonzero(self.alive)
+        if len(rows):
+            vectors = self._matrix.rows(rows) if self._emb is None else self._emb[rows]
+            # PQ / PCA（quantized_index）は登録の前に学習が要る
+            if not getattr(self._index, "trained", True):
+                self._index.train(vectors)
+            self._index.add_items(vectors, rows)
+
+    def _ensure_index_capacity(self, n):
+        if not hasattr(self._index, "get_max_elements"):
+            return
+        if self._index.get_max_elements() < n:
+            self._index.resize_index(len(self._alive))
+
+    def changed_rows_since(self, version, products=False):
+        """
+        version 以降に embedding / 生存状態が変わった行の set。
+        products=True なら商品dictだけ変わった行（価格・在庫など）も含める。
+        compact で行番号が変わっていたら None（全部作り直しが必要）
+        """
+        if version < self._changes_floor:
+            return None
+        rows = set()
+        for v, changed, product_rows in self._changes:
+            if v <= version:
+                continue
+            if changed is None:
+                return None
+            rows.update(changed)
+            if products:
+                rows.update(product_rows)
+        return rows
+
+    # ---------- 内部 ----------
+    def _bump(self, rows, product_rows=(), max_history=10000):
+        self.version += 1
+        if rows is None:
+            # 全行変わったので、それより前の差分はもう要らない
+            self._changes = []
+        self._changes.append((self.version, None if rows is None else list(rows),
+                              list(product_rows)))
+        if len(self._changes) > max_history:
+            drop = len(self._changes) // 2
+            self._changes_floor = self._changes[drop - 1][0]
+            self._changes = self._changes[drop:]
+
+    def _set_product(self, row, p):
+        """products[row] を差し替えて、商品名 → 行 の index も更新する"""
+        old = self.products[row]
+        if old is not None:
+            rows = self.name_to_rows.get(old["name"])
+            rows.discard(row)
+            if not rows:
+                del self.name_to_rows[old["name"]]
+        if p is not None:
+            self.name_to_rows.setdefault(p["name"], set()).add(row)
+        self.products[row] = p
+
+    def _writable(self):
+        """publish で手放した float32 の行列を mmap から作り直す"""
+        if self._emb is not None:
+            return
+        self._emb = np.zeros((len(self._alive), self.dim), dtype=np.float32)
+        self._emb[:self.n_rows] = self._matrix.rows(np.arange(self.n_rows))
+
+    def _append_row(self):
+        self._writable()
+        if self.n_rows == len(self._alive):
+            cap = max(len(self._alive) * 2, 16)
+            emb = np.zeros((cap, self.dim), dtype=np.float32)
+            emb[:self.n_rows] = self._emb[:self.n_rows]
+            alive = np.zeros(cap, dtype=bool)
+            alive[:self.n_rows] = self._alive[:self.n_rows]
+            self._emb, self._alive = emb, alive
+        row = self.n_rows
+        self.n_rows += 1
+        self.products.append(None)
+        self.texts.append(None)
+        return row
@@ -0,0 +1,195 @@
+# =====================================
+# PCA で次元を落としたコピーで候補を出す（一次走査用）+ 次元数ごとの評価
+# =====================================
+# 384 次元のまま全件内積を取る代わりに、カタログの embedding で PCA を学習し
+#   items: (x - mean) @ components.T   → n_components 次元の float32 のコピー
+#   query: q @ components.T            （q・mean は全アイテム共通なので順位に影響しない）
+# の内積で候補を出して、元のベクトルで再ランキングする（quantized_index.PCAIndex, backend "pca"）。
+# 学習した射影は embedding_matrix の保存先（path/）に pca_<次元>.npz として一緒に置き、
+# 行列の data_dir / version / shape が同じなら次からはそれを読む（open_projection）。
+# build_index("pca", load_matrix(path)) はこれを使うので、起動のたびに学習し直さない。
+#   python projection.py               → 合成データで 32 / 64 / 128 / 256 次元を比べる
+#   python projection.py <matrix_dir>  → 保存済みの行列（e08_products など）で比べる
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from embedding_matrix import load_matrix
+
+DIMS = (32, 64, 128, 256)
+
+
+class Projection:
+    def __init__(self, mean, components, explained_variance_ratio=None):
+        self.mean = np.asarray(mean, dtype=np.float32)               # (dim,)
+        self.components = np.asarray(components, dtype=np.float32)   # (n_components, dim)
+        self.explained_variance_ratio = explained_variance_ratio
+
+    @property
+    def n_components(self):
+        return self.components.shape[0]
+
+    def transform(self, vectors):
+        """アイテム側: (n, dim) → (n, n_components)"""
+        return (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+
+    def transform_query(self, query):
+        """クエリ側: (dim,) または (n_queries, dim)"""
+        return np.asarray(query, dtype=np.float32) @ self.components.T
+
+
+def _sample_rows(vectors, train_size, seed):
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    ids = np.sort(rng.choice(n, min(n, train_size), replace=False))
+    if hasattr(vectors, "rows"):
+        return vectors.rows(ids)
+    return np.asarray(vectors[ids], dtype=np.float32)
+
+
+def fit_pca(vectors, n_components, train_size=20000, seed=0):
+    """vectors（ndarray / MappedMatrix）から最大 train_size 行をサンプルして PCA を学習する"""
+    sample = _sample_rows(vectors, train_size, seed).astype(np.float64)
+    mean = sample.mean(axis=0)
+    _, s, vt = np.linalg.svd(sample - mean, full_matrices=False)
+    n_components = min(n_components, vt.shape[0])
+    var = s ** 2
+    return Projection(mean, vt[:n_components],
+                      float(var[:n_components].sum() / max(var.sum(), 1e-12)))
+
+
+# =====================================
+# 保存 / 読み込み（embedding_matrix の保存先に一緒に置く）
+# =====================================
+def projection_path(matrix_dir, n_components):
+    return os.path.join(matrix_dir, f"pca_{n_components}.npz")
+
+
+def save_projection(path, projection, version=0, shape=(0, 0), source="."):
+    """source: 学習に使った行列の data_dir（meta.json の data_dir）"""
+    ratio = projection.explained_variance_ratio
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", suffix=".tmp.npz",
+                                     delete=False) as f:
+        np.savez(f, mean=projection.mean, components=projection.components,
+                 explained_variance_ratio=np.nan if ratio is None else float(ratio),
+                 version=version, shape=np.asarray(shape), source=source)
+    os.replace(f.name, path)
+
+
+def load_projection(path, version=0, shape=(0, 0), source="."):
+    """行列の data_dir / version / shape が保存時と同じなら Projection、違う / 無ければ None"""
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    saved_source = str(data["source"]) if "source" in data.files else "."
+    if (int(data["version"]) != version or tuple(data["shape"]) != tuple(shape)
+            or saved_source != source):
+        return None
+    ratio = float(data["explained_variance_ratio"])
+    return Projection(data["mean"], data["components"], None if np.isnan(ratio) else ratio)
+
+
+def open_projection(matrix_dir, n_components, train_size=20000, seed=0, matrix=None,
+                    verbose=True):
+    """
+    save_matrix で保存した行列（matrix_dir）用の射影。保存済みのものが使えなければ学習して保存する。
+    matrix: load_matrix(matrix_dir) 済みならそれ（開き直さない）
+    """
+    if matrix is None:
+        matrix = load_matrix(matrix_dir)
+    path = projection_path(matrix_dir, n_components)
+    source = matrix.meta.get("data_dir", ".")
+    projection = load_projection(path, matrix.version, matrix.shape, source)
+    status = "loaded"
+    if projection is None:
+        projection = fit_pca(matrix, n_components, train_size=train_size, seed=seed)
+        save_projection(path, projection, matrix.version, matrix.shape, source)
+        status = "fitted"
+    if verbose:
+        ratio = projection.explained_variance_ratio
+        print(f"[projection] {status} pca {matrix.shape[1]} -> {projection.n_components} dims "
+              f"(explained variance {'?' if ratio is None else f'{ratio:.3f}'})")
+    return projection
+
+
+# =====================================
+# 評価: 次元数ごとの recall@k と走査のスループット
+# =====================================
+def evaluate_dims(embeddings, queries, dims=DIMS, k=10, n_candidates=200, repeat=3):
+    """
+    基準は今の全件内積（embeddings @ query_emb）の上位 k 件。次元数ごとに
+      recall@k      : 低次元のスコアだけで選んだ上位 k 件
+      rerank_recall : 低次元で n_candidates 件 → 元のベクトルで再ランキングした上位 k 件
+      scan_ms       : 1 クエリの走査（低次元の内積）にかかる時間、Mitems/sec はそのスループット
+      search_ms     : 再ランキング込みの 1 クエリの時間
+    """
+    from ann_bench import recall_at_k
+    from quantized_index import PCAIndex
+    from topk import top_k_indices
+
+    matrix = embeddings.rows(np.arange(len(embeddings))) if hasattr(embeddings, "rows") \
+        else np.asarray(embeddings, dtype=np.float32)
+    n, dim = matrix.shape
+
+    def timed(fn):
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = [fn(q) for q in queries]
+            best = min(best, time.perf_counter() - start)
+        return out, best * 1000.0 / len(queries)
+
+    full_scores, full_ms = timed(lambda q: matrix @ q)
+    truth = np.stack([top_k_indices(s, k) for s in full_scores])
+    rows = [{
+        "dims": dim, "recall@k": 1.0, "rerank_recall": 1.0, "scan_ms": full_ms,
+        "Mitems/sec": n / full_ms / 1000.0, "search_ms": full_ms, "speedup": 1.0,
+        "bytes/item": dim * 4, "explained_var": 1.0,
+    }]
+    for d in dims:
+        if d >= dim:
+            continue
+        index = PCAIndex(dim, max_elements=n, embeddings=matrix, n_components=d,
+                         n_candidates=n_candidates)
+        approx, scan_ms = timed(index.approx_scores)
+        found, search_ms = timed(lambda q: index.search(q, k)[0])
+        rows.append({
+            "dims": d,
+            "recall@k": recall_at_k(np.stack([top_k_indices(s, k) for s in approx]), truth),
+            "rerank_recall": recall_at_k(np.stack(found), truth),
+            "scan_ms": scan_ms,
+            "Mitems/sec": n / scan_ms / 1000.0,
+            "search_ms": search_ms,
+            "speedup": full_ms / search_ms,
+            "bytes/item": d * 4,
+            "explained_var": index.projection.explained_variance_ratio,
+        })
+    return rows
+
+
+def main() -> None:
+    import sys
+
+    from ann_bench import synthetic_embeddings
+    from report import print_report
+
+    if len(sys.argv) > 1:
+        embeddings = load_matrix(sys.argv[1])
+        name = sys.argv[1]
+    else:
+        embeddings = synthetic_embeddings(100_000)
+        name = "synthetic"
+    # クエリは行列の行にノイズを足したもの
+    rng = np.random.default_rng(1)
+    base = _sample_rows(embeddings, 200, seed=1)
+    queries = base + 0.1 * rng.standard_normal(base.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    print(f"=== {name}: n={len(embeddings)}, dim={embeddings.shape[1]} ===")
+    print_report(evaluate_dims(embeddings, queries))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+# =====================================
+# 量子化した embedding で候補を出し、float で再ランキングする index
+# =====================================
+# 384 次元 float32 の全件内積はメモリ帯域で頭打ちになるので、
+#   "int8": 行ごとのスケール付き int8（1 アイテム = dim バイト + 4 バイト）
+#   "pq"  : 直積量子化。dim を n_subspaces 個に分け、それぞれ 256 個の代表ベクトル
+#           （k-means で学習）の番号 1 バイトで表す（1 アイテム = n_subspaces バイト）
+#   "pca" : PCA で n_components 次元に落とした float32 のコピー（1 アイテム = 4 * n_components バイト。
+#           射影は projection.py）
+# の圧縮コードだけを走査してスコアの近似値を出し、上位 n_candidates 件だけを
+# 元の精度のベクトル（ExactIndex。mmap の MappedMatrix ならそのまま）で計算し直して並べる。
+# 使い方は ann_index の他の backend と同じ（build_index("int8", embeddings) など）。
+# PQ は代表ベクトルの学習に十分な行が要るので、embeddings= か training_sample= を渡すか
+# train(sample) してからでないと add_items できない。カタログが大きく変わったら retrain()。
+# PCA は min_train_size 行たまるまで学習せず全件内積で探す。build_index("pca", load_matrix(path))
+# のように保存済みの行列を渡すと、path/ に保存した射影を使う（projection.open_projection）。
+import numpy as np
+
+from ann_index import AnnIndex, ExactIndex
+from embedding_matrix import quantize_int8
+from projection import fit_pca, open_projection
+from topk import top_k_indices
+
+
+def _as_float32_rows(embeddings, start, end):
+    if hasattr(embeddings, "rows"):
+        return embeddings.rows(np.arange(start, end))
+    return np.asarray(embeddings[start:end], dtype=np.float32)
+
+
+class QuantizedIndex(AnnIndex):
+    """int8 / PQ 共通: 圧縮コードの管理、候補出し + 再ランキング"""
+
+    def __init__(self, dim, max_elements=1024, embeddings=None, n_candidates=200,
+                 block_rows=4096, training_sample=None):
+        self.dim = dim
+        self.n_candidates = n_candidates
+        self.block_rows = block_rows
+        # 再ランキング用の元の精度のベクトル（embeddings はコピーしない）
+        self.full = ExactIndex(dim, max_elements=max_elements, embeddings=embeddings)
+        n = 0 if embeddings is None else len(embeddings)
+        self._n = 0
+        self._alive = np.zeros(max(max_elements, n), dtype=bool)
+        self._codes = None
+        self._code_capacity = 0
+        if training_sample is not None:
+            self._fit(training_sample)
+        if embeddings is not None:
+            if not self.trained and self._can_train(n):
+                self._fit(embeddings)
+            for start in range(0, n, self.block_rows):
+                end = min(start + self.block_rows, n)
+                if self.trained:
+                    self._put(np.arange(start, end), _as_float32_rows(embeddings, start, end))
+                else:
+                    self._buffer(np.arange(start, end))
+
+    def __len__(self):
+        return int(self._alive[:self._n].sum())
+
+    def get_max_elements(self):
+        return len(self._alive)
+
+    def resize_index(self, max_elements):
+        self.full.resize_index(max_elements)
+        self._grow(max_elements)
+
+    @property
+    def trained(self):
+        """コード化の準備ができているか（int8 は学習が要らないので常に True）"""
+        return True
+
+    def train(self, sample):
+        """sample（ndarray / MappedMatrix）で学習する。登録済みの行があればコード化し直す"""
+        self._fit(sample)
+        self._reencode()
+
+    def retrain(self):
+        """今登録されている行で学習し直して、全行をコード化し直す"""
+        ids = np.flatnonzero(self._alive[:self._n])
+        if len(ids) == 0:
+            raise ValueError(f"{type(self).__name__}.retrain() needs at least one item")
+        self.train(self.full.vectors(ids))
+
+    def add_items(self, vectors, ids=None):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        ids = np.arange(self._n, self._n + len(vectors)) if ids is None else np.asarray(ids)
+        if len(ids) == 0:
+            return
+        if not self.trained:
+            raise ValueError(f"{type(self).__name__} is not trained: pass embeddings= or "
+                             "training_sample=, or call train(sample) before add_items")
+        self.full.add_items(vectors, ids)
+        self._put(ids, vectors)
+
+    def mark_deleted(self, id_):
+        self.full.mark_deleted(id_)
+        self._alive[id_] = False
+
+    def approx_scores(self, query):
+        """圧縮コードだけから計算した全行のスコア（削除済みは -inf）"""
+        query = np.asarray(query, dtype=np.float32)
+        out = np.empty(self._n, dtype=np.float32)
+        prepared = self._prepare_query(query)
+        for start in range(0, self._n, self.block_rows):
+            end = min(start + self.block_rows, self._n)
+            out[start:end] = self._scan(prepared, start, end)
+        out[~self._alive[:self._n]] = -np.inf
+        return out
+
+    def search(self, query, k, exclude=None, accept=None):
+        if k <= 0 or len(self) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        cand = top_k_indices(self.approx_scores(query), max(k, self.n_candidates),
+                             exclude=exclude, accept=accept)
+        exact = self.full.vectors(cand) @ np.asarray(query, dtype=np.float32)
+        order = np.argsort(-exact, kind="stable")[:k]
+        return cand[order], exact[order].astype(np.float32)
+
+    def _knn(self, query, k):
+        return self.search(query, k)
+
+    def memory_bytes(self):
+        """走査する圧縮コードの大きさ（再ランキング用の元のベクトルは含まない）"""
+        return 0 if self._codes is None else self._codes[:self._n].nbytes
+
+    # ---------- 各方式で実装 ----------
+    def _can_train(self, n):
+        """n 行あれば学習してよいか"""
+        return n > 0
+
+    def _fit(self, vectors):
+        """コード化の準備（PQ は代表ベクトルの学習）"""
+
+    def _encode(self, vectors):
+        raise NotImplementedError
+
+    def _prepare_query(self, query):
+        return query
+
+    def _scan(self, prepared, start, end):
+        raise NotImplementedError
+
+    # ---------- 内部 ----------
+    def _reencode(self):
+        ids = np.flatnonzero(self._alive[:self._n])
+        self._codes = None
+        self._code_capacity = 0
+        for start in range(0, len(ids), self.block_rows):
+            block = ids[start:start + self.block_rows]
+            self._put(block, self.full.vectors(block))
+
+    def _buffer(self, ids):
+        """学習前の行: 元のベクトル（self.full）にだけある状態で登録済みにする"""
+        need = int(ids.max()) + 1
+        self._grow(need)
+        self._alive[ids] = True
+        self._n = max(self._n, need)
+
+    def _put(self, ids, vectors):
+        codes = self._encode(vectors)
+        need = int(ids.max()) + 1
+        self._grow(need)
+        if self._code_capacity < len(self._alive):
+            self._grow_codes(codes)
+        self._store_codes(ids, codes)
+        self._alive[ids] = True
+        self._n = max(self._n, need)
+
+    def _grow(self, capacity):
+        if capacity <= len(self._alive):
+            return
+        alive = np.zeros(max(capacity, 2 * len(self._alive)), dtype=bool)
+        alive[:len(self._alive)] = self._alive
+        self._alive = alive
+
+    def _grow_codes(self, sample):
+        capacity = len(self._alive)
+        new = np.zeros((capacity,) + sample.shape[1:], dtype=sample.dtype)
+        if self._codes is not None:
+            new[:len(self._codes)] = self._codes
+        self._codes = new
+        self._code_capacity = capacity
+
+    def _store_codes(self, ids, codes):
+        self._codes[ids] = codes
+
+
+class Int8Index(QuantizedIndex):
+    """行ごとのスケール付き int8 のスカラー量子化（embedding_matrix.quantize_int8 と同じ形式）"""
+
+    def __init__(self, dim, max_elements=1024, embeddings=None, n_candidates=200,
+                 block_rows=4096):
+        self._scales = np.zeros(0, dtype=np.float32)
+        super().__init__(dim, max_elements=max_elements, embeddings=embeddings,
+                         n_candidates=n_candidates, block_rows=block_rows)
+
+    def _encode(self, vectors):
+        return quantize_int8(vectors)
+
+    def _grow_codes(self, sample):
+        codes, scales = sample
+        super()._grow_codes(codes)
+        new = np.zeros(len(self._alive), dtype=np.float32)
+        new[:len(self._scales)] = self._scales
+        self._scales = new
+
+    def _store_codes(self, ids, codes):
+        codes, scales = codes
+        self._codes[ids] = codes
+        self._scales[ids] = scales
+
+    def _scan(self, query, start, end):
+        # int8 のブロックを float32 にしてから内積（ブロックはキャッシュに収まる大きさ）
+        return (self._codes[start:end].astype(np.float32) @ query) * self._scales[start:end]
+
+    def memory_bytes(self):
+        return super().memory_bytes() + self._scales[:self._n].nbytes
+
+
+class PQIndex(QuantizedIndex):
+    """
+    直積量子化。スコアは「サブ空間ごとのクエリ × 代表ベクトル」の表（n_subspaces × 256）を
+    クエリごとに 1 回作り、コードで表を引いて足すだけで出す
+    """
+
+    def __init__(self, dim, max_elements=1024, embeddings=None, n_subspaces=96,
+                 n_centroids=256, n_candidates=200, train_size=10000, n_iter=15, seed=0,
+                 block_rows=65536, training_sample=None):
+        if dim % n_subspaces:
+            raise ValueError(f"dim ({dim}) must be divisible by n_subspaces ({n_subspaces})")
+        if n_centroids > 256:
+            raise ValueError("n_centroids must be <= 256 (codes are uint8)")
+        self.n_subspaces = n_subspaces
+        self.sub_dim = dim // n_subspaces
+        self.n_centroids = n_centroids
+        self.train_size = train_size
+        self.n_iter = n_iter
+        self.seed = seed
+        self.codebooks = None  # (n_subspaces, n_centroids, sub_dim)
+        super().__init__(dim, max_elements=max_elements, embeddings=embeddings,
+                         n_candidates=n_candidates, block_rows=block_rows,
+                         training_sample=training_sample)
+
+    @property
+    def trained(self):
+        return self.codebooks is not None
+
+    def _fit(self, vectors):
+        """サブ空間ごとに k-means で代表ベクトルを学習する（最大 train_size 行のサンプル）"""
+        rng = np.random.default_rng(self.seed)
+        n = len(vectors)
+        sample_ids = np.sort(rng.choice(n, min(n, self.train_size), replace=False))
+        if hasattr(vectors, "rows"):
+            sample = vectors.rows(sample_ids)
+        else:
+            sample = np.asarray(vectors[sample_ids], dtype=np.float32)
+        k = min(self.n_centroids, len(sample))
+        self.codebooks = np.stack([
+            _kmeans(self._sub(sample, j), k, self.n_iter, rng)
+            for j in range(self.n_subspaces)
+        ])
+
+    def _sub(self, vectors, j):
+        return vectors[:, j * self.sub_dim:(j + 1) * self.sub_dim]
+
+    def _encode(self, vectors):
+        codes = np.empty((len(vectors), self.n_subspaces), dtype=np.uint8)
+        for j in range(self.n_subspaces):
+            codes[:, j] = _nearest(self._sub(vectors, j), self.codebooks[j])
+        return codes
+
+    def _prepare_query(self, query):
+        # (n_subspaces, n_centroids): サブ空間 j で代表ベクトル c を選んだときの内積
+        return np.einsum("jcd,jd->jc", self.codebooks,
+                         query.reshape(self.n_subspaces, self.sub_dim))
+
+    def _grow_codes(self, sample):
+        # コードは (n_subspaces, 件数) で持つ（走査はサブ空間ごとに連続したメモリを読む）
+        capacity = len(self._alive)
+        new = np.zeros((self.n_subspaces, capacity), dtype=np.uint8)
+        if self._codes is not None:
+            new[:, :self._codes.shape[1]] = self._codes
+        self._codes = new
+        self._code_capacity = capacity
+
+    def _store_codes(self, ids, codes):
+        self._codes[:, ids] = codes.T
+
+    def _scan(self, table, start, end):
+        out = np.zeros(end - start, dtype=np.float32)
+        for j in range(self.n_subspaces):
+            out += np.take(table[j], self._codes[j, start:end])
+        return out
+
+    def memory_bytes(self):
+        codes = 0 if self._codes is None else self._codes[:, :self._n].nbytes
+        codebooks = 0 if self.codebooks is None else self.codebooks.nbytes
+        return codes + codebooks
+
+
+class PCAIndex(QuantizedIndex):
+    """
+    PCA で落とした低次元のコピーの内積で候補を出す。
+    projection（projection.open_projection の結果など）を渡すと学習せずにそれを使う。
+    学習は min_train_size 行（省略時は 4 * n_components）たまってから。それまでは全件内積で探す
+    """
+
+    def __init__(self, dim, max_elements=1024, embeddings=None, n_components=64,
+                 projection=None, n_candidates=200, train_size=20000, seed=0,
+                 block_rows=65536, training_sample=None, min_train_size=None):
+        self.projection = projection
+        self.n_components = n_components if projection is None else projection.n_components
+        self.train_size = train_size
+        self.seed = seed
+        self.min_train_size = 4 * self.n_components if min_train_size is None else min_train_size
+        super().__init__(dim, max_elements=max_elements, embeddings=embeddings,
+                         n_candidates=n_candidates, block_rows=block_rows,
+                         training_sample=training_sample)
+
+    @property
+    def trained(self):
+        return self.projection is not None
+
+    def train(self, sample):
+        """
+        sample が min_train_size 行に足りなければ学習しない（ProductStore などが小さいカタログで
+        呼んでも落ちないように）。そのときは add_items で行がたまってから学習する
+        """
+        if self._can_train(len(sample)):
+            super().train(sample)
+
+    def add_items(self, vectors, ids=None):
+        if self.trained:
+            return super().add_items(vectors, ids)
+        # 学習前は元のベクトルだけに入れておき、min_train_size 行たまったら学習する
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        ids = np.arange(self._n, self._n + len(vectors)) if ids is None else np.asarray(ids)
+        if len(ids) == 0:
+            return
+        self.full.add_items(vectors, ids)
+        self._buffer(ids)
+        if self._can_train(len(self)):
+            self.retrain()
+
+    def approx_scores(self, query):
+        if not self.trained:
+            return self.full.scores(query)
+        return super().approx_scores(query)
+
+    def search(self, query, k, exclude=None, accept=None):
+        if not self.trained:
+            return self.full.search(query, k, exclude=exclude, accept=accept)
+        return super().search(query, k, exclude=exclude, accept=accept)
+
+    def _can_train(self, n):
+        return n >= self.min_train_size
+
+    def _fit(self, vectors):
+        if not self._can_train(len(vectors)):
+            raise ValueError(f"PCAIndex needs at least {self.min_train_size} rows to fit "
+                             f"(got {len(vectors)})")
+        self.projection = fit_pca(vectors, self.n_components, train_size=self.train_size,
+                                  seed=self.seed)
+
+    def _encode(self, vectors):
+        return self.projection.transform(vectors)
+
+    def _prepare_query(self, query):
+        return self.projection.transform_query(query)
+
+    def _scan(self, query, start, end):
+        return self._codes[start:end] @ query
+
+    def memory_bytes(self):
+        components = 0 if self.projection is None else self.projection.components.nbytes
+        return super().memory_bytes() + components
+
+
+def _nearest(x, centers):
+    """各行に一番近い代表ベクトルの番号"""
+    d = (centers ** 2).sum(axis=1)[None, :] - 2.0 * (x @ centers.T)
+    return d.argmin(axis=1)
+
+
+def _kmeans(x, k, n_iter, rng):
+    centers = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest(x, centers)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.stack([np.bincount(assign, weights=x[:, d], minlength=k)
+                         for d in range(x.shape[1])], axis=1)
+        empty = counts == 0
+        centers[~empty] = sums[~empty] / counts[~empty, None]
+        # 空になった代表ベクトルはランダムな点で置き直す
+        centers[empty] = x[rng.choice(len(x), int(empty.sum()))]
+    return centers.astype(np.float32)
+
+
+def make_quantized_index(backend, dim, max_elements=1024, **params):
+    """ann_index.make_index から呼ばれる（PQ は training_sample= か、add_items の前に train() が要る）"""
+    cls = {"int8": Int8Index, "pq": PQIndex, "pca": PCAIndex}[backend]
+    return cls(dim, max_elements=max_elements, **params)
+
+
+def build_quantized_index(backend, embeddings, **params):
+    """ann_index.build_index から呼ばれる（embeddings はコピーせず再ランキングに使う）"""
+    cls = {"int8": Int8Index, "pq": PQIndex, "pca": PCAIndex}[backend]
+    if backend == "pca" and params.get("projection") is None \
+            and getattr(embeddings, "path", None) is not None:
+        # load_matrix で開いた行列: 保存済みの射影を使う（無ければ学習して保存）
+        n_components = params.get("n_components", 64)
+        min_train_size = params.get("min_train_size")
+        if min_train_size is None:
+            min_train_size = 4 * n_components
+        if len(embeddings) >= min_train_size:
+            params["projection"] = open_projection(
+                embeddings.path, n_components, train_size=params.get("train_size", 20000),
+                seed=params.get("seed", 0), matrix=embeddings)
+    return cls(embeddings.shape[1], max_elements=len(embeddings), embeddings=embeddings,
+               **params)
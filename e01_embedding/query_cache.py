@@ -0,0 +1,121 @@
+# =====================================
+# クエリ embedding の LRU / TTL キャッシュ
+# =====================================
+# 「寄せ鍋」のような同じ料理名・材料の組み合わせが何度も来るので、
+# 正規化したクエリ文字列をキーにして model.encode の結果を使い回す。
+# asyncio のサーバからは aencode / aencode_many で、キャッシュに無い分だけ
+# encode_service.BatchingEncoder に回す（同時に来たクエリを 1 回の encode にまとめる）。
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(text):
+    """全角/半角・前後の空白・連続空白をそろえる"""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+def join_ingredients(ingredients, sep="、"):
+    """材料リスト → 1本のテキスト（順番違いで別クエリにならないようにソート）"""
+    return sep.join(sorted(normalize_query(i) for i in ingredients))
+
+
+class QueryEmbeddingCache:
+    def __init__(self, model, maxsize=1024, ttl=None, normalize_embeddings=True,
+                 clock=time.monotonic):
+        """
+        maxsize: 保持するクエリ数の上限（超えたら一番古く使われたものから捨てる）
+        ttl: 秒。None なら期限なし
+        clock: 現在時刻（秒）を返す関数（テストで時計を差し替える用）
+        """
+        self.model = model
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.normalize_embeddings = normalize_embeddings
+        self.clock = clock
+        self._entries = OrderedDict()  # key → (作成時刻, ベクトル)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, emb = entry
+            if self.ttl is not None and self.clock() - created > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return emb
+
+    def _put(self, key, emb):
+        with self._lock:
+            self._entries[key] = (self.clock(), emb)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def encode(self, text):
+        """model.encode([text], normalize_embeddings=...)[0] と同じベクトルを返す"""
+        return self.encode_many([text])[0]
+
+    def encode_many(self, texts):
+        """キャッシュに無いクエリだけまとめて 1 回の encode に回す"""
+        keys, embs, missing = self._lookup(texts)
+        if missing:
+            new_embs = self.model.encode(missing,
+                                         normalize_embeddings=self.normalize_embeddings)
+            embs = self._fill(keys, embs, missing, new_embs)
+        return np.stack(embs)
+
+    async def aencode(self, text, encoder):
+        return (await self.aencode_many([text], encoder))[0]
+
+    async def aencode_many(self, texts, encoder):
+        """
+        encode_many の asyncio 版。キャッシュに無いクエリは encoder（encode_service.BatchingEncoder）に
+        渡して、同時に来たほかのリクエストの分と 1 回の model.encode にまとめてもらう
+        """
+        keys, embs, missing = self._lookup(texts)
+        if missing:
+            embs = self._fill(keys, embs, missing, await encoder.encode_many(missing))
+        return np.stack(embs)
+
+    def _lookup(self, texts):
+        keys = [normalize_query(t) for t in texts]
+        embs = [self._get(k) for k in keys]
+        missing = list(dict.fromkeys(k for k, e in zip(keys, embs) if e is None))
+        self.hits += sum(e is not None for e in embs)
+        self.misses += sum(e is None for e in embs)
+        return keys, embs, missing
+
+    def _fill(self, keys, embs, missing, new_embs):
+        fresh = dict(zip(missing, new_embs))
+        for k, emb in fresh.items():
+            self._put(k, emb)
+        return [fresh[k] if e is None else e for k, e in zip(keys, embs)]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
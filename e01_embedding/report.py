@@ -0,0 +1,16 @@
+# =====================================
+# ベンチマーク結果（dict のリスト）を表にして表示する
+# =====================================
+# ann_bench / encoder_bench / length_buckets / projection / vocab_tiers で共通に使う。
+# psutil や ann_index などのベンチマーク用の依存を引き込まないように、ここは標準ライブラリだけ。
+
+
+def print_report(results):
+    """results: [{列名: 値, ...}, ...]（1 行目のキーを列にする。float は小数 3 桁）"""
+    if not results:
+        return
+    keys = list(results[0].keys())
+    print("  ".join(f"{key:>12s}" for key in keys))
+    for r in results:
+        cells = [f"{v:>12.3f}" if isinstance(v, float) else f"{v!s:>12s}" for v in r.values()]
+        print("  ".join(cells))
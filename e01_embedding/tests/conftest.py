@@ -0,0 +1,42 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# スクリプトと同じく、e01_embedding/ の中のモジュールをそのまま import する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeEncoder:
+    """SentenceTransformer の代わり: 文章の hash から決まるベクトルを返す（encode の回数を数える）"""
+
+    def __init__(self, dim=16):
+        self.dim = dim
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        self.encoded.extend(texts)
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, t in enumerate(texts):
+            seed = int(hashlib.md5(t.encode("utf-8")).hexdigest()[:8], 16)
+            out[i] = np.random.default_rng(seed).standard_normal(self.dim)
+            if normalize_embeddings:
+                out[i] /= np.linalg.norm(out[i])
+        return out[0] if single else out
+
+
+@pytest.fixture
+def encoder():
+    return FakeEncoder()
+
+
+def random_unit(n, dim, seed=0):
+    x = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
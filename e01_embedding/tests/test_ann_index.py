@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from ann_index import build_index, make_index
+from conftest import random_unit
+
+# 小さい行列なので、近似の backend も全件たどる設定にして厳密解と一致させる
+BACKENDS = [
+    ("exact", None, {}),
+    ("hnsw", "hnswlib", {"ef": 200}),
+    ("annoy", "annoy", {"n_trees": 10, "search_k": 200 * 10}),
+]
+
+
+def brute_force(embeddings, query, k, exclude=None):
+    scores = embeddings @ query
+    if exclude is not None:
+        scores[exclude] = -np.inf
+    top = np.argsort(-scores, kind="stable")[:k]
+    return top[scores[top] > -np.inf]
+
+
+@pytest.fixture(params=BACKENDS, ids=[b for b, _, _ in BACKENDS])
+def backend(request):
+    name, module, params = request.param
+    if module is not None:
+        pytest.importorskip(module)
+    return name, params
+
+
+def test_top_k_matches_brute_force(backend):
+    name, params = backend
+    embeddings = random_unit(200, 16)
+    index = build_index(name, embeddings, **params)
+    queries = random_unit(10, 16, seed=1)
+    exclude = np.zeros(200, dtype=bool)
+    exclude[::3] = True
+
+    for q in queries:
+        ids, scores = index.search(q, 5)
+        np.testing.assert_array_equal(ids, brute_force(embeddings, q, 5))
+        np.testing.assert_allclose(scores, embeddings[ids] @ q, atol=1e-5)
+        ids, _ = index.search(q, 5, exclude=exclude)
+        np.testing.assert_array_equal(ids, brute_force(embeddings, q, 5, exclude))
+
+    ids, scores = index.search_batch(queries, 5)
+    np.testing.assert_array_equal(ids, [brute_force(embeddings, q, 5) for q in queries])
+
+
+def test_deleted_items_are_not_returned(backend):
+    name, params = backend
+    embeddings = random_unit(50, 8)
+    index = make_index(name, 8, max_elements=50, **params)
+    index.add_items(embeddings, np.arange(50))
+    q = embeddings[7]
+    assert index.search(q, 1)[0][0] == 7
+
+    index.mark_deleted(7)
+    deleted = np.zeros(50, dtype=bool)
+    deleted[7] = True
+    assert len(index) == 49
+    np.testing.assert_array_equal(index.search(q, 5)[0], brute_force(embeddings, q, 5, deleted))
+    assert len(index.search(q, 100)[0]) == 49
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+
+from bulk_encode import _thread_env, bulk_encode, catalog_texts
+from catalog import product_to_text
+from embedding_matrix import read_meta
+
+
+def test_catalog_texts_truncates_fields():
+    products = [{"name": "白菜", "category": "野菜", "tags": ["鍋", "冬野菜", "甘い"],
+                 "description": "あ" * 300}]
+    assert catalog_texts(products) == [product_to_text(products[0])]
+
+    text, = catalog_texts(products, field_budgets={"tags": 4, "description": 10})
+    assert "タグ: 鍋 冬野菜。" in text
+    assert text.endswith("説明: " + "あ" * 10)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_resume_after_partial_run(tmp_path, encoder):
+    texts = [f"商品 {i}" + "説明" * (i % 7) for i in range(50)]
+    path = str(tmp_path / "bulk")
+
+    class Crashing:
+        """3 shard 目の encode で落ちる"""
+
+        def __init__(self):
+            self.calls = 0
+
+        def encode(self, texts, **kwargs):
+            self.calls += 1
+            if self.calls == 3:
+                raise Interrupted
+            return encoder.encode(texts, **kwargs)
+
+    with pytest.raises(Interrupted):
+        bulk_encode(texts, path, shard_size=10, model=Crashing(), verbose=False)
+    assert read_meta(path) is None  # 途中なので load_matrix ではまだ開けない
+
+    encoder.encoded.clear()
+    matrix = bulk_encode(texts, path, shard_size=10, model=encoder, verbose=False)
+    assert len(encoder.encoded) == 30  # 終わっていた 2 shard は encode し直さない
+    np.testing.assert_allclose(np.asarray(matrix.data),
+                               encoder.encode(texts, normalize_embeddings=True), rtol=1e-6)
+
+    # 全部終わっていれば何も encode しない / texts が変われば最初から
+    encoder.encoded.clear()
+    bulk_encode(texts, path, shard_size=10, model=encoder, verbose=False)
+    assert encoder.encoded == []
+    bulk_encode(texts[:-1], path, shard_size=10, model=encoder, verbose=False)
+    assert len(encoder.encoded) == 49
+
+
+def test_thread_env_is_restored(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "8")
+    monkeypatch.delenv("MKL_NUM_THREADS", raising=False)
+    with _thread_env(2):
+        assert os.environ["OMP_NUM_THREADS"] == os.environ["MKL_NUM_THREADS"] == "2"
+    assert os.environ["OMP_NUM_THREADS"] == "8"
+    assert "MKL_NUM_THREADS" not in os.environ
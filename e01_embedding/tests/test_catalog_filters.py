@@ -0,0 +1,63 @@
+import numpy as np
+
+from catalog_filters import AhoCorasick, CatalogFilters, keyword_mask, predicate_mask
+from product_store import ProductStore
+
+
+def test_aho_corasick_matches_naive_scan():
+    rng = np.random.default_rng(0)
+    alphabet = list("abcあい")
+    for _ in range(200):
+        keywords = ["".join(rng.choice(alphabet, rng.integers(1, 4)))
+                    for _ in range(rng.integers(1, 6))]
+        text = "".join(rng.choice(alphabet, rng.integers(0, 30)))
+        matcher = AhoCorasick(keywords)
+        expected = {i for i, kw in enumerate(keywords) if kw in text}
+        assert matcher.find(text) == expected
+        assert matcher.contains_any(text) == bool(expected)
+
+
+def test_keyword_mask_skips_deleted_rows():
+    mask = keyword_mask(["寄せ鍋スープ", None, "牛乳"], ["鍋", "スープ"])
+    assert mask.tolist() == [True, False, False]
+
+
+def test_masks_follow_store_version(encoder):
+    products = [{"id": i, "name": f"p{i}", "in_stock": True} for i in range(4)]
+    store = ProductStore(encoder, "m", lambda p: p["name"], products, cache_path=None,
+                         compact_ratio=1.0)
+    filters = CatalogFilters()
+    calls = []
+
+    def in_stock(ps):
+        calls.append(len(ps))
+        return predicate_mask(ps, lambda p: p["in_stock"])
+
+    filters.register("in_stock", in_stock)
+    assert filters.mask(store, ["in_stock"]).all()
+    filters.mask(store, ["in_stock"])
+    assert calls == [4]  # 同じ version ならキャッシュ
+
+    # version が上がったら、変わった行 / 増えた行だけ作り直す
+    store.upsert([dict(products[2], in_stock=False), {"id": 9, "name": "p9", "in_stock": False}])
+    assert filters.mask(store, ["in_stock"]).tolist() == [True, True, False, True, False]
+    store.delete([0])
+    assert filters.mask(store, ["in_stock"]).tolist() == [False, True, False, True, False]
+    assert calls == [4, 2, 1]
+
+    # compact で行番号が変わったら全行
+    store.compact()
+    assert filters.mask(store, ["in_stock"]).tolist() == [True, False, True, False]
+    assert calls == [4, 2, 1, 4]
+
+
+def test_masks_are_not_shared_between_stores(encoder):
+    filters = CatalogFilters()
+    filters.register("in_stock", lambda ps: predicate_mask(ps, lambda p: p["in_stock"]))
+    a = ProductStore(encoder, "m", lambda p: p["name"],
+                     [{"id": 1, "name": "a", "in_stock": True}], cache_path=None)
+    b = ProductStore(encoder, "m", lambda p: p["name"],
+                     [{"id": 1, "name": "b", "in_stock": False}], cache_path=None)
+    assert a.version == b.version
+    assert filters.mask(a, ["in_stock"]).tolist() == [True]
+    assert filters.mask(b, ["in_stock"]).tolist() == [False]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import e10_mini
+from catalog import product_to_text
+from conftest import FakeEncoder
+from product_store import ProductStore
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    encoder = FakeEncoder()
+    store = ProductStore(encoder, "fake", product_to_text, e10_mini.products,
+                         cache_path=str(tmp_path / "emb.npz"))
+    store.publish(str(tmp_path / "products"), dtype="float16")
+    monkeypatch.setattr(e10_mini, "model", encoder)
+    monkeypatch.setattr(e10_mini, "get_store", lambda: store)
+    return store
+
+
+def per_cart(store, cart, top_k):
+    """1 カートずつ: 商品名の平均 → 全件スコア → カートの商品を除いて上位 top_k"""
+    if not cart:
+        return []
+    query = FakeEncoder().encode(cart, normalize_embeddings=True).mean(axis=0)
+    scores = store.scores(query)
+    scores[store.rows_for(names=cart)] = -np.inf
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return [store.products[i]["id"] for i in order if scores[i] > -np.inf]
+
+
+def test_batch_matches_per_cart_calls(store):
+    carts = [
+        ["豚バラ肉 200g", "しらたき 200g"],
+        [],
+        ["白菜 1/4カット"],
+        ["カタログに無い商品", "木綿豆腐 1丁"],
+        ["まったく知らない名前"],
+        [],
+        ["豚バラ肉 200g", "しらたき 200g"],  # 同じカートが 2 回
+        [p["name"] for p in e10_mini.products[:-2]],  # 残り 2 件しか出せない
+    ]
+    # block_size を小さくして、ブロックの切れ目をまたがせる
+    batch = e10_mini.recommend_related_products_batch(carts, top_k=5, block_size=3)
+
+    assert len(batch) == len(carts)
+    for cart, result in zip(carts, batch):
+        single = e10_mini.recommend_related_products_multi(cart, top_k=5)
+        # 行列積のまとめ方で下の桁は変わるので、スコアは近ければよい
+        assert [(r["id"], r["name"]) for r in result] == [(r["id"], r["name"]) for r in single]
+        np.testing.assert_allclose([r["score"] for r in result], [r["score"] for r in single],
+                                   rtol=1e-5)
+        assert [r["id"] for r in result] == per_cart(store, cart, 5)
+        assert not {r["name"] for r in result} & set(cart)
+    assert batch[1] == [] and batch[5] == []
+    assert len(batch[-1]) == 2
+
+
+def test_batch_of_empty_carts(store):
+    assert e10_mini.recommend_related_products_batch([]) == []
+    assert e10_mini.recommend_related_products_batch([[], []]) == [[], []]
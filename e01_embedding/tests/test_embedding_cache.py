@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, encode_with_cache
+
+
+def test_encode_with_cache_only_encodes_misses(tmp_path, encoder):
+    path = str(tmp_path / "emb.npz")
+    texts = ["a", "b", "a"]
+    first = encode_with_cache(encoder, texts, "m", cache_path=path, verbose=False)
+    assert encoder.encoded == ["a", "b"]
+    np.testing.assert_allclose(first, encoder.encode(texts, normalize_embeddings=True))
+
+    encoder.encoded.clear()
+    again = encode_with_cache(encoder, texts + ["c"], "m", cache_path=path, verbose=False)
+    assert encoder.encoded == ["c"]
+    np.testing.assert_allclose(again[:3], first)
+
+
+def test_save_leaves_no_temp_files(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "emb.npz"))
+    cache.put("k", np.ones(4))
+    cache.save()
+    assert os.listdir(tmp_path) == ["emb.npz"]
+    assert np.array_equal(EmbeddingCache(str(tmp_path / "emb.npz")).get("k"), np.ones(4))
+
+
+def test_lru_eviction(tmp_path, encoder):
+    path = str(tmp_path / "emb.npz")
+    cache = EmbeddingCache(path, max_entries=2)
+    cache.put("a", np.zeros(2))
+    cache.put("b", np.zeros(2))
+    cache.get("a")            # a を使ったので b が一番古い
+    cache.put("c", np.zeros(2))
+    assert "a" in cache and "c" in cache and "b" not in cache
+
+    # 上限より多い文章を一度に encode しても結果は全部返る
+    out = encode_with_cache(encoder, ["x", "y", "z"], "m", verbose=False,
+                            cache=EmbeddingCache(path, max_entries=1))
+    assert out.shape == (3, encoder.dim)
@@ -0,0 +1,86 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from conftest import random_unit
+from embedding_matrix import load_matrix, open_matrix, read_meta, save_matrix
+from product_store import ProductStore
+
+
+def data_file(path):
+    meta = read_meta(path)
+    return os.path.join(path, meta["data_dir"], "data.npy")
+
+
+def test_open_matrix_only_builds_when_stale(tmp_path):
+    path = str(tmp_path / "m")
+    x = random_unit(50, 8)
+    calls = []
+
+    def build():
+        calls.append(1)
+        return x
+
+    m1 = open_matrix(path, build, dtype="float16", key="a")
+    inode = os.stat(data_file(path)).st_ino
+    m2 = open_matrix(path, build, dtype="float16", key="a")
+    assert len(calls) == 1
+    assert os.stat(data_file(path)).st_ino == inode   # 書き直していない → 同じファイルを mmap
+    np.testing.assert_array_equal(m1.data, m2.data)
+
+    open_matrix(path, build, dtype="float16", key="b")
+    open_matrix(path, build, dtype="float16", key="b", version=1)
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_save_writes_a_new_data_dir_and_keeps_the_previous(tmp_path, dtype):
+    path = str(tmp_path / "m")
+    x = random_unit(20, 8)
+    save_matrix(path, x, dtype=dtype, version=1)
+    first = read_meta(path)["data_dir"]
+    save_matrix(path, x * 0.5, dtype=dtype, version=2)
+    second = read_meta(path)["data_dir"]
+    save_matrix(path, x, dtype=dtype, version=3)
+    assert first != second
+    dirs = {d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))}
+    assert first not in dirs and second in dirs and len(dirs) == 2
+
+    m = load_matrix(path)
+    assert m.version == 3
+    np.testing.assert_allclose(m.rows(np.arange(20)), x, atol=1e-2)
+    if dtype == "int8":
+        assert os.path.exists(os.path.join(path, m.meta["data_dir"], "scales.npy"))
+
+
+def test_load_format_version_1(tmp_path):
+    x = random_unit(5, 4)
+    np.save(tmp_path / "data.npy", x)
+    with open(tmp_path / "meta.json", "w") as f:
+        json.dump({"format_version": 1, "dtype": "float32", "shape": [5, 4], "version": 0}, f)
+    np.testing.assert_array_equal(load_matrix(str(tmp_path)).data, x)
+
+
+def test_publish_releases_float32_copy(tmp_path, encoder):
+    items = [{"id": i, "name": f"商品{i}"} for i in range(10)]
+    store = ProductStore(encoder, "m", lambda p: p["name"], items, cache_path=None)
+    before = store.scores(store.embeddings[0].astype(np.float32))
+    path = str(tmp_path / "products")
+    store.publish(path, dtype="float16")
+    assert store._emb is None and store.embeddings.dtype == np.float16
+    np.testing.assert_allclose(store.scores(np.asarray(store.embeddings[0], np.float32)),
+                               before, atol=2e-3)
+
+    # 同じ内容なら他のプロセスの publish は書き直さない
+    inode = os.stat(data_file(path)).st_ino
+    other = ProductStore(encoder, "m", lambda p: p["name"], items, cache_path=None)
+    other.publish(path, dtype="float16")
+    assert os.stat(data_file(path)).st_ino == inode
+
+    # 更新すると float32 の行列を mmap から作り直す
+    store.upsert([{"id": 3, "name": "新しい名前"}, {"id": 20, "name": "追加"}])
+    assert store._emb is not None and store.n_rows == 11
+    np.testing.assert_allclose(store.embeddings[3],
+                               encoder.encode("新しい名前", normalize_embeddings=True))
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from encode_service import BatchingEncoder
+from query_cache import QueryEmbeddingCache
+
+
+def test_requests_are_batched(encoder):
+    async def run():
+        async with BatchingEncoder(encoder, max_batch_size=8, max_wait_ms=50.0) as service:
+            embs = await service.encode_many([f"q{i}" for i in range(8)])
+        return embs, service.stats()
+
+    embs, stats = asyncio.run(run())
+    np.testing.assert_allclose(
+        embs, encoder.encode([f"q{i}" for i in range(8)], normalize_embeddings=True), rtol=1e-6)
+    assert stats["batch_size_hist"] == {8: 1}
+
+
+def test_encode_before_start_raises(encoder):
+    with pytest.raises(RuntimeError, match="not running"):
+        asyncio.run(BatchingEncoder(encoder).encode("a"))
+
+
+def test_stop_fails_pending_requests():
+    release = threading.Event()
+
+    class SlowEncoder:
+        def encode(self, texts, **kwargs):
+            release.wait(5)
+            return np.zeros((len(texts), 4), dtype=np.float32)
+
+    async def run():
+        service = await BatchingEncoder(SlowEncoder(), max_batch_size=1, max_wait_ms=0.0).start()
+        tasks = [asyncio.create_task(service.encode(t)) for t in ("a", "b", "c")]
+        await asyncio.sleep(0.05)  # "a" が encode 中、"b" / "c" はキューの中
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, release.set)
+        await service.stop()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) and "service stopped" in str(r) for r in results)
+
+
+def test_query_cache_async_goes_through_service(encoder):
+    cache = QueryEmbeddingCache(encoder)
+
+    async def run():
+        async with BatchingEncoder(encoder, max_wait_ms=50.0) as service:
+            embs = await asyncio.gather(*(cache.aencode(t, service) for t in ("寄せ鍋", "豚汁")))
+            again = await cache.aencode("寄せ鍋", service)
+        return embs, again, service.stats()
+
+    embs, again, stats = asyncio.run(run())
+    assert stats["batch_size_hist"] == {2: 1}
+    np.testing.assert_allclose(again, embs[0])
+    assert cache.stats()["hits"] == 1
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from conftest import random_unit
+from embedding_matrix import load_matrix, save_matrix
+from filtered_index import build_partitioned_index
+
+
+def brute_force(embeddings, labels, query, k, wanted, exclude=None):
+    scores = np.asarray(embeddings, dtype=np.float32) @ query
+    ok = np.isin(labels, list(wanted))
+    if exclude is not None:
+        ok &= ~exclude
+    scores[~ok] = -np.inf
+    top = np.argsort(-scores, kind="stable")[:k]
+    return top[scores[top] > -np.inf]
+
+
+@pytest.mark.parametrize("backend", ["exact", "hnsw"])
+@pytest.mark.parametrize("wanted", [["rare"], ["a", "b"]])
+def test_matches_brute_force(backend, wanted):
+    rng = np.random.default_rng(0)
+    embeddings = random_unit(600, 16)
+    labels = rng.choice(["a", "b", "c"], 600)
+    labels[rng.choice(600, 12, replace=False)] = "rare"
+    index = build_partitioned_index(backend, embeddings, labels, ef=600)
+    exclude = np.zeros(600, dtype=bool)
+    exclude[::7] = True
+
+    for q in random_unit(5, 16, seed=1):
+        ids, scores = index.search(q, 5, labels=wanted, exclude=exclude)
+        np.testing.assert_array_equal(ids, brute_force(embeddings, labels, q, 5, wanted, exclude))
+        np.testing.assert_allclose(scores, embeddings[ids] @ q, rtol=1e-5)
+    assert sum(index.plan_counts.values()) == 5
+
+
+@pytest.mark.parametrize("backend", ["exact", "hnsw"])
+def test_plan_by_estimated_cost(backend):
+    rng = np.random.default_rng(0)
+    embeddings = random_unit(8000, 16)
+    labels = np.where(rng.random(8000) < 0.5, "big", "small")
+    labels[rng.choice(8000, 100, replace=False)] = "rare"
+    index = build_partitioned_index(backend, embeddings, labels)
+
+    # exact は全体を引くと常に全件なので行番号リスト。hnsw は ef=50, M=16 で 1 クエリ 1600 内積なので
+    # 半分（約 4000 行）のラベルは全体 + 除外マスク、100 行のラベルは行番号リスト
+    assert index.plan(["rare"], 10) == "partition"
+    assert index.plan(["nothing"], 10) == "partition"
+    assert index.plan(["big"], 10) == ("partition" if backend == "exact" else "predicate")
+
+    hits = 0
+    for q in random_unit(20, 16, seed=1):
+        for wanted in (["rare"], ["big"]):
+            ids, _ = index.search(q, 10, labels=wanted)
+            expected = brute_force(embeddings, labels, q, 10, wanted)
+            assert set(labels[ids]) <= set(wanted)
+            if index.plan(wanted, 10) == "partition":
+                np.testing.assert_array_equal(ids, expected)
+            else:
+                hits += len(set(ids) & set(expected))
+    if backend == "hnsw":
+        assert index.plan_counts["predicate"] == 20
+        assert hits >= 0.9 * 20 * 10
+
+
+def test_partitions_share_the_mapped_matrix(tmp_path):
+    path = str(tmp_path / "m")
+    embeddings = random_unit(100, 8)
+    save_matrix(path, embeddings, dtype="float16")
+    matrix = load_matrix(path)
+    labels = ["x"] * 5 + ["y"] * 95
+    index = build_partitioned_index("exact", matrix, labels)
+    assert index.embeddings is matrix
+    assert all(rows.dtype == np.intp for rows in index.partitions.values())
+    ids, _ = index.search(embeddings[3], 2, labels=["x"])
+    assert ids[0] == 3 and set(ids) <= set(range(5))
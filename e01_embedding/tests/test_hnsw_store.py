@@ -0,0 +1,19 @@
+from conftest import random_unit
+from hnsw_store import load_hnsw, open_hnsw_index
+
+
+def test_reload_grow_and_version(tmp_path, capsys):
+    path = str(tmp_path / "hnsw")
+    x = random_unit(60, 8)
+    open_hnsw_index(path, x[:50], version=1)
+    assert "built" in capsys.readouterr().out
+
+    index = open_hnsw_index(path, x, version=1)
+    assert "loaded + added 10" in capsys.readouterr().out
+    assert index.get_current_count() == 60
+
+    # 中身が同じでもカタログのバージョンが違えば読み込まない
+    assert load_hnsw(path, x, version=2) is None
+    open_hnsw_index(path, x, version=2)
+    assert "built" in capsys.readouterr().out
+    assert load_hnsw(path, x, version=2) is not None
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from kv_batch import batch_analogy, batch_most_similar, batch_similarity, key_ids
+
+gensim_models = pytest.importorskip("gensim.models")
+
+
+@pytest.fixture
+def kv():
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(300)]
+    kv = gensim_models.KeyedVectors(vector_size=12)
+    kv.add_vectors(words, rng.standard_normal((300, 12)).astype(np.float32))
+    return kv
+
+
+def test_batch_similarity_matches_kv_similarity(kv):
+    w1 = ["w0", "w5", "w7", "unknown"]
+    w2 = ["w1", "w5", "w299", "w3"]
+    sims = batch_similarity(kv.get_normed_vectors(), key_ids(kv, w1), key_ids(kv, w2))
+    np.testing.assert_allclose(sims[:3], [kv.similarity(a, b) for a, b in zip(w1[:3], w2[:3])],
+                               rtol=1e-5)
+    assert np.isnan(sims[3])
+
+
+def test_batch_most_similar_matches_kv(kv):
+    words = ["w0", "w42", "w299"]
+    ids = key_ids(kv, words)
+    # ブロックを小さくして、ブロックをまたいだ上位のマージも通す
+    out_ids, out_scores = batch_most_similar(
+        kv.get_normed_vectors(), kv.get_normed_vectors()[ids], topn=8,
+        exclude_ids=ids[:, None], block_queries=2, block_vocab=64)
+    for word, row_ids, row_scores in zip(words, out_ids, out_scores):
+        expected = kv.most_similar(word, topn=8)
+        assert [kv.index_to_key[i] for i in row_ids] == [w for w, _ in expected]
+        np.testing.assert_allclose(row_scores, [s for _, s in expected], rtol=1e-5)
+
+
+def test_batch_analogy_matches_kv(kv):
+    problems = [("w1", "w2", "w3"), ("w10", "w200", "w30"), ("w7", "w8", "unknown"),
+                ("w50", "w60", "w299")]
+    a, b, c = (key_ids(kv, words) for words in zip(*problems))
+    out_ids, out_scores = batch_analogy(kv.get_normed_vectors(), a, b, c, topn=5,
+                                        block_queries=3, block_vocab=100)
+    for (wa, wb, wc), row_ids, row_scores in zip(problems, out_ids, out_scores):
+        if "unknown" in (wa, wb, wc):
+            assert (row_ids == -1).all()
+            continue
+        expected = kv.most_similar(positive=[wb, wc], negative=[wa], topn=5)
+        assert [kv.index_to_key[i] for i in row_ids] == [w for w, _ in expected]
+        np.testing.assert_allclose(row_scores, [s for _, s in expected], rtol=1e-5)
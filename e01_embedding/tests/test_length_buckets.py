@@ -0,0 +1,53 @@
+import numpy as np
+
+from conftest import FakeEncoder
+from length_buckets import encode_bucketed, truncate_fields
+
+
+class RecordingEncoder(FakeEncoder):
+    """encode に渡されたバッチサイズも記録する"""
+
+    def __init__(self, dim=16):
+        super().__init__(dim)
+        self.batch_sizes = []
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False, **kwargs):
+        self.batch_sizes.append(batch_size)
+        return super().encode(texts, batch_size, normalize_embeddings, **kwargs)
+
+
+def test_encode_bucketed_matches_encode_row_for_row():
+    rng = np.random.default_rng(0)
+    texts = ["鍋" * int(n) for n in rng.integers(1, 200, 300)] + ["", "寄せ鍋", "寄せ鍋"]
+    rng.shuffle(texts)
+    model = RecordingEncoder()
+
+    out = encode_bucketed(model, texts, boundaries=(8, 32, 128), token_budget=512)
+    expected = FakeEncoder().encode(texts, normalize_embeddings=True)
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out, expected)
+    # 長さでバケットが分かれて、長いバケットほどバッチサイズが小さい
+    assert len(model.batch_sizes) == 4
+    assert model.batch_sizes == sorted(model.batch_sizes, reverse=True)
+
+    empty = encode_bucketed(model, [])
+    assert empty.shape == (0, 16)
+
+
+def test_truncate_fields_cuts_each_field_and_keeps_whole_tags():
+    record = {
+        "id": "p1",
+        "name": "特選" * 30,
+        "tags": ["鍋", "冬", "ポン酢", "しめじ", "白菜"],
+        "description": "説明",
+        "price": 398,
+    }
+    out = truncate_fields(record, budgets={"name": 10, "tags": 6, "description": 10})
+
+    assert out["name"] == ("特選" * 30)[:10]
+    # 1 + 1 + 3 = 5 文字までは入る。次の "しめじ" で 8 > 6 になるので、そこから先は捨てる
+    assert out["tags"] == ["鍋", "冬", "ポン酢"]
+    assert out["description"] == "説明"
+    assert out["id"] == "p1" and out["price"] == 398
+    # 元の record は書き換えない
+    assert len(record["name"]) == 60 and len(record["tags"]) == 5
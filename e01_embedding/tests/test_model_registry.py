@@ -0,0 +1,25 @@
+import model_registry
+from conftest import FakeEncoder
+
+
+def test_lazy_model_resolves_once(monkeypatch):
+    loads = []
+
+    def fake_load_encoder(model_name, backend="torch", verbose=True, threads=None):
+        loads.append((model_name, backend))
+        return FakeEncoder()
+
+    monkeypatch.setattr(model_registry, "load_encoder", fake_load_encoder)
+    model_registry.clear()
+    try:
+        model = model_registry.lazy_model("fake-model")
+        assert not model.loaded and loads == []
+
+        for _ in range(3):
+            model.encode(["寄せ鍋"], normalize_embeddings=True)
+        assert model.get_sentence_embedding_dimension() == 16
+        assert model.loaded and loads == [("fake-model", "torch")]
+        # 最初の 1 回だけ get_model を通る（あとは代理オブジェクトが持っているモデルを使う）
+        assert model_registry.load_stats()[0]["uses"] == 1
+    finally:
+        model_registry.clear()
@@ -0,0 +1,71 @@
+import numpy as np
+
+from conftest import random_unit
+from neighbor_table import NeighborTable
+from product_store import ProductStore
+
+
+def brute_force(emb, alive, n_neighbors):
+    scores = emb @ emb.T
+    scores[:, ~alive] = -np.inf
+    np.fill_diagonal(scores, -np.inf)
+    return np.argsort(-scores, axis=1, kind="stable")[:, :n_neighbors]
+
+
+def test_blocked_build_matches_brute_force():
+    emb = random_unit(300, 8, seed=1)
+    alive = np.ones(300, dtype=bool)
+    alive[[5, 77]] = False
+    # 行も列も細かく分けてもマージの結果は全件計算と同じ
+    table = NeighborTable(n_neighbors=7, block_size=32, col_block_size=50)
+    table.build(emb, alive)
+    expected = brute_force(emb, alive, 7)
+    for row in np.flatnonzero(alive):
+        np.testing.assert_array_equal(table.lookup(row)[0], expected[row])
+    assert (table.neighbors[[5, 77]] == -1).all()
+
+
+def test_build_accepts_float16_rows():
+    emb = random_unit(100, 8, seed=2)
+    table = NeighborTable(n_neighbors=5, block_size=16, col_block_size=40)
+    table.build(emb.astype(np.float16))
+    nbrs, scores = table.lookup(0)
+    assert len(nbrs) == 5 and 0 not in nbrs
+    assert np.all(np.diff(scores) <= 1e-3)
+
+
+def test_refresh_matches_rebuild():
+    emb = random_unit(200, 8, seed=3)
+    alive = np.ones(200, dtype=bool)
+    table = NeighborTable(n_neighbors=5, block_size=64, col_block_size=64)
+    table.build(emb, alive)
+
+    emb[[3, 50]] = random_unit(2, 8, seed=4)
+    alive[10] = False
+    table.refresh(emb, alive, {3, 10, 50})
+    fresh = NeighborTable(n_neighbors=5)
+    fresh.build(emb, alive)
+    np.testing.assert_array_equal(table.neighbors, fresh.neighbors)
+
+
+def test_save_load_checks_the_catalog(tmp_path, encoder):
+    def make_store(names):
+        return ProductStore(encoder, "m", lambda p: p["name"],
+                            [{"id": i, "name": n} for i, n in enumerate(names)], cache_path=None)
+
+    path = str(tmp_path / "neighbors.npz")
+    store = make_store([f"p{i}" for i in range(30)])
+    assert NeighborTable.load(path, store) is None
+    table = NeighborTable(n_neighbors=4)
+    table.sync(store)
+    table.save(path, store)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["neighbors.npz"]
+
+    # 別のプロセスで同じカタログを作り直したストア（version は同じでも別物）→ 読める
+    loaded = NeighborTable.load(path, make_store([f"p{i}" for i in range(30)]))
+    np.testing.assert_array_equal(loaded.neighbors, table.neighbors)
+    # version が同じでも中身が違うカタログ / 更新後のカタログは読まない
+    other = make_store([f"q{i}" for i in range(30)])
+    assert other.version == store.version and NeighborTable.load(path, other) is None
+    store.upsert([{"id": 3, "name": "changed"}])
+    assert NeighborTable.load(path, store) is None
@@ -0,0 +1,63 @@
+import numpy as np
+
+from ann_index import build_index
+from embedding_matrix import load_matrix, save_matrix
+from projection import Projection, load_projection, projection_path, save_projection
+from quantized_index import PCAIndex
+
+
+def low_rank_unit(n, dim=32, rank=6, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((n, rank)) @ rng.standard_normal((rank, dim))
+    x += 0.05 * rng.standard_normal((n, dim))
+    x = x.astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_small_adds_are_searched_exactly_until_trained():
+    embeddings = low_rank_unit(40)
+    index = PCAIndex(32, max_elements=4, n_components=8)
+    index.add_items(embeddings[:1])
+    index.add_items(embeddings[1:10])
+    assert not index.trained
+    ids, _ = index.search(embeddings[5], 1)
+    assert ids[0] == 5
+
+    index.add_items(embeddings[10:])  # 40 行 >= 4 * 8 で学習
+    assert index.trained and index.projection.n_components == 8
+    ids, _ = index.search(embeddings[5], 1)
+    assert ids[0] == 5
+
+
+def test_recall_against_exact():
+    embeddings = low_rank_unit(2000)
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.choice(2000, 30, replace=False)]
+    truth, _ = build_index("exact", embeddings).search_batch(queries, 10)
+    found, _ = build_index("pca", embeddings, n_components=8, n_candidates=50).search_batch(
+        queries, 10)
+    assert np.mean([len(set(f) & set(t)) / 10 for f, t in zip(found, truth)]) >= 0.9
+
+
+def test_build_index_reuses_saved_projection(tmp_path, capsys):
+    path = str(tmp_path / "m")
+    save_matrix(path, low_rank_unit(300), dtype="float32", version=3)
+    first = build_index("pca", load_matrix(path), n_components=8)
+    assert "fitted" in capsys.readouterr().out
+    second = build_index("pca", load_matrix(path), n_components=8)
+    assert "loaded" in capsys.readouterr().out
+    np.testing.assert_array_equal(first.projection.components, second.projection.components)
+
+    # 行列を書き直したら（同じ version / shape でも）学習し直す
+    save_matrix(path, low_rank_unit(300, seed=5), dtype="float32", version=3)
+    build_index("pca", load_matrix(path), n_components=8)
+    assert "fitted" in capsys.readouterr().out
+
+
+def test_projection_without_explained_variance_round_trips(tmp_path):
+    path = projection_path(str(tmp_path), 4)
+    save_projection(path, Projection(np.zeros(8), np.eye(4, 8)), version=1, shape=(10, 8))
+    loaded = load_projection(path, version=1, shape=(10, 8))
+    assert loaded.explained_variance_ratio is None
+    assert np.load(path)["explained_variance_ratio"].dtype == np.float64
+    assert load_projection(path, version=2, shape=(10, 8)) is None
@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pytest
+
+from ann_index import index_factory
+from product_store import ProductStore
+
+
+def text(p):
+    return f"{p['name']}。{p.get('description', '')}"
+
+
+def products(n):
+    return [{"id": i, "name": f"商品{i}", "description": f"説明{i}"} for i in range(n)]
+
+
+def make_store(encoder, tmp_path, items, **kwargs):
+    return ProductStore(encoder, "m", text, items, cache_path=str(tmp_path / "emb.npz"),
+                        **kwargs)
+
+
+def test_upsert_encodes_only_changed_text(tmp_path, encoder):
+    store = make_store(encoder, tmp_path, products(5))
+    encoder.encoded.clear()
+    rows = store.upsert([{"id": 1, "name": "商品1", "description": "説明1", "price": 100},
+                         {"id": 2, "name": "商品2", "description": "新しい説明"},
+                         {"id": 9, "name": "商品9"}])
+    assert rows == [2, 5]
+    assert encoder.encoded == ["商品2。新しい説明", "商品9。"]
+    np.testing.assert_allclose(store.embeddings[2],
+                               encoder.encode("商品2。新しい説明", normalize_embeddings=True))
+
+
+def test_upsert_does_not_write_cache_until_flush(tmp_path, encoder):
+    store = make_store(encoder, tmp_path, products(3))
+    before = os.stat(tmp_path / "emb.npz").st_mtime_ns
+    store.upsert([{"id": 7, "name": "追加"}])
+    assert os.stat(tmp_path / "emb.npz").st_mtime_ns == before
+    store.flush()
+    assert os.stat(tmp_path / "emb.npz").st_mtime_ns != before
+
+
+def test_delete_then_compact_remaps_rows(tmp_path, encoder):
+    store = make_store(encoder, tmp_path, products(6), compact_ratio=1.0)
+    expected = {p["id"]: store.embeddings[store.id_to_row[p["id"]]].copy()
+                for p in products(6)}
+    store.delete([1, 3])
+    assert len(store) == 4 and store.n_rows == 6
+    assert np.isinf(store.scores(store.embeddings[0])[[1, 3]]).all()
+
+    store.compact()
+    assert store.n_rows == 4
+    assert [p["id"] for p in store.products] == [0, 2, 4, 5]
+    for pid, row in store.id_to_row.items():
+        np.testing.assert_array_equal(store.embeddings[row], expected[pid])
+        assert row in store.name_to_rows[f"商品{pid}"]
+    assert store.changed_rows_since(0) is None
+
+    # 詰めたあとの検索結果も id で見れば同じ
+    rows, _ = store.search(expected[4], 1)
+    assert store.products[rows[0]]["id"] == 4
+
+
+def test_failed_encode_leaves_store_unchanged(tmp_path, encoder):
+    store = make_store(encoder, tmp_path, products(3))
+    before = (list(store.products), list(store.texts), dict(store.id_to_row),
+              {k: set(v) for k, v in store.name_to_rows.items()}, store.embeddings.copy(),
+              store.version)
+
+    def broken_encode(texts, **kwargs):
+        raise RuntimeError("encoder down")
+
+    store.model.encode = broken_encode
+    with pytest.raises(RuntimeError, match="encoder down"):
+        store.upsert([{"id": 1, "name": "改名", "description": "新しい説明"},
+                      {"id": 7, "name": "追加"}])
+
+    assert (store.products, store.texts, store.id_to_row, store.name_to_rows) == before[:4]
+    np.testing.assert_array_equal(store.embeddings, before[4])
+    assert store.version == before[5] and store.n_rows == 3 and len(store) == 3
+
+
+def test_scores_keep_using_published_matrix_after_upsert(tmp_path, encoder):
+    store = make_store(encoder, tmp_path, products(8))
+    store.publish(str(tmp_path / "matrix"), dtype="float16")
+    version = store.version
+
+    # 何も変わらない upsert / 無い id の delete では version は上がらない
+    store.upsert(products(8)[:2])
+    store.delete([99])
+    assert store.version == version
+    # 文章に出ない項目だけの変更は version を上げるが、embedding の差分には入らない
+    store.upsert([dict(products(8)[3], price=100)])
+    assert store.changed_rows_since(version) == set()
+    assert store.changed_rows_since(version, products=True) == {3}
+
+    store.upsert([{"id": 2, "name": "商品2", "description": "新しい説明"}, {"id": 20, "name": "追加"}])
+    store.delete([5])
+    q = encoder.encode("商品2。新しい説明", normalize_embeddings=True)
+    scores = store.scores(q)
+    # mmap の行列はそのまま使い、書き換えた行 / 追加した行だけ重ねる
+    assert store._matrix is not None and store._dirty == {2, 8}
+    expected = store.embeddings @ q
+    expected[5] = -np.inf
+    np.testing.assert_allclose(scores, expected, atol=1e-3)
+    assert store.search(q, 1)[0][0] == 2
+
+
+def test_pca_index_on_a_small_catalog(tmp_path, encoder):
+    # min_train_size（4 * 64 = 256 行）より小さいカタログでも attach できて、全件内積で探す
+    store = make_store(encoder, tmp_path, products(20))
+    index = store.attach_index(index_factory("pca"))
+    assert not index.trained
+    q = encoder.encode("商品3。説明3", normalize_embeddings=True)
+    rows, _ = store.search(q, 3)
+    assert list(rows) == list(np.argsort(-(store.embeddings @ q))[:3])
+
+    # 行がたまったら自分で学習する
+    store.upsert(products(300)[20:])
+    assert index.trained
+    assert store.search(q, 1)[0][0] == store.id_to_row[3]
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from ann_index import build_index
+from conftest import random_unit
+from quantized_index import Int8Index, PQIndex
+
+
+def recall(index, embeddings, queries, k=10):
+    truth, _ = build_index("exact", embeddings).search_batch(queries, k)
+    found, _ = index.search_batch(queries, k)
+    return np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+
+
+def noisy_queries(embeddings, n=30, seed=1):
+    rng = np.random.default_rng(seed)
+    q = embeddings[rng.choice(len(embeddings), n, replace=False)]
+    q = q + 0.1 * rng.standard_normal(q.shape).astype(np.float32)
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("backend, params", [
+    ("int8", {}),
+    ("pq", {"n_subspaces": 8, "n_centroids": 64}),
+])
+def test_recall_against_exact(backend, params):
+    embeddings = random_unit(2000, 32)
+    index = build_index(backend, embeddings, n_candidates=100, **params)
+    assert recall(index, embeddings, noisy_queries(embeddings)) >= 0.9
+
+
+def test_int8_add_items_without_training():
+    embeddings = random_unit(500, 32)
+    index = Int8Index(32, max_elements=10)
+    index.add_items(embeddings)
+    assert recall(index, embeddings, noisy_queries(embeddings)) >= 0.9
+
+
+def test_pq_requires_training_before_add():
+    index = PQIndex(32, n_subspaces=8, n_centroids=16)
+    with pytest.raises(ValueError, match="not trained"):
+        index.add_items(random_unit(5, 32))
+
+
+def test_pq_training_sample_and_retrain():
+    embeddings = random_unit(1000, 32)
+    # 学習サンプルが偏っていると近似スコアの誤差が大きい
+    index = PQIndex(32, max_elements=1000, n_subspaces=8, n_centroids=64, n_candidates=30,
+                    training_sample=embeddings[:70])
+    index.add_items(embeddings)
+    queries = noisy_queries(embeddings)
+    before = recall(index, embeddings, queries)
+
+    index.retrain()
+    assert index.codebooks.shape == (8, 64, 4)
+    after = recall(index, embeddings, queries)
+    assert after >= 0.9
+    assert after >= before
+    # 削除済みの行は retrain の後も出てこない
+    index.mark_deleted(int(index.search(queries[0], 1)[0][0]))
+    index.retrain()
+    assert len(index) == 999
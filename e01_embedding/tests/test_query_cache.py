@@ -0,0 +1,52 @@
+import numpy as np
+
+from conftest import FakeEncoder
+from query_cache import QueryEmbeddingCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_evicts_least_recently_used(encoder):
+    cache = QueryEmbeddingCache(encoder, maxsize=2)
+    a = cache.encode("寄せ鍋")
+    cache.encode("キムチ鍋")
+    cache.encode("寄せ鍋")    # 使ったので キムチ鍋 の方が古くなる
+    cache.encode("豆乳鍋")    # キムチ鍋 が捨てられる
+    assert cache.evictions == 1 and len(cache) == 2
+
+    encoder.encoded.clear()
+    np.testing.assert_array_equal(cache.encode("寄せ鍋"), a)
+    cache.encode("豆乳鍋")
+    assert encoder.encoded == []
+    cache.encode("キムチ鍋")  # 入れ直しで、今度は一番古い 寄せ鍋 が捨てられる
+    assert encoder.encoded == ["キムチ鍋"]
+    encoder.encoded.clear()
+    cache.encode("寄せ鍋")
+    assert encoder.encoded == ["寄せ鍋"]
+    assert cache.evictions == 3
+
+
+def test_ttl_expires_entries(encoder):
+    clock = FakeClock()
+    cache = QueryEmbeddingCache(encoder, ttl=10, clock=clock)
+    expected = FakeEncoder().encode(["寄せ鍋"], normalize_embeddings=True)[0]
+    cache.encode("寄せ鍋")
+
+    clock.now = 10.0  # ちょうど ttl まではまだ使える
+    np.testing.assert_array_equal(cache.encode("　寄せ鍋 "), expected)
+    assert encoder.encoded == ["寄せ鍋"] and cache.hits == 1
+
+    clock.now = 10.5  # 作成から ttl を超えたら（途中で使われていても）encode し直す
+    np.testing.assert_array_equal(cache.encode("寄せ鍋"), expected)
+    assert encoder.encoded == ["寄せ鍋", "寄せ鍋"]
+    assert cache.stats()["misses"] == 2 and len(cache) == 1
+
+    clock.now = 15.0  # 入れ直した時刻から数える
+    cache.encode("寄せ鍋")
+    assert len(encoder.encoded) == 2
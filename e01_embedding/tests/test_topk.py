@@ -0,0 +1,44 @@
+import numpy as np
+
+from topk import top_k_indices, top_k_rows
+
+
+def naive_top_k(scores, k, keep):
+    order = np.argsort(-scores, kind="stable")
+    return [i for i in order if keep[i] and scores[i] > -np.inf][:k]
+
+
+def accept(i):
+    return i % 3 != 0
+
+
+def test_top_k_indices_matches_full_sort_with_exclusion():
+    rng = np.random.default_rng(0)
+    scores = rng.standard_normal(500)
+    scores[rng.choice(500, 20, replace=False)] = -np.inf
+    # 上位の大半を除外して、候補の取り直しが起きるようにする
+    exclude = np.zeros(500, dtype=bool)
+    exclude[np.argsort(-scores)[:40]] = True
+
+    for k in (1, 10, 100):
+        assert list(top_k_indices(scores, k)) == naive_top_k(scores, k, np.ones(500, bool))
+        keep = ~exclude & np.array([accept(i) for i in range(500)])
+        assert list(top_k_indices(scores, k, exclude=exclude, accept=accept)) == \
+            naive_top_k(scores, k, keep)
+
+
+def test_top_k_indices_short_and_empty():
+    scores = np.array([0.1, 0.5, -np.inf, 0.3])
+    assert list(top_k_indices(scores, 10)) == [1, 3, 0]
+    assert list(top_k_indices(scores, 10, exclude=np.array([True, True, True, True]))) == []
+    assert len(top_k_indices(scores, 0)) == 0
+    assert len(top_k_indices(np.empty(0), 3)) == 0
+
+
+def test_top_k_rows_matches_argsort():
+    scores = np.random.default_rng(1).standard_normal((7, 50))
+    scores[:, 5] = -np.inf  # 除外した列
+    top = top_k_rows(scores, 5)
+    np.testing.assert_array_equal(top, np.argsort(-scores, axis=1, kind="stable")[:, :5])
+    assert not (top == 5).any()
+    assert top_k_rows(scores[:, :3], 10).shape == (7, 3)
@@ -0,0 +1,45 @@
+import numpy as np
+
+from conftest import random_unit
+from vocab_tiers import VocabTiers
+
+
+def brute_force(normed, query, n_vocab, topn, exclude=()):
+    scores = normed[:n_vocab] @ (query / np.linalg.norm(query))
+    scores[[i for i in exclude if 0 <= i < n_vocab]] = -np.inf
+    return np.argsort(-scores, kind="stable")[:topn]
+
+
+def test_neighbors_come_from_the_requested_tier():
+    normed = random_unit(500, 8)
+    tiers = VocabTiers(normed, tiers={"hot": 50, "warm": 200})
+    assert tiers.tiers == {"hot": 50, "warm": 200, "full": 500}
+    assert tiers.matrix(50) is tiers.resident and tiers.matrix(200) is normed
+
+    queries = random_unit(12, 8, seed=1)
+    restrict = ["hot", "warm", "full", None, 30, 1000] * 2
+    sizes = [50, 200, 500, 50, 30, 500] * 2
+    ids, scores = tiers.most_similar(queries, topn=5, restrict_vocab=restrict,
+                                     block_vocab=64)
+    for q, row, n_vocab in zip(queries, ids, sizes):
+        assert (row < n_vocab).all()
+        np.testing.assert_array_equal(row, brute_force(normed, q, n_vocab, 5))
+
+    # 全クエリ共通の段 + 除外
+    words = np.array([3, 40, 120])
+    ids, _ = tiers.most_similar(normed[words], topn=4, restrict_vocab="hot",
+                                exclude_ids=words[:, None])
+    assert (ids < 50).all() and not (ids == words[:, None]).any()
+    for w, row in zip(words, ids):
+        np.testing.assert_array_equal(row, brute_force(normed, normed[w], 50, 4, exclude=[w]))
+
+
+def test_analogy_inputs_outside_the_tier():
+    normed = random_unit(500, 8)
+    tiers = VocabTiers(normed, tiers={"hot": 50})
+    # 入力の単語は段の外（全語彙）からも引ける。答えは段の中だけ
+    a, b, c = np.array([1, 300]), np.array([2, 400]), np.array([3, -1])
+    ids, _ = tiers.analogy(a, b, c, topn=5, restrict_vocab="hot")
+    query = normed[2] - normed[1] + normed[3]
+    np.testing.assert_array_equal(ids[0], brute_force(normed, query, 50, 5, exclude=[1, 2, 3]))
+    assert (ids[1] == -1).all()
@@ -0,0 +1,64 @@
+# =====================================
+# 部分ソートによる top-k 選択
+# =====================================
+# np.argsort(scores)[::-1] は O(n log n) で全件を並べるが、欲しいのは上位 k 件だけ。
+# argpartition で上位候補を O(n) で取り出し、その中だけをソートする（O(n + k log k)）。
+# 除外（カート・自分自身など）は bool マスク、ジャンルなどの条件は accept 関数で渡す。
+# 除外で候補が足りなくなったら、取り出す件数を増やしてやり直す。
+import numpy as np
+
+
+def _top_idx(scores, kk):
+    """scores の上位 kk 件の index をスコア降順で返す"""
+    n = len(scores)
+    if kk >= n:
+        idx = np.arange(n)
+    else:
+        idx = np.argpartition(-scores, kk - 1)[:kk]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def top_k_indices(scores, k, exclude=None, accept=None):
+    """
+    scores : (n,) のスコア
+    k      : 欲しい件数
+    exclude: (n,) の bool マスク。True の行は除外
+    accept : accept(i) -> bool。False の行は除外（候補にだけ呼ばれる）
+    戻り値 : スコア降順の index 配列（最大 k 件, -inf の行は含まない）
+    """
+    scores = np.asarray(scores)
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.intp)
+
+    kk = min(n, k if exclude is None and accept is None else 2 * k)
+    while True:
+        idx = _top_idx(scores, kk)
+        idx = idx[scores[idx] > -np.inf]
+        if exclude is not None:
+            idx = idx[~exclude[idx]]
+        if accept is not None:
+            idx = np.array([i for i in idx if accept(i)], dtype=np.intp)
+        if len(idx) >= k or kk >= n:
+            return idx[:k]
+        kk = min(n, kk * 4)
+
+
+def top_k_rows(scores, k):
+    """
+    (n_queries, n) のスコア行列から、行ごとに上位 k 件の index を返す。
+    除外したい要素は呼び出し側で -inf にしておく（結果に -inf が混ざることがある）
+    戻り値: (n_queries, min(k, n)) の index 配列（各行スコア降順）
+    """
+    scores = np.asarray(scores)
+    m, n = scores.shape
+    k = min(k, n)
+    if k <= 0:
+        return np.empty((m, 0), dtype=np.intp)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(n), (m, n))
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind="stable")
+    return np.take_along_axis(idx, order, axis=1)
@@ -0,0 +1,148 @@
+# =====================================
+# 頻度順の語彙を「段」に分けて近傍探索する
+# =====================================
+# GloVe の語彙は頻度順に並んでいて、役に立つ答えはほとんど上位数万語に入っている。
+# 毎回 40 万語全部と比べる代わりに
+#   tiers = {"hot": 30000, "warm": 100000}  → 先頭から何語までを探すか（"full" は全語彙）
+#   resident="hot" の段 → 連続した float32 の行列としてメモリに持つ
+#   それより大きい段     → mmap の全語彙行列をその都度読む
+# とし、呼び出し側がクエリごとに restrict_vocab（段の名前 or 語数）を選べるようにする。
+#   python vocab_tiers.py    → 評価用のクエリで段ごとの latency と全語彙との結果の違いを出す
+import time
+
+import numpy as np
+
+from kv_batch import analogy_queries, batch_most_similar
+
+DEFAULT_TIERS = {"hot": 30000, "warm": 100000}
+
+
+class VocabTiers:
+    def __init__(self, normed, tiers=None, resident="hot"):
+        """normed: 頻度順に並んだ正規化済みの語彙行列（load_normed_vectors() の mmap など）"""
+        self.normed = normed
+        self.tiers = {name: min(size, len(normed))
+                      for name, size in (DEFAULT_TIERS if tiers is None else tiers).items()}
+        self.tiers["full"] = len(normed)
+        self.default = resident
+        n_resident = self.tiers[resident]
+        self.resident = np.ascontiguousarray(normed[:n_resident], dtype=np.float32)
+
+    def size(self, restrict_vocab):
+        """段の名前 / 語数 / None（resident の段）→ 語数"""
+        if restrict_vocab is None:
+            restrict_vocab = self.default
+        if isinstance(restrict_vocab, str):
+            return self.tiers[restrict_vocab]
+        return min(int(restrict_vocab), len(self.normed))
+
+    def matrix(self, n):
+        """先頭 n 語を探すときに使う行列（メモリ上の段に収まればそちら）"""
+        return self.resident if n <= len(self.resident) else self.normed
+
+    def most_similar(self, queries, topn=10, restrict_vocab=None, exclude_ids=None, **kwargs):
+        """
+        restrict_vocab: 全クエリ共通の値、またはクエリごとの配列（段の名前 / 語数 / None）
+        戻り値は kv_batch.batch_most_similar と同じ (n, topn) の行番号とスコア
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        n = len(queries)
+        if restrict_vocab is None or np.isscalar(restrict_vocab):
+            sizes = np.full(n, self.size(restrict_vocab))
+        else:
+            sizes = np.array([self.size(r) for r in restrict_vocab])
+
+        out_ids = np.full((n, topn), -1, dtype=np.int64)
+        out_scores = np.full((n, topn), -np.inf, dtype=np.float32)
+        # 同じ語数のクエリはまとめて 1 回で探す
+        for size in np.unique(sizes):
+            rows = np.flatnonzero(sizes == size)
+            ex = None if exclude_ids is None else np.asarray(exclude_ids)[rows]
+            out_ids[rows], out_scores[rows] = batch_most_similar(
+                self.matrix(size), queries[rows], topn=topn, exclude_ids=ex,
+                restrict_vocab=int(size), **kwargs)
+        return out_ids, out_scores
+
+    def analogy(self, ids_a, ids_b, ids_c, topn=10, restrict_vocab=None, **kwargs):
+        """kv_batch.batch_analogy の段つき版（入力の単語は全語彙から引く）"""
+        queries, ids, valid = analogy_queries(self.normed, ids_a, ids_b, ids_c)
+        out_ids, out_scores = self.most_similar(queries, topn=topn,
+                                                restrict_vocab=restrict_vocab,
+                                                exclude_ids=ids, **kwargs)
+        out_ids[~valid] = -1
+        out_scores[~valid] = -np.inf
+        return out_ids, out_scores
+
+
+def tier_report(tiers, queries, exclude_ids=None, topn=10, names=None, repeat=3):
+    """
+    段ごとに queries を探したときの latency と、全語彙（"full"）の結果との違い
+      overlap@topn: 上位 topn の重なり / top1_same: 1 位が同じ割合
+    """
+    names = list(tiers.tiers) if names is None else list(names)
+    if "full" not in names:
+        names.append("full")
+
+    results = {}
+    for name in names:
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            ids, _ = tiers.most_similar(queries, topn=topn, restrict_vocab=name,
+                                        exclude_ids=exclude_ids)
+            best = min(best, time.perf_counter() - start)
+        results[name] = (ids, best)
+
+    full_ids, full_sec = results["full"]
+    rows = []
+    for name in names:
+        ids, sec = results[name]
+        overlap = np.mean([len(set(a[a >= 0]) & set(b[b >= 0])) / topn
+                           for a, b in zip(ids, full_ids)])
+        rows.append({
+            "tier": name,
+            "vocab": tiers.tiers[name],
+            "ms/query": sec * 1000.0 / max(len(queries), 1),
+            "speedup": full_sec / max(sec, 1e-12),
+            f"overlap@{topn}": float(overlap),
+            "top1_same": float(np.mean(ids[:, 0] == full_ids[:, 0])),
+        })
+    return rows
+
+
+# =====================================
+# 評価: アナロジー + 単語ごとの近傍
+# =====================================
+EVAL_ANALOGIES = [
+    ("man", "king", "woman"), ("man", "boy", "woman"), ("he", "his", "she"),
+    ("japan", "tokyo", "france"), ("france", "paris", "italy"), ("germany", "berlin", "spain"),
+    ("good", "better", "bad"), ("big", "bigger", "small"), ("walk", "walking", "swim"),
+    ("dollar", "dollars", "child"), ("mouse", "mice", "foot"),
+]
+
+
+def main() -> None:
+    from glove_store import load_glove, load_normed_vectors
+    from kv_batch import key_ids
+    from report import print_report
+
+    name = "glove-wiki-gigaword-100"
+    model = load_glove(name)
+    tiers = VocabTiers(load_normed_vectors(name))
+
+    # アナロジー（入力の 3 語は除外）
+    a, b, c = (key_ids(model, words) for words in zip(*EVAL_ANALOGIES))
+    queries, ids, valid = analogy_queries(tiers.normed, a, b, c)
+    print("\n=== analogies ===")
+    print_report(tier_report(tiers, queries[valid], exclude_ids=ids[valid]))
+
+    # 単語ごとの近傍（頻度 1000〜100000 位からランダムに 2000 語。自分自身は除外）
+    rng = np.random.default_rng(0)
+    words = rng.integers(1000, min(100000, len(model)), 2000)
+    print("\n=== word neighbors ===")
+    print_report(tier_report(tiers, np.asarray(tiers.normed[words]),
+                             exclude_ids=words[:, None]))
+
+
+if __name__ == "__main__":
+    main()
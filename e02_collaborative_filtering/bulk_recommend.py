@@ -0,0 +1,159 @@
+# =====================================
+# 全ユーザー分のおすすめをまとめて出す（日次バッチ用）
+# =====================================
+# user_embeddings を chunk_size 人ずつ hnswlib の knn_query(num_threads=) に渡し、
+#   - 既に interaction のあるアイテムを除外できるように多めに取る
+#     （chunk 内の interaction 数の 99 パーセンタイルぶん。足りなかった人だけ取り直す）
+#   - 結果は chunk ごとにファイルに書き出す（メモリは chunk 1 つぶんだけ）
+# 出力:
+#   out_path が *.parquet → 1 chunk = 1 row group（user_id, items, scores）
+#   それ以外               → out_path/ に user_ids.npy / items.npy / scores.npy
+#                            （npz は追記できないので .npy を open_memmap で書く。np.load(mmap_mode="r") で読める）
+# items が -1 のところは候補が足りなかった枠。scores は 1 - 距離（space="cosine" / "ip" のとき）。
+# space="l2" の MIPS index（mips.py）では to_scores に距離 → スコアの変換を渡す。
+import os
+import time
+
+import numpy as np
+
+
+def recommend_all_users(index, user_embeddings, k, out_path, interactions=None,
+                        user_ids=None, chunk_size=10000, num_threads=-1, to_scores=None,
+                        verbose=True):
+    """
+    index          : アイテムを登録済みの hnswlib.Index（id = アイテム番号）
+    user_embeddings: (num_users, dim)
+    interactions   : (num_users, num_items) の疎行列。ここにあるアイテムは除外する
+    user_ids       : 一部のユーザーだけ出すとき（省略時は全員）
+    to_scores      : to_scores(distances, vectors) → scores。省略時は 1 - 距離
+    """
+    user_ids = np.arange(len(user_embeddings)) if user_ids is None else np.asarray(user_ids)
+    seen = None if interactions is None else interactions.tocsr()
+    writer = _open_writer(out_path, len(user_ids), k)
+
+    start_time = time.perf_counter()
+    try:
+        for start in range(0, len(user_ids), chunk_size):
+            users = user_ids[start:start + chunk_size]
+            items, scores = recommend_chunk(
+                index, np.asarray(user_embeddings[users], dtype=np.float32),
+                k, seen=None if seen is None else seen[users], num_threads=num_threads,
+                to_scores=to_scores)
+            writer.write(start, users, items, scores)
+            if verbose:
+                done = start + len(users)
+                elapsed = time.perf_counter() - start_time
+                print(f"[bulk recommend] {done}/{len(user_ids)} users "
+                      f"({done / max(elapsed, 1e-9):.0f} users/sec)")
+    finally:
+        writer.close()
+
+
+def recommend_chunk(index, vectors, k, seen=None, num_threads=-1, to_scores=None):
+    """
+    vectors の各行について、seen（CSR。行は vectors と対応）のアイテムを除いた上位 k 件
+    戻り値: (n, k) の items（int32, 足りない枠は -1）と scores（float32）
+    """
+    n_items = index.get_current_count()
+    n_seen = np.zeros(len(vectors), dtype=np.int64) if seen is None else np.diff(seen.indptr)
+    if len(vectors) == 0 or n_items == 0:
+        return (np.full((len(vectors), k), -1, dtype=np.int32),
+                np.zeros((len(vectors), k), dtype=np.float32))
+
+    kk = min(n_items, k + int(np.percentile(n_seen, 99)))
+    items, scores, n_valid = _drop_seen(*_knn(index, vectors, kk, num_threads, to_scores), seen, k)
+
+    # 取り直し: 除外で k 件に届かず、まだ取れるアイテムが残っている人
+    need = np.minimum(n_items, k + n_seen)
+    short = np.flatnonzero((n_valid < k) & (need > kk))
+    if len(short):
+        labels, sc = _knn(index, vectors[short], int(need[short].max()), num_threads, to_scores)
+        items[short], scores[short], _ = _drop_seen(labels, sc, seen[short], k)
+    return items, scores
+
+
+def _knn(index, vectors, kk, num_threads, to_scores=None):
+    ef = index.ef
+    index.set_ef(max(ef, kk))  # ef は k 以上でないといけない
+    try:
+        labels, distances = index.knn_query(vectors, k=kk, num_threads=num_threads)
+    finally:
+        index.set_ef(ef)
+    scores = 1.0 - distances if to_scores is None else to_scores(distances, vectors)
+    return labels.astype(np.int64), np.asarray(scores, dtype=np.float32)
+
+
+def _drop_seen(labels, scores, seen, k):
+    """labels から seen の行ごとのアイテムを除き、前から k 件に詰める"""
+    n, kk = labels.shape
+    if kk < k:
+        labels = np.pad(labels, ((0, 0), (0, k - kk)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, k - kk)))
+    excluded = labels < 0
+    if seen is not None:
+        # (行, アイテム) を 1 つの整数にして、まとめて isin で調べる
+        seen_rows = np.repeat(np.arange(n), np.diff(seen.indptr))
+        seen_keys = seen_rows * seen.shape[1] + seen.indices
+        excluded |= np.isin(np.arange(n)[:, None] * seen.shape[1] + labels, seen_keys)
+
+    order = np.argsort(excluded, axis=1, kind="stable")[:, :k]  # 除外されていないものを前に
+    excluded = np.take_along_axis(excluded, order, axis=1)
+    items = np.where(excluded, -1, np.take_along_axis(labels, order, axis=1)).astype(np.int32)
+    scores = np.where(excluded, 0.0, np.take_along_axis(scores, order, axis=1)).astype(np.float32)
+    return items, scores, (~excluded).sum(axis=1)
+
+
+# ---------- 出力 ----------
+def _open_writer(out_path, n_users, k):
+    if out_path.endswith(".parquet"):
+        return _ParquetWriter(out_path, k)
+    return _NpyWriter(out_path, n_users, k)
+
+
+class _NpyWriter:
+    def __init__(self, path, n_users, k):
+        os.makedirs(path, exist_ok=True)
+        open_memmap = np.lib.format.open_memmap
+        self.user_ids = open_memmap(os.path.join(path, "user_ids.npy"), mode="w+",
+                                    dtype=np.int64, shape=(n_users,))
+        self.items = open_memmap(os.path.join(path, "items.npy"), mode="w+",
+                                 dtype=np.int32, shape=(n_users, k))
+        self.scores = open_memmap(os.path.join(path, "scores.npy"), mode="w+",
+                                  dtype=np.float32, shape=(n_users, k))
+
+    def write(self, start, users, items, scores):
+        end = start + len(users)
+        self.user_ids[start:end] = users
+        self.items[start:end] = items
+        self.scores[start:end] = scores
+
+    def close(self):
+        for array in (self.user_ids, self.items, self.scores):
+            array.flush()
+
+
+class _ParquetWriter:
+    def __init__(self, path, k):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.k = k
+        self.schema = pa.schema([
+            ("user_id", pa.int64()),
+            ("items", pa.list_(pa.int32(), k)),
+            ("scores", pa.list_(pa.float32(), k)),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, start, users, items, scores):
+        pa = self.pa
+        table = pa.Table.from_arrays([
+            pa.array(np.asarray(users, dtype=np.int64)),
+            pa.FixedSizeListArray.from_arrays(pa.array(items.ravel()), self.k),
+            pa.FixedSizeListArray.from_arrays(pa.array(scores.ravel()), self.k),
+        ], schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
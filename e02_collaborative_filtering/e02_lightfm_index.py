@@ -1,7 +1,15 @@
+import os
+
 import numpy as np
 from scipy.sparse import coo_matrix
 from lightfm import LightFM
 
+# HNSW の保存 / 読み込みは e01_embedding/hnsw_store.py
+# （PYTHONPATH=../e01_embedding python e02_lightfm_index.py で実行する）
+from hnsw_store import open_hnsw_index
+
+SEED = 0
+
 # ===== 疑似データ =====
 interactions_data = np.array([1, 1, 1, 1, 1, 1])
 user_ids = np.array([0, 0, 1, 1, 2, 3])
@@ -18,8 +26,10 @@ interactions = coo_matrix(
 print("interactions shape:", interactions.shape)
 
 # ===== モデル作成 & 学習 =====
-model = LightFM(loss="warp")  # implicit 用
-model.fit(interactions, epochs=20, num_threads=2)
+# 乱数を固定して毎回同じ embedding に（保存した HNSW index の checksum が次回も合うように）。
+# 複数スレッドの学習（Hogwild SGD）は更新の順番が毎回変わって再現しないので 1 スレッドで学習する
+model = LightFM(loss="warp", random_state=SEED)  # implicit 用
+model.fit(interactions, epochs=20, num_threads=1)
 
 
 # LightFM から埋め込みを取り出す
@@ -29,27 +39,25 @@ item_biases, item_embeddings = model.get_item_representations()
 print("user_embeddings shape:", user_embeddings.shape)  # (num_users, k)
 print("item_embeddings shape:", item_embeddings.shape)  # (num_items, k)
 
-# ===== HNSW インデックス作成 =====
-import hnswlib
-
-dim = item_embeddings.shape[1]      # ベクトル次元数（LightFM の latent_dim）
-num_elements = item_embeddings.shape[0]  # アイテム数（num_items）
-
-# ===== HNSW インデックスを作成 =====
-p = hnswlib.Index(space='cosine', dim=dim)  # ここでは cosine 類似度ベース
-
-p.init_index(
-    max_elements=num_elements,
-    ef_construction=200,
+# ===== HNSW インデックス（保存 / 読み込みは e01_embedding/hnsw_store.py） =====
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# ===== HNSW インデックスを用意 =====
+# item embedding の隣に .cache/lightfm_items/hnsw/ として保存しておき、
+# 次回はそれを読み込む（checksum で item embedding と一致するか確認する。
+# 学習し直して embedding が変わっていれば作り直し、アイテムが後ろに増えただけなら追加分だけ登録）
+items_path = os.path.join(CACHE_DIR, "lightfm_items")
+os.makedirs(items_path, exist_ok=True)
+np.save(os.path.join(items_path, "item_embeddings.npy"), item_embeddings)
+p = open_hnsw_index(
+    os.path.join(items_path, "hnsw"),
+    item_embeddings,
+    space='cosine',  # ここでは cosine 類似度ベース
     M=16,
+    ef_construction=200,
+    ef=50,  # 検索時の精度/速度トレードオフ（大きくすると精度↑ 速度↓）
 )
 
-# アイテムベクトルを ANN に登録
-item_ids = np.arange(num_elements)  # 0,1,2,... の item index
-p.add_items(item_embeddings, item_ids)
-
-# 検索時の精度/速度トレードオフ
-p.set_ef(50)  # 大きくすると精度↑ 速度↓
 
 
 
@@ -76,3 +84,48 @@ ranked_by_lightfm = np.argsort(-scores_lightfm)
 
 print("LightFM ranking:", ranked_by_lightfm)
 print("ANN topK:", labels[0])
+
+
+# ===== predict と同じ順位で引く（MIPS） =====
+# cosine の index は bias もベクトルの長さも見ないので、上の 2 つの順位は一致しない。
+# アイテムに [bias, 長さをそろえる成分]、ユーザーに [1, 0] を足すと全アイテムの長さがそろうので、
+# 距離（space='l2'）が近い順 =「内積 + item bias」の順 = predict の順になる（user bias はユーザー内で一定）
+from mips import (augment_items, augment_users, predict_scores, recall_against_predict,
+                  squared_radius)
+
+mips_items = augment_items(item_embeddings, item_biases)
+mips_radius_sq = squared_radius(mips_items)
+p_mips = open_hnsw_index(
+    os.path.join(items_path, "hnsw_mips"),
+    mips_items,
+    space='l2',
+    M=16,
+    ef_construction=200,
+    ef=50,
+)
+
+mips_query = augment_users(user_embeddings[[user_id]])
+labels_mips, distances_mips = p_mips.knn_query(mips_query, k=K)
+print("MIPS topK:", labels_mips[0])
+print("MIPS scores:",
+      predict_scores(distances_mips, mips_query, mips_radius_sq, user_biases[[user_id]])[0])
+print("predict scores:", scores_lightfm[labels_mips[0]])
+
+# 全アイテムを predict で採点した結果とどれだけ一致するか（ここで 1.0 に近ければ index から返してよい）
+recall = recall_against_predict(model, p_mips, user_embeddings, num_items, k=K)
+print(f"MIPS recall@{K} vs predict: {recall:.3f}")
+
+
+# ===== 全ユーザー分をまとめて出す（日次バッチ用） =====
+# MIPS の index を chunk ごとに全コアで knn_query し、interaction 済みのアイテムを除いて
+# .cache/lightfm_recs/ に書き出す（.parquet を指定すると Parquet）
+from bulk_recommend import recommend_all_users
+
+recs_path = os.path.join(CACHE_DIR, "lightfm_recs")
+recommend_all_users(p_mips, augment_users(user_embeddings), K, recs_path,
+                    interactions=interactions, chunk_size=10000, num_threads=-1,
+                    to_scores=lambda d, q: predict_scores(d, q, mips_radius_sq))
+
+recs_items = np.load(os.path.join(recs_path, "items.npy"), mmap_mode="r")
+for u in range(num_users):
+    print("user", u, "おすすめ（interaction 済みを除く）:", recs_items[u])
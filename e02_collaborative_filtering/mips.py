@@ -0,0 +1,70 @@
+# =====================================
+# LightFM.predict と同じ順位を ANN で出す（最大内積探索 / MIPS）
+# =====================================
+# LightFM のスコアは
+#   predict(u, i) = user_emb[u]·item_emb[i] + user_bias[u] + item_bias[i]
+# で、cosine の index（ベクトルの向きだけを見る）とは順位が合わない。そこで
+#   アイテム: x_i = [item_emb[i], item_bias[i], sqrt(R² - |item_emb[i]|² - item_bias[i]²)]
+#   ユーザー: q_u = [user_emb[u], 1, 0]
+# と 1 次元ずつ足すと q_u·x_i = user_emb[u]·item_emb[i] + item_bias[i] になる
+# （user_bias[u] はユーザー内で一定なので順位に関係ない）。
+# R は |[item_emb, item_bias]| の最大値で、最後の成分で全アイテムの x_i を同じ長さ R にそろえる。
+# すると |q_u - x_i|² = |q_u|² + R² - 2 q_u·x_i なので、space="l2" の HNSW で近い順に引いた
+# 上位 k 件が predict の上位 k 件と一致する（ANN の近似誤差を除く。space="cosine" でも同じ順位）。
+# （space="ip" なら最後の成分はクエリ側が 0 なので効かず、長さのそろわない内積をそのまま引くことになる）
+import numpy as np
+
+
+def augment_items(item_embeddings, item_biases):
+    """(num_items, dim) → (num_items, dim + 2)。全行の長さがそろう"""
+    x = np.hstack([np.asarray(item_embeddings, dtype=np.float32),
+                   np.asarray(item_biases, dtype=np.float32)[:, None]])
+    sq_norms = (x.astype(np.float64) ** 2).sum(axis=1)
+    completion = np.sqrt(np.maximum(sq_norms.max() - sq_norms, 0.0))
+    return np.hstack([x, completion[:, None].astype(np.float32)])
+
+
+def augment_users(user_embeddings):
+    """(num_users, dim) → (num_users, dim + 2)"""
+    user_embeddings = np.asarray(user_embeddings, dtype=np.float32)
+    n = len(user_embeddings)
+    return np.hstack([user_embeddings, np.ones((n, 1), dtype=np.float32),
+                      np.zeros((n, 1), dtype=np.float32)])
+
+
+def squared_radius(augmented_items):
+    """augment_items の結果の（全行共通の）長さの 2 乗 R²"""
+    augmented_items = np.asarray(augmented_items, dtype=np.float64)
+    return float((augmented_items ** 2).sum(axis=1).max()) if len(augmented_items) else 0.0
+
+
+def predict_scores(distances, user_queries, radius_sq, user_biases=None):
+    """
+    space="l2" の距離 → LightFM.predict と同じスコア
+    user_queries: augment_users の結果（クエリした順）、radius_sq: squared_radius(アイテム側)
+    user_biases を省略すると user_bias を足さない（順位は同じ）
+    """
+    q_sq = (np.asarray(user_queries, dtype=np.float64) ** 2).sum(axis=1, keepdims=True)
+    scores = (q_sq + radius_sq - np.asarray(distances, dtype=np.float64)) / 2.0
+    if user_biases is not None:
+        scores += np.asarray(user_biases, dtype=np.float64).reshape(-1, 1)
+    return scores.astype(np.float32)
+
+
+def recall_against_predict(model, index, user_embeddings, num_items, k=10, user_ids=None,
+                           num_threads=-1):
+    """
+    user_ids のユーザーについて、index の上位 k 件と
+    model.predict で全アイテムを採点した上位 k 件の重なり（recall@k の平均）
+    """
+    user_ids = np.arange(len(user_embeddings)) if user_ids is None else np.asarray(user_ids)
+    k = min(k, num_items)
+    labels, _ = index.knn_query(augment_users(user_embeddings[user_ids]), k=k,
+                                num_threads=num_threads)
+    item_ids = np.arange(num_items)
+    hits = 0
+    for labels_u, u in zip(labels, user_ids):
+        scores = model.predict(int(u), item_ids)
+        truth = np.argpartition(-scores, k - 1)[:k]
+        hits += len(set(labels_u.tolist()) & set(truth.tolist()))
+    return hits / (k * max(len(user_ids), 1))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# スクリプトと同じく、e02_collaborative_filtering/ の中のモジュールをそのまま import する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+import hnswlib
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from bulk_recommend import recommend_all_users
+from mips import augment_items, augment_users, predict_scores, squared_radius
+
+
+def toy_model(n_users=50, n_items=120, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    user_emb = rng.standard_normal((n_users, dim)).astype(np.float32)
+    item_emb = (rng.standard_normal((n_items, dim))
+                * rng.uniform(0.1, 3.0, (n_items, 1))).astype(np.float32)
+    item_bias = rng.standard_normal(n_items).astype(np.float32)
+
+    # interaction の数をばらばらにする（99 パーセンタイルを超える人は取り直しになる）
+    seen = sp.lil_matrix((n_users, n_items), dtype=np.float32)
+    for u in range(n_users):
+        n_seen = 60 if u % 17 == 0 else int(rng.integers(0, 5))
+        seen[u, rng.choice(n_items, n_seen, replace=False)] = 1.0
+    seen[3, :] = 1.0  # 全部見たユーザー → 全枠 -1
+    return user_emb, item_emb, item_bias, seen.tocsr()
+
+
+def brute_force(user_emb, item_emb, item_bias, seen, k):
+    predict = user_emb @ item_emb.T + item_bias[None, :]
+    predict[seen.toarray() > 0] = -np.inf
+    top = np.argsort(-predict, axis=1, kind="stable")[:, :k]
+    return np.where(np.take_along_axis(predict, top, axis=1) > -np.inf, top, -1), predict
+
+
+def read_result(out_path):
+    if out_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(out_path)
+        return (table.column("user_id").to_numpy(),
+                np.array(table.column("items").to_pylist()),
+                np.array(table.column("scores").to_pylist(), dtype=np.float32))
+    return tuple(np.load(f"{out_path}/{name}.npy", mmap_mode="r")
+                 for name in ("user_ids", "items", "scores"))
+
+
+@pytest.mark.parametrize("out_name", ["recs.parquet", "recs"])
+def test_matches_brute_force_with_seen_items_excluded(tmp_path, out_name):
+    if out_name.endswith(".parquet"):
+        pytest.importorskip("pyarrow")
+    user_emb, item_emb, item_bias, seen = toy_model()
+    items = augment_items(item_emb, item_bias)
+    index = hnswlib.Index(space="l2", dim=items.shape[1])
+    index.init_index(max_elements=len(items), ef_construction=200, M=16)
+    index.add_items(items, np.arange(len(items)))
+    index.set_ef(len(items))
+    radius_sq = squared_radius(items)
+
+    k = 10
+    out_path = str(tmp_path / out_name)
+    recommend_all_users(index, augment_users(user_emb), k, out_path, interactions=seen,
+                        chunk_size=16, num_threads=4, verbose=False,
+                        to_scores=lambda d, q: predict_scores(d, q, radius_sq))
+
+    user_ids, found, scores = read_result(out_path)
+    expected, predict = brute_force(user_emb, item_emb, item_bias, seen, k)
+    np.testing.assert_array_equal(user_ids, np.arange(len(user_emb)))
+    assert found.shape == (len(user_emb), k)
+    np.testing.assert_array_equal(found, expected)
+    assert (found[3] == -1).all() and (scores[3] == 0).all()
+
+    valid = found >= 0
+    np.testing.assert_allclose(scores[valid],
+                               np.take_along_axis(predict, np.maximum(found, 0), axis=1)[valid],
+                               atol=1e-3)
+    # 取り直しになったユーザー（interaction 60 件）も k 件そろっている
+    assert valid[::17].all()
@@ -0,0 +1,59 @@
+import hnswlib
+import numpy as np
+
+from bulk_recommend import recommend_chunk
+from mips import augment_items, augment_users, predict_scores, squared_radius
+
+
+def lightfm_like(n_users=20, n_items=300, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    user_emb = rng.standard_normal((n_users, dim)).astype(np.float32)
+    # 長さのばらばらなアイテム（cosine だと順位が合わない）
+    item_emb = (rng.standard_normal((n_items, dim))
+                * rng.uniform(0.1, 3.0, (n_items, 1))).astype(np.float32)
+    return (user_emb, rng.standard_normal(n_users).astype(np.float32),
+            item_emb, rng.standard_normal(n_items).astype(np.float32))
+
+
+def mips_index(items):
+    index = hnswlib.Index(space="l2", dim=items.shape[1])
+    index.init_index(max_elements=len(items), ef_construction=200, M=16)
+    index.add_items(items, np.arange(len(items)))
+    index.set_ef(len(items))
+    return index
+
+
+def test_augmented_items_have_equal_norms():
+    _, _, item_emb, item_bias = lightfm_like()
+    items = augment_items(item_emb, item_bias)
+    norms_sq = (items.astype(np.float64) ** 2).sum(axis=1)
+    np.testing.assert_allclose(norms_sq, squared_radius(items), rtol=1e-5)
+
+
+def test_top_k_matches_brute_force_predict():
+    user_emb, user_bias, item_emb, item_bias = lightfm_like()
+    items = augment_items(item_emb, item_bias)
+    queries = augment_users(user_emb)
+    k = 10
+    labels, distances = mips_index(items).knn_query(queries, k=k)
+
+    predict = user_emb @ item_emb.T + item_bias[None, :] + user_bias[:, None]
+    truth = np.argsort(-predict, axis=1)[:, :k]
+    np.testing.assert_array_equal(labels, truth)
+    np.testing.assert_allclose(
+        predict_scores(distances, queries, squared_radius(items), user_bias),
+        np.take_along_axis(predict, labels.astype(np.int64), axis=1), atol=1e-3)
+
+
+def test_recommend_chunk_scores_with_to_scores():
+    user_emb, _, item_emb, item_bias = lightfm_like()
+    items = augment_items(item_emb, item_bias)
+    queries = augment_users(user_emb)
+    radius_sq = squared_radius(items)
+    found, scores = recommend_chunk(mips_index(items), queries, 5,
+                                    to_scores=lambda d, q: predict_scores(d, q, radius_sq))
+
+    predict = user_emb @ item_emb.T + item_bias[None, :]
+    np.testing.assert_array_equal(found, np.argsort(-predict, axis=1)[:, :5])
+    np.testing.assert_allclose(scores, np.take_along_axis(predict, found.astype(np.int64), axis=1),
+                               atol=1e-3)